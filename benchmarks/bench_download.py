@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measure download write-path throughput against a local stand-in for the Log Insight /messages endpoint.
+Compares the original 512-byte iter_content loop with copy_response at several buffer sizes.
+
+    python benchmarks/bench_download.py [--megabytes 256] [--repeat 3]
+"""
+
+import argparse
+import contextlib
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from loginsightexport.files import copy_response  # noqa: E402
+from loginsightexport.uidriver import Connection  # noqa: E402
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+EVENT = b'{"text":"benchmark event with a moderately sized message body","timestamp":1483154000000,"fields":[]},'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(body):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            view = memoryview(body)
+            for offset in range(0, len(body), 1024 * 1024):
+                self.wfile.write(view[offset:offset + 1024 * 1024])
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def legacy_copy(response, f):
+    """The write path prior to copy_response: a Python-level write per 512-byte chunk."""
+    written = 0
+    for chunk in response.iter_content(chunk_size=512):
+        written += len(chunk)
+        f.write(chunk)
+    return written
+
+
+def measure(connection, directory, copy_fn, repeat):
+    best = None
+    for i in range(repeat):
+        filename = os.path.join(directory, "output.%d" % i)
+        started = time.perf_counter()
+        with open(filename, 'xb') as f:
+            with contextlib.closing(connection.get("/messages", stream=True, sendauthorization=False)) as r:
+                written = copy_fn(r, f)
+        elapsed = time.perf_counter() - started
+        os.unlink(filename)
+        rate = written / elapsed / (1024 * 1024)
+        best = rate if best is None else max(best, rate)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megabytes", type=int, default=256, help="Size of the served export body, default %(default)s")
+    parser.add_argument("--repeat", type=int, default=3, help="Report the best of %(metavar)s runs, default %(default)s")
+    args = parser.parse_args()
+
+    body = EVENT * (args.megabytes * 1024 * 1024 // len(EVENT))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(body))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    connection = Connection("127.0.0.1", port=server.server_address[1], ssl=False)
+    candidates = [("iter_content(512) + write", legacy_copy)]
+    for buffer_size in (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024):
+        candidates.append(("copy_response(buffer_size=%d)" % buffer_size, lambda r, f, b=buffer_size: copy_response(r, f, b)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("Downloading {0} MB from {1}:{2}, best of {3}".format(len(body) // (1024 * 1024), *server.server_address, args.repeat))
+        for name, fn in candidates:
+            print("{0:>40}: {1:8.1f} MB/s".format(name, measure(connection, directory, fn, args.repeat)))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -16,12 +16,15 @@
 from __future__ import print_function
 import argparse
 import collections
+import contextlib
 import logging
 import netrc
 import os
 import shutil
 import sys
+import threading
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from getpass import getpass, getuser
 from urllib.parse import urlparse
@@ -31,12 +34,42 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from requests.structures import CaseInsensitiveDict
 
-from loginsightexport.binfit import merge, patch_bins_at_boundaries, split, sorted_by_startTimeMillis
+from loginsightexport.binfit import anchored_target, estimate_split_requests, merge, pack, partition, patch_bins_at_boundaries, split, split_by_density, split_by_level, sorted_by_startTimeMillis
+from loginsightexport.cancellation import OutstandingQueries, untracked
 from loginsightexport.paramhelper import ExplorerUrlParse, SeenWarning
+from loginsightexport.plan import InvalidPlan, Plan, shard
+from loginsightexport.plancache import PlanCache, PLAN_CACHE_DIRECTORY
 from loginsightexport.progress import ProgressRange, ProgressBar
+from loginsightexport.scheduler import Scheduler, prefetch
+from loginsightexport.serverlog import ServerLog
+from loginsightexport.sessioncache import SessionCache, SESSION_CACHE_DIRECTORY
+from loginsightexport.sessionpool import SessionPool
 from loginsightexport.shorturl import unfurl_short_url
-from loginsightexport.uidriver import Connection, Credentials, AggregateQuery, TechPreviewWarning
-from loginsightexport.files import ExportBinToFile, InconsistentFile
+from loginsightexport.throttle import AdaptiveLimit, BinSizer, Throttle
+from loginsightexport.uidriver import Connection, Credentials, AggregateQuery, FieldAggregateQuery, TechPreviewWarning
+from loginsightexport.files import Cancelled, ExportBinToFile, InconsistentFile, SyncPolicy, DEFAULT_BUFFER_SIZE, LAYOUTS, OUTPUT_PREFIX, bin_filename, bin_path, check_file, output_files
+from loginsightexport.lease import Leases, LeaseLost, claim
+from loginsightexport.manifest import Manifest
+
+
+def shard_argument(value):
+    """Parse --shard I/N into (I, N)."""
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected I/N, such as 2/4, got {0!r}".format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("expected 1 <= I <= N, got {0!r}".format(value))
+    return index, count
+
+
+def node_argument(value):
+    """Parse --node HOST[:PORT] into (HOST, PORT), PORT None if not given."""
+    hostname, _, port = value.rpartition(':') if ':' in value else (value, None, None)
+    try:
+        return hostname, int(port) if port else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected HOST or HOST:PORT, got {0!r}".format(value))
 
 
 def arguments():
@@ -48,9 +81,9 @@ def arguments():
         usage='%(prog)s https://loginsight.example.com/s/e6jc6n',
     )
 
-    parser.add_argument("url",
+    parser.add_argument("url", nargs="?",
                         metavar='https://.../s/e6jc6n',
-                        help="A short share URL, produced by the Log Insight UI.")
+                        help="A short share URL, produced by the Log Insight UI. Optional with --from-plan, which names the query; if given, it picks the server")
     parser.add_argument('-o', '--output',
                         default=os.getcwd(),
                         metavar="DIR",
@@ -69,6 +102,13 @@ def arguments():
                               help="Alternate .netrc configuration file with credentials in the format "
                                    "`machine li.example.com login Charlie password SuperSecr3t! account Local`")
 
+    accountgroup.add_argument("--session-cache", nargs="?", const=SESSION_CACHE_DIRECTORY, default=None, metavar="DIR",
+                              help="Reuse the session of an earlier run for the same server and user, skipping the login, and keep this run's for the next. "
+                                   "Sessions are kept in %(metavar)s, readable only by you, default {0}".format(SESSION_CACHE_DIRECTORY))
+    accountgroup.add_argument("--session-ttl", type=float, default=1800, metavar="SECONDS",
+                              help="Log in again before a session has lasted this long, rather than have a request refused, and replayed, "
+                                   "once the server expires it. Default %(default)ss, the server's default session timeout; 0 to wait for a refusal.")
+
     certgroup = parser.add_argument_group("Certificates")
     certgroup.add_argument("--save", metavar="foo.pem",
                            help="Save the remote's certificate as a PEM-formatted file.")
@@ -82,12 +122,93 @@ def arguments():
     loggroup.add_argument("-v", "--verbose", action="count", default=0, dest="loglevel", help="Replace progressbar with logs. -vv writes PII (urls & queries) to stdout")
     loggroup.add_argument("--noprompt", action="store_false", default=True, dest="prompt", help="Don't prompt for anything interactively")
 
-    parser.add_argument("--nice", type=int, default=0, dest="delay", help="Be nice: wait %(metavar)s seconds between chunk downloads.")
+    storagegroup = parser.add_argument_group("Storage")
+    storagegroup.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE, metavar="BYTES", help="Read downloads from the network in blocks of %(metavar)s, default %(default)s; the fastest size depends on the machine")
+    storagegroup.add_argument("--preallocate", type=int, default=0, metavar="BYTES", help="Reserve %(metavar)s of disk per expected event before writing each file, default %(default)s (off)")
+    storagegroup.add_argument("--revalidate", action="store_true", help="Re-read existing output files to check them, even those the manifest already vouches for. "
+                                                                        "Without it, a file the manifest records is skipped if its size matches, and its checksum isn't verified")
+    storagegroup.add_argument("--validate", type=int, nargs="?", const=os.cpu_count() or 1, default=None, metavar="N",
+                              help="Don't download anything: check the output files against the plan using %(metavar)s processes (default: one per CPU), then exit")
+    storagegroup.add_argument("--fsync", default="none", choices=SyncPolicy.MODES, help="Flush completed files to disk never (leave it to the OS), per file, or in batches. Default: %(default)s")
+
+    throttlegroup = parser.add_argument_group("Throttling")
+    throttlegroup.add_argument("--nice", type=float, default=0, dest="delay", metavar="SECONDS", help="Be nice: wait %(metavar)s seconds between chunk downloads.")
+    throttlegroup.add_argument("--adaptive", action="store_true",
+                               help="Start with one download at a time, and adapt up to --parallel as the server copes: back off on slow responses, server errors and Warning headers")
+    throttlegroup.add_argument("--requests-per-second", type=float, default=0, metavar="N", help="Send at most %(metavar)s requests per second, default unlimited")
+    throttlegroup.add_argument("--bytes-per-second", type=int, default=0, metavar="N", help="Download at most %(metavar)s bytes per second, default unlimited")
+    throttlegroup.add_argument("--stall-timeout", type=float, default=0, metavar="SECONDS",
+                               help="Give up on a download which sends nothing for %(metavar)s seconds, and resume it where it stopped; other requests only time out connecting. Default: wait forever")
+    # A cancel token costs a request to the server before each query it tags, so by default only the downloads which the
+    # export itself may abandon, for a hedge or a resume, are tagged.
+    throttlegroup.add_argument("--cancel", action="store_const", const="all", default="superseded", dest="cancel",
+                               help="Tag every query, chart queries included, with a cancel token, so that an abort cancels whatever the server is still running. "
+                                    "Costs an extra request per query. Default: only downloads which --hedge or --stall-timeout may abandon are tagged")
+    throttlegroup.add_argument("--no-cancel", action="store_const", const="none", dest="cancel",
+                               help="Don't tag any query with a cancel token, saving the extra request before each download which --hedge or --stall-timeout may abandon; "
+                                    "queries abandoned by an abort, a timeout or a hedge then run to completion on the server")
     parser.add_argument("--max", type=int, default=2000, help="Largest quantity of messages to retrieve in a single bin [1-20k], default %(default)s")
+    parser.add_argument("--target-seconds", type=float, default=0, metavar="SECONDS",
+                        help="With --pipeline, size bins, within --max, for each download to take about %(metavar)s, judging by the downloads so far")
+    parser.add_argument("--target-bytes", type=int, default=0, metavar="N",
+                        help="With --pipeline, size bins, within --max, for each file to be about %(metavar)s bytes, judging by the downloads so far")
     parser.add_argument("--raw", dest="format", action="store_const", default="JSON", const="RAW", help="Export in %(const)s format instead of the %(default)s default")
+    parser.add_argument("--parallel", type=int, default=1, metavar="N", help="Download up to %(metavar)s bins at the same time, default %(default)s")
+    parser.add_argument("--hedge", type=int, default=0, metavar="N",
+                        help="Once every bin has started, download up to %(metavar)s of the slowest a second time, keep whichever copy finishes first and cancel the other")
+    parser.add_argument("--sessions", type=int, default=1, metavar="N",
+                        help="Log in %(metavar)s times and spread queries over the sessions, for servers which run each session's queries one at a time, default %(default)s")
+    parser.add_argument("--node", type=node_argument, action="append", default=[], dest="nodes", metavar="HOST[:PORT]",
+                        help="Another node of the same Log Insight cluster to query, as well as the one in the URL; may be repeated. "
+                             "Each node gets --sessions logins, and workers favour the nodes answering fastest")
+    parser.add_argument("--pipeline", action="store_true", help="Start downloading bins while the rest of the time range is still being planned")
+    parser.add_argument("--plan-parallel", type=int, default=1, metavar="N", help="While planning, issue up to %(metavar)s chart queries at the same time, default %(default)s")
+    parser.add_argument("--planner", default="split", choices=["split", "density"],
+                        help="Divide oversized bins one chart request at a time (split), or into as many windows as their event counts predict, "
+                             "so fewer rounds of requests are needed (density). Default: %(default)s")
+    parser.add_argument("--packer", default="greedy", choices=["greedy", "optimal", "balanced"],
+                        help="Merge neighbouring bins left to right while they fit under --max (greedy); into as few bins, "
+                             "with the largest as small as possible (optimal); or also into a multiple of --parallel bins, so every round of downloads is full (balanced). Default: %(default)s")
+    parser.add_argument("--partition-field", metavar="FIELD", default=None,
+                        help="Divide a millisecond holding more than --max events by the values of %(metavar)s, such as hostname or __li_source_path, "
+                             "into separate files which download in parallel")
+    parser.add_argument("--plan-cache", metavar="DIR", default=None,
+                        help="Remember chart query results in %(metavar)s, so re-runs of the same query skip planning. Default: {0} in the output directory".format(PLAN_CACHE_DIRECTORY))
+    parser.add_argument("--no-plan-cache", action="store_const", const=False, dest="plan_cache", help="Always ask the server to plan")
+    parser.add_argument("--plan-cache-ttl", type=float, default=600, metavar="SECONDS",
+                        help="Trust cached results for recent time ranges for %(metavar)s, default %(default)s. Results for ranges over an hour old never expire")
+    storagegroup.add_argument("--layout", default=LAYOUTS[0], choices=LAYOUTS,
+                              help="Write output files straight into the output directory (flat), or into YYYY/MM/DD/HH subdirectories by the UTC hour "
+                                   "each bin starts in (hourly), which keeps directories small for large exports. A resumed export must use the same layout. Default: %(default)s")
+    storagegroup.add_argument("--cooperate", action="store_true",
+                              help="Share the output directory with other processes exporting the same plan: each bin is leased by one process at a time, "
+                                   "and bins whose process stopped renewing its lease are taken over. The directory must be on a local filesystem")
+    storagegroup.add_argument("--lease-expiry", type=float, default=60, metavar="SECONDS",
+                              help="With --cooperate, take over a bin whose lease hasn't been renewed for %(metavar)s, default %(default)s")
+    plangroup = parser.add_argument_group("Plan files")
+    plangroup.add_argument("--plan-only", metavar="FILE", default=None,
+                           help="Plan the export, write the bins and the query to %(metavar)s, then exit without downloading")
+    plangroup.add_argument("--from-plan", metavar="FILE", default=None,
+                           help="Download the bins in a file written by --plan-only, without planning again")
+    plangroup.add_argument("--shard", type=shard_argument, default=None, metavar="I/N",
+                           help="Only download the I'th of N slices of the plan, balanced by event count, so that N machines can share an export. "
+                                "Their output directories may be separate or shared")
 
     args = parser.parse_args()
 
+    args.plan = None
+    if args.from_plan is not None:
+        try:
+            args.plan = Plan.load(args.from_plan)
+        except (OSError, InvalidPlan) as e:
+            parser.error("Can't use --from-plan: {0}".format(e))
+        if args.url is None:
+            args.url = args.plan.url
+        args.format = args.plan.output_format
+        args.max = args.plan.maximum
+    elif args.url is None:
+        parser.error("A URL is required, unless downloading --from-plan")
+
     # Add hostname/port/username/password to args namespace, derived from URL or .netrc file
     remote = urlparse(args.url)
 
@@ -152,6 +273,45 @@ def arguments():
     if not os.path.isdir(args.output):
         parser.error("{0} is not a directory".format(args.output))
 
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if args.plan_parallel < 1:
+        parser.error("--plan-parallel must be at least 1")
+    if args.sessions < 1:
+        parser.error("--sessions must be at least 1")
+    if args.buffer_size < 1:
+        parser.error("--buffer-size must be at least 1")
+    if args.plan_cache is None:
+        args.plan_cache = os.path.join(args.output, PLAN_CACHE_DIRECTORY)
+
+    if args.delay < 0 or args.requests_per_second < 0 or args.bytes_per_second < 0 or args.stall_timeout < 0:
+        parser.error("--nice, --requests-per-second, --bytes-per-second and --stall-timeout can't be negative")
+    if args.hedge < 0:
+        parser.error("--hedge can't be negative")
+    if args.hedge and args.parallel < 2:
+        parser.error("--hedge races a second copy of a download on a spare worker, it needs --parallel 2 or more")
+    if args.validate is not None:
+        if args.validate < 1:
+            parser.error("--validate must use at least 1 process")
+        if args.pipeline:
+            parser.error("--validate checks a complete plan, it can't be combined with --pipeline")
+    if args.target_seconds < 0 or args.target_bytes < 0:
+        parser.error("--target-seconds and --target-bytes can't be negative")
+    if (args.target_seconds or args.target_bytes) and not args.pipeline:
+        parser.error("--target-seconds and --target-bytes size bins by the downloads before them, they need --pipeline")
+    if args.packer != "greedy" and args.pipeline:
+        parser.error("--packer {0} needs the complete plan, it can't be combined with --pipeline".format(args.packer))
+    if (args.plan_only or args.from_plan or args.shard) and args.pipeline:
+        parser.error("--plan-only, --from-plan and --shard work on a complete plan, they can't be combined with --pipeline")
+    if args.cooperate and (args.pipeline or args.validate is not None or args.plan_only):
+        parser.error("--cooperate shares out the bins of a complete plan to download, it can't be combined with --pipeline, --validate or --plan-only")
+    if args.lease_expiry <= 0:
+        parser.error("--lease-expiry must be positive")
+    if args.plan_only and (args.from_plan or args.shard or args.validate is not None):
+        parser.error("--plan-only writes a whole plan and exits, it can't be combined with --from-plan, --shard or --validate")
+    if args.from_plan and (args.partition_field or args.packer != "greedy"):
+        parser.error("--from-plan downloads bins which were partitioned and packed when they were planned")
+
     nice_provider_names = CaseInsensitiveDict({'local': "DEFAULT", 'ad': "ACTIVE_DIRECTORY"})
     if args.provider in nice_provider_names:
         args.provider = nice_provider_names[args.provider]
@@ -161,6 +321,9 @@ def arguments():
 
     args.path = remote.path
     args.query = remote.query
+    if args.plan is not None:
+        planned = urlparse(args.plan.url)
+        args.path, args.query = planned.path, planned.query
 
     return parser, args
 
@@ -189,15 +352,47 @@ def setup_logger(args):
 def main():
     parser, args = arguments()
     logger = setup_logger(args)
+    # A 0ms bin can't be split, so one holding more than --max events is exported in pages of --max instead.
+    # Pages of a JSON export are checked against their headers while they're stitched together; RAW pages can't be.
+    paginate = args.format == 'JSON'
 
-    with ProgressBar([], quiet=True) as overall_progress:
+    with ProgressBar([], quiet=True) as overall_progress, contextlib.ExitStack() as resources:
         session = requests.Session()
 
         retries = Retry(total=20, backoff_factor=1, status_forcelist=[500, 502, 503, 504])  # Retry on server errors
-        session.mount('https://', HTTPAdapter(max_retries=retries))
-
-        auth = Credentials(args.username, args.password, args.provider, reuse_session=session)
-        ui = Connection(args.hostname, port=args.port, verify=args.verify, auth=auth, existing_session=session)
+        session.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=max(10, args.parallel, args.plan_parallel)))  # One pooled connection per worker
+
+        throttle = Throttle(concurrency=AdaptiveLimit(maximum=args.parallel) if args.adaptive else None,
+                            requests_per_second=args.requests_per_second,
+                            bytes_per_second=args.bytes_per_second,
+                            download_interval=args.delay)
+        session_cache = None
+        if args.session_cache:
+            session_cache = SessionCache(args.session_cache, args.hostname, args.port, args.username, args.provider)
+        cached_session = session_cache.load() if session_cache is not None else None
+        auth = Credentials(args.username, args.password, args.provider, reuse_session=session,
+                           session=cached_session, session_age=session_cache.age if cached_session is not None else 0,
+                           on_login=session_cache.save if session_cache is not None else None,
+                           session_ttl=args.session_ttl or None)
+        ui = Connection(args.hostname, port=args.port, verify=args.verify, auth=auth, existing_session=session, throttle=throttle,
+                        timeout=args.stall_timeout or None)
+        pool = ui  # Where queries go; each worker sticks to one of --sessions logins on each --node for a while
+        if args.sessions > 1 or args.nodes:
+            def new_session():
+                pooled = requests.Session()
+                # Room for every worker: threads gravitate to the fastest session, so any one of them may have them all
+                pooled.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=max(args.parallel, args.plan_parallel)))
+                return pooled
+
+            nodes = [(hostname, port or args.port) for hostname, port in args.nodes]
+            pool = SessionPool.login(ui, args.sessions, new_session=new_session, nodes=nodes)
+        server_log = ServerLog(ui)  # Messages for the server's ui_runtime.log, sent in the background
+        resources.callback(server_log.close)
+        cancel_downloads = args.cancel == "all" or (args.cancel == "superseded" and bool(args.hedge or args.stall_timeout))
+        queries = OutstandingQueries(pool) if cancel_downloads else None
+        chart_queries = queries if args.cancel == "all" else None  # Only an abort would cancel one
+        if queries is not None:
+            resources.callback(queries.cancel_all)  # On the way out of an abort, cancel whatever the server is still running for us
 
         try:
             ui.ping()  # Make a GET / request to the server.
@@ -215,7 +410,7 @@ def main():
             parser.exit()
 
         logger.info("Connected to {0}".format(args.hostname))
-        ui.log("Connected")
+        server_log.log("Connected")
 
         # If we got a short url, expand it to a long /explorer? one
         explorer_url = "%s?%s" % (args.path, args.query)
@@ -226,85 +421,285 @@ def main():
         # Generate an initial list of binned timestamps
         root = ExplorerUrlParse(explorer_url)
 
-        # We're ready to start doing work
-
-        # Recursively split into smaller bins, with progress bar
-        with ProgressRange() as callback:
-            def retrieve_aggregate_results(bin=(None, None, None), report_callback=True):
-                if report_callback:
-                    callback.update([(bin[0], bin[1], 0)])
-                a = AggregateQuery(ui, root.chartingurl_export(altstart=bin[0], altend=bin[1]))
-                return sorted_by_startTimeMillis(patch_bins_at_boundaries(bin, a.bins))
-
-            overview = retrieve_aggregate_results((root.start, root.end, 0), False)
-            callback.start(overview)
-            expanded_bins = list(split(overview, retrieve_aggregate_results, maximum=args.max))
+        plan_cache = None
+        if args.plan_cache and args.plan is None:
+            plan_cache = PlanCache(args.plan_cache, server="{0}:{1}".format(args.hostname, args.port), model=root.existingChartQuery,
+                                   username=args.username, provider=args.provider, ttl=args.plan_cache_ttl)
 
-            ui.log("Estimation over range {d}: {e} events in {b} bins took {r} requests".format(
-                d=datetime.fromtimestamp(callback._end / 1000) - datetime.fromtimestamp(callback._start / 1000),
-                e=sum([x[2] for x in expanded_bins]),
-                b=len(expanded_bins),
-                r=callback.updates,
-            ))
+        manifest = Manifest(args.output)
+        sizer = target = anchors = None
+        if args.target_seconds or args.target_bytes:
+            sizer = BinSizer(args.max, target_seconds=args.target_seconds, target_bytes=args.target_bytes)
+            # Bins are split and merged toward the sizer's target as it learns from the downloads. Ranges completed by
+            # an earlier run are divided and merged as they were then, so their files are still part of the plan.
+            anchors = {e.start: e.end for e in manifest.entries()}
+            target = anchored_target(sizer, anchors)
 
-            rendered_bins = list(merge(expanded_bins, maximum=args.max))
+        # We're ready to start doing work
 
-            ui.log("Repacked estimation over range {d}: {e} events in {b} bins".format(
-                d=datetime.fromtimestamp(callback._end / float(1000)) - datetime.fromtimestamp(callback._start / float(1000)),
-                e=sum([x[2] for x in rendered_bins]),
-                b=len(rendered_bins),
-            ))
+        if args.plan is not None:
+            rendered_bins = args.plan.bins
+            server_log.log("Loaded plan {f}: {e} events in {b} bins".format(f=args.from_plan, e=sum([x[2] for x in rendered_bins]), b=len(rendered_bins)))
+        else:
+            # Recursively split into smaller bins, with progress bar.
+            # A pipelined plan keeps running while bins download, so it doesn't draw its own progress bar.
+            with ProgressRange(quiet=args.pipeline) as callback:
+                def tracked():
+                    """A cancel token for one chart query, with --cancel."""
+                    return chart_queries.track() if chart_queries is not None else untracked()
+
+                def retrieve_aggregate_results(bin=(None, None, None), report_callback=True):
+                    bins = plan_cache.get(bin[0], bin[1]) if plan_cache is not None else None
+                    if report_callback:
+                        callback.update([(bin[0], bin[1], 0)], increment=1 if bins is None else 0)  # Counts requests to the server
+                    if bins is None:
+                        with tracked() as token:
+                            query = AggregateQuery(pool, root.chartingurl_export(altstart=bin[0], altend=bin[1], cancel_token=token))
+                        if sizer is not None:
+                            sizer.observe_query(query.elapsed.total_seconds())
+                        bins = query.bins
+                        if plan_cache is not None:
+                            plan_cache.put(bin[0], bin[1], bins)
+                    return sorted_by_startTimeMillis(patch_bins_at_boundaries(bin, bins))
+
+                overview = retrieve_aggregate_results((root.start, root.end, 0), False)
+                callback.start(overview)
+                planner_map = map
+                if args.plan_parallel > 1:
+                    planners = resources.enter_context(ThreadPoolExecutor(max_workers=args.plan_parallel))
+                    if chart_queries is not None:
+                        resources.callback(chart_queries.cancel_all)  # Before the planners wait for their queries to finish
+                    planner_map = planners.map
+
+                plan_stats = collections.Counter()
+                histogram = []  # The density planner's final bins, kept to estimate what split would have cost
+
+                def recorded(bins):
+                    for b in bins:
+                        histogram.append(b)
+                        yield b
+
+                def retrieve_field_groups(bin, field):
+                    callback.update([(bin[0], bin[1], 0)])
+                    with tracked() as token:
+                        return FieldAggregateQuery(pool, root.chartingurl_export(altstart=bin[0], altend=bin[1], group_by=field, cancel_token=token)).groups
+
+                # Partitioning by field picks up 0ms bins that split leaves oversized; those it can't divide fall back to pages
+                leave_whole = paginate or args.partition_field is not None
+
+                if args.planner == 'density':
+                    expanded_bins = recorded(split_by_density(overview, retrieve_aggregate_results, maximum=args.max, map_fn=planner_map,
+                                                              buckets_per_request=max(2, len(overview)), stats=plan_stats, paginate=leave_whole))
+                elif args.plan_parallel > 1:
+                    expanded_bins = split_by_level(overview, retrieve_aggregate_results, maximum=args.max, map_fn=planner_map, paginate=leave_whole)
+                else:
+                    expanded_bins = split(overview, retrieve_aggregate_results, maximum=args.max, paginate=leave_whole, target=target)
+                if args.partition_field is not None:
+                    expanded_bins = partition(expanded_bins, retrieve_field_groups, args.partition_field, maximum=args.max, paginate=paginate)
+
+                def log_planner_savings():
+                    if args.planner != 'density':
+                        return
+                    requests, rounds = estimate_split_requests(overview, histogram, maximum=args.max,
+                                                               buckets_per_request=plan_stats['buckets_per_request'] or max(2, len(overview)))
+                    server_log.log("Density planning took {r} chart requests in {l} rounds; split would have taken about {e} in {d} rounds, saving {s} requests".format(
+                        r=plan_stats['requests'], l=plan_stats['levels'], e=requests, d=rounds, s=requests - plan_stats['requests']))
+
+                if args.pipeline:
+                    # Bins flow from split through merge into the download queue as soon as they're final.
+                    # Planning runs ahead of the downloads by at most one bin per download worker.
+                    rendered_bins = prefetch(merge(expanded_bins, maximum=args.max, target=target, anchors=anchors), maxsize=args.parallel)
+                else:
+                    expanded_bins = list(expanded_bins)
+
+                    server_log.log("Estimation over range {d}: {e} events in {b} bins took {r} requests ({h} answered by the plan cache)".format(
+                        d=datetime.fromtimestamp(callback._end / 1000) - datetime.fromtimestamp(callback._start / 1000),
+                        e=sum([x[2] for x in expanded_bins]),
+                        b=len(expanded_bins),
+                        r=callback.updates,
+                        h=plan_cache.hits if plan_cache is not None else 0,
+                    ))
+
+                    log_planner_savings()
+                    if args.packer == "greedy":
+                        rendered_bins = list(merge(expanded_bins, maximum=args.max))
+                    else:
+                        rendered_bins = list(pack(expanded_bins, maximum=args.max, concurrency=args.parallel if args.packer == "balanced" else 1))
+
+                    server_log.log("Repacked estimation over range {d}: {e} events in {b} bins, the largest holding {l}".format(
+                        d=datetime.fromtimestamp(callback._end / float(1000)) - datetime.fromtimestamp(callback._start / float(1000)),
+                        e=sum([x[2] for x in rendered_bins]),
+                        b=len(rendered_bins),
+                        l=max([x[2] for x in rendered_bins] or [0]),
+                    ))
 
         # Sanity check the proposed query plan
         # Bins are not evenly time-sized. Contiguous bins under the maximum value-size limit have been merged.
         # [-999-][--900--] [80]  [1]  [-5-] [-900---]
         def assert_only(bin):
             raise RuntimeError("BUG: Unsplit buckets still exceed maximum %d" % args.max)
-        list(split(rendered_bins, assert_only, maximum=args.max))
-
-        if len(rendered_bins) == 0:
-            parser.error("There appears to be no data in this query & time-range. Aborting.")
 
         # Sanity check output directory for filename collisions
-        PREFIX = "output."
-        expected_files = [PREFIX + "%s" % b[0] for b in rendered_bins]
-        extra_files = [f for f in os.listdir(args.output) if f.startswith(PREFIX) and f not in expected_files]
-        if extra_files:
+        PREFIX = OUTPUT_PREFIX
+
+        def extra_files_error(extra_files):
             parser.error(
                 "There are extra files in the output directory {output} which are not part of the desired output set {prefix}*. "
-                "Delete them or use a different output directory:\n{extra_files}".format(
+                "Delete them, use a different output directory, or the --layout they were written with:\n{extra_files}".format(
                     output=args.output,
                     prefix=PREFIX,
-                    extra_files=" ".join(extra_files)
+                    extra_files=" ".join(sorted(extra_files))
                 ))
 
+        # Relative paths, in either layout. Partial files are the exporter's own, left by interrupted downloads which will be resumed
+        existing_files = set(output_files(args.output))
+
+        if args.pipeline:
+            def checked_bins(bins):
+                """Apply the plan's sanity checks to each bin as it arrives, and grow the progress bar's total."""
+                unmatched = set(existing_files)
+
+                def start(f):
+                    s = os.path.basename(f)[len(PREFIX):].split('.')[0]  # output.<start>, or output.<start>.<partition>
+                    return int(s) if s.isdigit() else -1
+                by_start = sorted((start(f), f) for f in existing_files)
+                checked = 0
+                for b in bins:
+                    list(split([b], assert_only, maximum=args.max, paginate=paginate))
+                    unmatched.discard(bin_path(b, args.layout))
+                    # Bins arrive in time order, so an unmatched file that starts before this bin will never be matched.
+                    passed = []
+                    while checked < len(by_start) and by_start[checked][0] < b[0]:
+                        if by_start[checked][1] in unmatched:
+                            passed.append(by_start[checked][1])
+                        checked += 1
+                    if passed:
+                        extra_files_error(passed)
+                    iterable.total += 1  # the progress bar below, which consumes this generator
+                    yield b
+                if unmatched:
+                    extra_files_error(unmatched)
+
+            planned_bins = checked_bins(rendered_bins)
+            total = 0
+        else:
+            list(split(rendered_bins, assert_only, maximum=args.max, paginate=paginate))
+
+            if len(rendered_bins) == 0:
+                parser.error("There appears to be no data in this query & time-range. Aborting.")
+
+            if args.plan_only:
+                plan = Plan("https://{0}:{1}{2}".format(args.hostname, args.port, explorer_url), args.format, args.max, rendered_bins)
+                plan.save(args.plan_only)
+                plan_msg = "Wrote plan {f}: {e} events in {b} bins".format(f=args.plan_only, e=sum([x[2] for x in rendered_bins]), b=len(rendered_bins))
+                server_log.log(plan_msg)
+                parser.exit(status=0, message="%s\n" % plan_msg)
+
+            # Every shard expects the whole plan's files, so shards can share an output directory
+            extra_files = existing_files.difference(bin_path(b, args.layout) for b in rendered_bins)
+            if extra_files:
+                extra_files_error(extra_files)
+
+            planned_bins = rendered_bins
+            if args.shard is not None:
+                planned_bins = shard(rendered_bins, *args.shard)
+                server_log.log("Shard {s[0]}/{s[1]}: {e} events in {b} of the plan's {n} bins".format(
+                    s=args.shard, e=sum([x[2] for x in planned_bins]), b=len(planned_bins), n=len(rendered_bins)))
+            total = len(planned_bins)
+
         stats = collections.Counter()
+
+        if args.validate is not None:
+            # Files are parsed on separate processes, one file per task, so validation scales with cores instead of being held to one.
+            tasks = [(os.path.join(args.output, bin_path(b, args.layout)), b, args.format) for b in planned_bins]
+            with ProcessPoolExecutor(max_workers=args.validate) as validators:
+                # Batches of files save a round trip to a worker process each, where map() can: chunksize is new in Python 3.5
+                checked = validators.map(check_file, tasks, chunksize=8) if sys.version_info >= (3, 5) else validators.map(check_file, tasks)
+                with ProgressBar(checked,
+                                 total=total,
+                                 prelude="Validate",
+                                 suffix="files",
+                                 quiet=not logger.isEnabledFor(logging.WARNING),
+                                 log=logger.isEnabledFor(logging.INFO),
+                                 extra=stats) as iterable:
+                    for filename, error in iterable:
+                        if error is None:
+                            stats['valid'] += 1
+                        elif isinstance(error, FileNotFoundError):
+                            stats['missing'] += 1
+                            logger.info("Missing {0!r}".format(filename))
+                        else:
+                            stats['inconsistent'] += 1
+                            logger.warning(str(error))
+
+            validate_msg = "Validated {n} files: {s[valid]} valid, {s[inconsistent]} inconsistent, {s[missing]} missing".format(n=len(tasks), s=stats)
+            server_log.log(validate_msg)
+            parser.exit(status=65 if stats['inconsistent'] or stats['missing'] else 0, message="%s\n" % validate_msg)
+
+        scheduler = Scheduler(workers=args.parallel, limit=throttle.concurrency, hedge=args.hedge)
+        sync = SyncPolicy(args.fsync)
+        resources.callback(sync.close)
+        retrieve = ExportBinToFile.retrieve
+        leases = None
+        if args.cooperate:
+            # Each bin is downloaded by whichever process leases it first; bins leased by other processes are left until
+            # last, then either found finished or, if their lease lapsed, taken over.
+            running = collections.defaultdict(list)  # Bin name to the attempts at it under way: its download, and any hedge
+            running_lock = threading.Lock()
+
+            def abandon(name):
+                with running_lock:
+                    attempts = list(running.get(name, ()))
+                for export_file in attempts:
+                    export_file.cancel()
+
+            leases = Leases(args.output, expiry=args.lease_expiry, on_lost=abandon)
+            resources.callback(leases.close)
+            planned_bins = claim(planned_bins, leases, key=bin_filename, finished=lambda b: os.path.exists(os.path.join(args.output, bin_path(b, args.layout))))
+
+            def retrieve_leased(export_file):
+                name = bin_filename(export_file.bin)
+                with running_lock:
+                    running[name].append(export_file)
+                try:
+                    return export_file.retrieve()
+                except (Cancelled, LeaseLost):
+                    if name not in leases.lost:
+                        raise
+                    logger.warning("Abandoned {0}, another process has taken it over".format(name))
+                    export_file.discard_partial()  # Named for this process, so nobody else would resume it
+                    return None
+                finally:
+                    with running_lock:
+                        running[name].remove(export_file)
+                        last = not running[name]
+                        if last:
+                            del running[name]
+                    if last:  # A hedge may still be writing until then
+                        leases.release(name)
+
+            retrieve = retrieve_leased
+
+        export_files = (ExportBinToFile(root, bin=b, output_directory=args.output, output_format=args.format, connection=pool,
+                                        buffer_size=args.buffer_size, preallocate_per_event=args.preallocate, sync=sync,
+                                        manifest=manifest, revalidate=args.revalidate, throttle=throttle,
+                                        page_size=args.max if paginate else None, queries=queries if cancel_downloads else None, layout=args.layout,
+                                        leases=leases) for b in planned_bins)
         try:
-            with ProgressBar(rendered_bins,
+            with ProgressBar(scheduler.imap_unordered(retrieve, export_files, twin=ExportBinToFile.hedge, cancel=ExportBinToFile.cancel),
+                             total=total,
                              suffix="files",
                              quiet=not logger.isEnabledFor(logging.WARNING),
                              log=logger.isEnabledFor(logging.INFO),
                              extra=stats) as iterable:
-                for b in iterable:
-                    export_file = ExportBinToFile(root, bin=b, output_directory=args.output, output_format=args.format, connection=ui)
-
-                    try:
-                        if export_file.valid:  # raises exceptions FileNotFoundError, InconsistentFile
-                            export_file.logger.info("Already been retrieved, skipping.")
-                            stats['skipped'] += 1
-                            continue
-                    except FileNotFoundError:
-                        pass  # download this
-
-                    downloaded_bytes = export_file.download()
-                    stats['bytes'] += downloaded_bytes
-                    export_file.logger.info("Wrote {bytes} bytes in {duration}".format(bytes=downloaded_bytes, duration=iterable.duration))
-
-                    try:
-                        if not export_file.valid:  # raises exceptions FileNotFoundError, InconsistentFile
-                            raise InconsistentFile("Wrote inconsistent output file {f!r}.".format(f=export_file.filename))
-                    except InconsistentFile:
-                        raise
+                # Each bin is skipped-if-valid, downloaded and validated on a worker; tally results here, on a single thread.
+                for export_file, downloaded_bytes in iterable:
+                    if downloaded_bytes is None:
+                        stats['skipped'] += 1
+                    else:
+                        stats['bytes'] += downloaded_bytes
+                        if sizer is not None:
+                            sizer.observe(export_file.bin[2], os.path.getsize(export_file.filename), export_file.duration)
 
             # end with
         except InconsistentFile as e:
@@ -313,8 +708,28 @@ def main():
         except FileExistsError as e:
             parser.exit(status=74, message="Refusing to overwrite existing unparsable file {f!r}. Delete it and retry, or report a bug.\n".format(f=e.filename))
 
+        if args.pipeline:
+            if iterable.total == 0:
+                parser.error("There appears to be no data in this query & time-range. Aborting.")
+
+            server_log.log("Pipelined estimation over range {d}: {b} bins took {r} requests ({h} answered by the plan cache)".format(
+                d=datetime.fromtimestamp(callback._end / float(1000)) - datetime.fromtimestamp(callback._start / float(1000)),
+                b=iterable.total,
+                r=callback.updates,
+                h=plan_cache.hits if plan_cache is not None else 0,
+            ))
+            log_planner_savings()
+
+    if throttle.concurrency is not None:
+        logger.info("Adaptive concurrency finished at {0}".format(throttle.concurrency))
+    if sizer is not None:
+        logger.info("Bin sizing finished at {0}".format(sizer))
+    if pool is not ui:
+        logger.info("Spread requests over sessions: {0}".format(pool))
+    if queries is not None and queries.cancelled:
+        logger.info("Cancelled {0} queries the export no longer needed".format(queries.cancelled))
     success_msg = "Complete export: {i.current} bins downloaded {s[bytes]} bytes in {i.duration} ({s[skipped]} already present)".format(s=stats, i=overall_progress)
-    ui.log(success_msg)
+    server_log.log(success_msg)
     if logger.isEnabledFor(logging.WARNING) and not logger.isEnabledFor(logging.INFO):
         parser.exit(status=0, message="%s\n" % success_msg)
 
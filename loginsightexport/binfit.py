@@ -4,6 +4,8 @@
 Given a set of time ranges as aggregate counts, produce a best-fit set of windows.
 """
 
+import bisect
+import collections
 import logging
 from itertools import tee
 
@@ -64,15 +66,35 @@ def contiguous(bins):
     return True
 
 
-def merge(bins, maximum=20000):
-    """Merge two adjacent bins, such that the total coverage is the same before and after."""
+def partitioned(bin):
+    """True for a bin restricted to one value of a field: (start, end, quantity, (field, value)). Such bins can't be merged."""
+    return len(bin) > 3 and bin[3] is not None
+
+
+def mergeable(a, b):
+    return contiguous([a, b]) and not partitioned(a) and not partitioned(b)
+
+
+def merge(bins, maximum=20000, target=None, anchors=None):
+    """
+    Merge two adjacent bins, such that the total coverage is the same before and after.
+    target, if given, is called with each prospective combined bin for the preferred quantity of events, no more than
+    maximum, so bins can be sized by what's been learned while earlier ones were downloading.
+    anchors, if given, maps the start of each range that should come out as a single bin, as it did in an earlier run,
+    to its end. Bins are combined to reproduce such a range regardless of target, though never beyond maximum.
+    """
     # This is an optional optimization. It would be premature to implement this early.
+    anchors = anchors or {}
     i = iter(bins)
-    prev = next(i)
+    prev = next(i, None)
+    if prev is None:
+        return
     for nb in i:
-        if contiguous([prev, nb]) and nb[2] + prev[2] <= maximum:
+        combined = (prev[0], nb[1], prev[2] + nb[2])
+        anchored = anchors.get(prev[0], prev[0]) > prev[1]  # prev is the beginning of a range from an earlier run
+        limit = maximum if anchored or target is None else min(maximum, target(combined))
+        if mergeable(prev, nb) and combined[2] <= limit and (not anchored or nb[1] <= anchors[prev[0]]):
             # Combine adjacent items
-            combined = (prev[0], nb[1], prev[2] + nb[2])
             logger.debug("Combined {0} + {1} to new bin {2}".format(prev, nb, combined))
             prev = combined
             continue
@@ -84,6 +106,52 @@ def merge(bins, maximum=20000):
         yield prev
 
 
+def _groups(bins, limit):
+    """Greedily cut bins into runs of contiguous bins, each totalling no more than limit unless it's a single bin."""
+    group = []
+    total = 0
+    for b in bins:
+        if group and (not mergeable(group[-1], b) or total + b[2] > limit):
+            yield group
+            group, total = [], 0
+        group.append(b)
+        total += b[2]
+    if group:
+        yield group
+
+
+def pack(bins, maximum=20000, concurrency=1):
+    """
+    Merge adjacent bins like merge(), into the same minimum number of bins, but make the largest of them as small as
+    possible, so parallel downloads are of even size and none straggles behind the rest.
+    Cutting greedily wherever the next bin wouldn't fit under a limit gives the fewest groups for that limit, so search
+    for the smallest limit that doesn't need more groups than merge() makes at the maximum.
+    With concurrency > 1, round the quantity of bins up to a multiple of it, where there are enough bins to divide,
+    so every round of downloads keeps all workers busy.
+    Unlike merge(), this reads all of bins before yielding anything.
+    """
+    bins = list(bins)
+    if not bins:
+        return
+    target = sum(1 for _ in _groups(bins, maximum))
+    target = min(len(bins), -(-target // concurrency) * concurrency)
+
+    low = max([b[2] for b in bins if b[2] <= maximum] or [0])  # No limit below the largest bin can leave it whole
+    high = maximum
+    while low < high:
+        middle = (low + high) // 2
+        if sum(1 for _ in _groups(bins, middle)) <= target:
+            high = middle
+        else:
+            low = middle + 1
+    logger.debug("Packing {0} bins into {1} groups of at most {2} events".format(len(bins), target, low))
+
+    for group in _groups(bins, low):
+        combined = group[0] if len(group) == 1 else (group[0][0], group[-1][1], sum(b[2] for b in group))
+        logger.debug("-------- {0}".format(combined))
+        yield combined
+
+
 def patch_bins_at_boundaries(boundary_bin, bins):
     """
     A query response produces a list of bins.
@@ -113,20 +181,216 @@ def patch_bins_at_boundaries(boundary_bin, bins):
             yield b
 
 
-def split(bins, fetch_subset_fn, maximum=20000):
+def split(bins, fetch_subset_fn, maximum=20000, paginate=False, target=None):
+    """
+    Query each bin larger than maximum for its subdivisions, recursively, until all fit.
+    With paginate=True, a 0ms bin can't be subdivided but is left oversized, for its events to be exported in pages.
+    target, if given, is called with each bin for a preferred quantity of events; bins under maximum but over target are
+    subdivided where the server can, and otherwise left as they are.
+    """
     for b in bins:
-        if b[2] > maximum:
+        too_large = b[2] > maximum or (target is not None and b[0] < b[1] and b[2] > target(b))
+        if b[2] > maximum and paginate and b[0] == b[1]:
+            logger.debug("This bin {0} is 0ms long, export it in pages".format(b))
+            yield b
+        elif too_large:
             logger.debug("This bin %s is larger than the maximum, split it apart" % str(b))
             newbins = fetch_subset_fn(b)
+            if [b] == newbins and b[2] <= maximum:
+                yield b  # Only larger than the target; good enough
+                continue
             if [b] == newbins:
                 if b[0] == b[1]:
                     raise IndivisibleBin("This bin {b} is 0ms long, so the server won't subdivide it any further, but there's more than {max} items in it. Use a larger --max".format(b=b, max=maximum))
                 raise IndivisibleBin("The server won't subdivide the bin {b} any further, but there's more than {max} items in it. Please report this as a bug.".format(b=b, max=maximum))
             count_in_new_bins = 0
-            for newbin in split(newbins, fetch_subset_fn, maximum):
+            for newbin in split(newbins, fetch_subset_fn, maximum, paginate, target):
                 yield newbin
                 count_in_new_bins += newbin[2]
             if count_in_new_bins != b[2]:
                 raise IndivisibleBin("The server expanded bin {b} to contain {i} items".format(b=b, i=count_in_new_bins))
         else:
             yield b
+
+
+def anchored_target(target, anchors):
+    """
+    A target for split() and merge() which also subdivides any bin straddling the edge of one of the anchors' ranges, so
+    that merge() can reassemble them. Splitting the same ranges again retraces the earlier run's divisions.
+    """
+    edges = sorted(set(anchors) | set(end + 1 for end in anchors.values()))
+
+    def preferred(b):
+        i = bisect.bisect_right(edges, b[0])
+        if i < len(edges) and edges[i] <= b[1]:
+            return 0
+        return target(b)
+    return preferred
+
+
+def split_by_level(bins, fetch_subset_fn, maximum=20000, map_fn=map, paginate=False):
+    """
+    Produce the same bins as split(), in the same order, but expand every oversized bin at each depth of the tree together.
+    The expansions of a level are issued through map_fn; pass a bounded pool's map to query the server concurrently.
+    Bins ahead of the first oversized bin are final, and are yielded before the next level is fetched. paginate is as for split().
+    """
+    def final(b):
+        return b[2] <= maximum or (paginate and b[0] == b[1])
+
+    level = list(bins)
+    while level:
+        finished = 0
+        while finished < len(level) and final(level[finished]):
+            yield level[finished]
+            finished += 1
+        level = level[finished:]
+        if not level:
+            return
+
+        oversized = [b for b in level if not final(b)]
+        logger.debug("Splitting {0} bins larger than the maximum at this level".format(len(oversized)))
+        expansions = iter(list(map_fn(fetch_subset_fn, oversized)))
+
+        next_level = []
+        for b in level:
+            if final(b):
+                next_level.append(b)
+                continue
+            newbins = next(expansions)
+            if [b] == newbins:
+                if b[0] == b[1]:
+                    raise IndivisibleBin("This bin {b} is 0ms long, so the server won't subdivide it any further, but there's more than {max} items in it. Use a larger --max".format(b=b, max=maximum))
+                raise IndivisibleBin("The server won't subdivide the bin {b} any further, but there's more than {max} items in it. Please report this as a bug.".format(b=b, max=maximum))
+            count_in_new_bins = sum(newbin[2] for newbin in newbins)
+            if count_in_new_bins != b[2]:
+                raise IndivisibleBin("The server expanded bin {b} to contain {i} items".format(b=b, i=count_in_new_bins))
+            next_level.extend(newbins)
+        level = next_level
+
+
+def partition(bins, fetch_groups_fn, field, maximum=20000, paginate=False):
+    """
+    Divide each 0ms bin larger than maximum, which time can't split any further, by the values of a field.
+    fetch_groups_fn(bin, field) returns [(value, quantity), ...] for the bin; each value becomes a bin of its own,
+    (start, end, quantity, (field, value)), which can be exported separately and in parallel with its siblings.
+    The partitions must account for every event of the bin. If they don't, because some events lack the field, the bin is
+    left whole to be exported in pages, or with paginate=False, raises IndivisibleBin.
+    """
+    for b in bins:
+        if b[2] <= maximum or b[0] != b[1] or partitioned(b):
+            yield b
+            continue
+        groups = [(value, quantity) for value, quantity in fetch_groups_fn(b, field) if quantity]
+        count_in_partitions = sum(quantity for _, quantity in groups)
+        if count_in_partitions != b[2]:
+            message = "Partitioning the bin {b} by {f} accounts for {i} of its {b[2]} items".format(b=b, f=field, i=count_in_partitions)
+            if not paginate:
+                raise IndivisibleBin(message + ". Use a larger --max")
+            logger.warning(message + "; exporting it in pages instead")
+            yield b
+            continue
+        logger.debug("Partitioned {0} by {1} into {2} values".format(b, field, len(groups)))
+        for value, quantity in sorted(groups, key=lambda g: str(g[0])):
+            if quantity > maximum and not paginate:
+                raise IndivisibleBin("The {f}={v!r} partition of the bin {b} has {q} items, more than {max}. Use a larger --max".format(
+                    f=field, v=value, b=b, q=quantity, max=maximum))
+            yield (b[0], b[1], quantity, (field, value))
+
+
+def windows(bin, quantity):
+    """Divide a bin's time range into `quantity` contiguous windows of nearly equal width. Counts are left at 0."""
+    start, end = bin[0], bin[1]
+    quantity = max(1, min(quantity, end - start + 1))  # Windows are at least 1ms wide
+    edges = [start + (end - start + 1) * i // quantity for i in range(quantity)] + [end + 1]
+    return [(a, b - 1, 0) for a, b in zip(edges, edges[1:])]
+
+
+def split_by_density(bins, fetch_subset_fn, maximum=20000, map_fn=map, buckets_per_request=4, stats=None, paginate=False):
+    """
+    Produce bins no larger than maximum, like split(), in fewer round trips to the server.
+    A chart request returns about buckets_per_request buckets, whatever the width of its time range. Rather than
+    re-querying an oversized bin once and recursing into each oversized bucket of the response, divide the bin into
+    enough windows that, were its events spread evenly, every bucket returned for every window would fit. All windows of
+    a level are fetched together through map_fn; only buckets that are still oversized, where events are bursty,
+    are divided again at the next level. The estimate of buckets per request follows the median size of responses.
+    paginate is as for split(). If given, the stats Counter is incremented with the 'requests' and 'levels' used, and given the final 'buckets_per_request'.
+    """
+    stats = stats if stats is not None else collections.Counter()
+    response_sizes = []
+
+    def final(b):
+        return b[2] <= maximum or (paginate and b[0] == b[1])
+
+    level = list(bins)
+    while level:
+        finished = 0
+        while finished < len(level) and final(level[finished]):
+            yield level[finished]
+            finished += 1
+        level = level[finished:]
+        if not level:
+            return
+
+        plan = []  # For each bin of this level, the windows it's divided into, or None if it's final
+        for b in level:
+            if final(b):
+                plan.append(None)
+                continue
+            if b[0] == b[1]:
+                raise IndivisibleBin("This bin {b} is 0ms long, so the server won't subdivide it any further, but there's more than {max} items in it. Use a larger --max".format(b=b, max=maximum))
+            plan.append(windows(b, -(-b[2] // (maximum * buckets_per_request))))  # ceil(count / events per request)
+        requests = [w for p in plan if p is not None for w in p]
+        logger.debug("Fetching {0} windows for {1} oversized bins at this level".format(len(requests), sum(1 for p in plan if p is not None)))
+        expansions = iter(list(map_fn(fetch_subset_fn, requests)))
+        stats['requests'] += len(requests)
+        stats['levels'] += 1
+
+        next_level = []
+        for b, p in zip(level, plan):
+            if p is None:
+                next_level.append(b)
+                continue
+            newbins = []
+            for w in p:
+                response = next(expansions)
+                bisect.insort(response_sizes, len(response))
+                newbins.extend(response)
+            buckets_per_request = max(2, response_sizes[len(response_sizes) // 2])
+            stats['buckets_per_request'] = buckets_per_request
+            if [b] == newbins:
+                raise IndivisibleBin("The server won't subdivide the bin {b} any further, but there's more than {max} items in it. Please report this as a bug.".format(b=b, max=maximum))
+            count_in_new_bins = sum(newbin[2] for newbin in newbins)
+            if count_in_new_bins != b[2]:
+                raise IndivisibleBin("The server expanded bin {b} to contain {i} items".format(b=b, i=count_in_new_bins))
+            next_level.extend(newbins)
+        level = next_level
+
+
+def estimate_split_requests(bins, histogram, maximum=20000, buckets_per_request=4):
+    """
+    Estimate how many chart requests split() would have made to divide bins, and in how many rounds, given the final
+    histogram of the range. Each oversized range costs one request, which is modelled as returning buckets_per_request
+    equal-width buckets. Events are assumed to be spread evenly within each bin of the histogram.
+    Returns (requests, rounds).
+    """
+    histogram = sorted_by_startTimeMillis(histogram)
+    starts = [h[0] for h in histogram]
+
+    def count(start, end):
+        total = 0.0
+        for h in histogram[max(0, bisect.bisect_right(starts, start) - 1):bisect.bisect_right(starts, end)]:
+            overlap = min(end, h[1]) - max(start, h[0]) + 1
+            if overlap > 0:
+                total += h[2] * overlap / float(h[1] - h[0] + 1)
+        return total
+
+    requests = 0
+    rounds = 0
+    level = [(b[0], b[1], b[2]) for b in bins]
+    while True:
+        oversized = [b for b in level if round(b[2]) > maximum and b[0] < b[1]]
+        if not oversized:
+            return requests, rounds
+        requests += len(oversized)
+        rounds += 1
+        level = [(w[0], w[1], count(w[0], w[1])) for b in oversized for w in windows(b, buckets_per_request)]
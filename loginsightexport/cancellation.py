@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Keep track of the queries running on the server on this exporter's behalf, so that one which is no longer wanted, because
+the export was aborted, its request timed out, a retry superseded it or a hedged copy finished first, can be cancelled
+instead of running to completion on a Log Insight node.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+from loginsightexport.sessionpool import SessionPool
+from loginsightexport.uidriver import query
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def untracked():
+    """OutstandingQueries.track()'s stand-in when cancellation is off: the query runs without a cancel token."""
+    yield None
+
+
+class OutstandingQueries(object):
+    """
+    Cancel tokens, from /logcancel, of the queries in flight. Cancellation is best effort: when the server won't issue a
+    token, queries run without them for retry_after seconds, twice as long after each failure in a row up to
+    maximum_retry_after, and a failure to cancel is logged and ignored.
+    connection may be a SessionPool; a token is then cancelled through the session it was issued to.
+    """
+
+    def __init__(self, connection, retry_after=5.0, maximum_retry_after=300.0, clock=time.monotonic):
+        self.connection = connection
+        self.retry_after = retry_after
+        self.maximum_retry_after = maximum_retry_after
+        self.cancelled = 0  # Queries the server confirmed it cancelled
+        self._tokens = {}  # Token: the connection it was issued through
+        self._failures = 0  # To get a token, in a row
+        self._retry_at = None  # While the clock is before this, queries go without tokens
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def token(self):
+        """A new cancel token, registered as outstanding, or None if the server isn't issuing them at the moment."""
+        with self._lock:
+            if self._retry_at is not None and self._clock() < self._retry_at:
+                return None
+        connection = self.connection.current() if isinstance(self.connection, SessionPool) else self.connection
+        try:
+            token = query(connection, '/logcancel').generateToken()
+        except Exception as e:
+            with self._lock:
+                self._failures += 1
+                wait = min(self.maximum_retry_after, self.retry_after * 2 ** (self._failures - 1))
+                self._retry_at = self._clock() + wait
+                first = self._failures == 1
+            (logger.warning if first else logger.info)(
+                "Couldn't get a cancel token, queries won't be cancelled on the server for {0}s: {1}".format(wait, e))
+            return None
+        with self._lock:
+            if self._failures:
+                logger.info("Getting cancel tokens again after {0} failures".format(self._failures))
+            self._failures = 0
+            self._retry_at = None
+            self._tokens[token] = connection
+        return token
+
+    def finished(self, token):
+        """The query has completed, so there's nothing left to cancel."""
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def cancel(self, token):
+        """Cancel an outstanding query. Returns True if the server confirmed it."""
+        with self._lock:
+            connection = self._tokens.pop(token, None)
+        if connection is None:
+            return False  # Already finished or cancelled
+        try:
+            succeeded = query(connection, '/logcancel').cancel(token)
+        except Exception as e:
+            logger.info("Couldn't cancel query {0}: {1}".format(token, e))
+            return False
+        if succeeded:
+            with self._lock:
+                self.cancelled += 1
+        return succeeded
+
+    def cancel_all(self):
+        """Cancel every outstanding query, such as on the way out of an aborted export."""
+        with self._lock:
+            tokens = list(self._tokens)
+        if tokens:
+            logger.info("Cancelling {0} outstanding queries".format(len(tokens)))
+        for token in tokens:
+            self.cancel(token)
+
+    @contextlib.contextmanager
+    def track(self):
+        """
+        Context manager giving a cancel token, or None, for one query. The query is cancelled if the block raises. With a
+        SessionPool, the block's requests go to the session which issued the token.
+        """
+        with contextlib.ExitStack() as stack:
+            if isinstance(self.connection, SessionPool):
+                stack.enter_context(self.connection.pinned())
+            token = self.token()
+            try:
+                yield token
+            except BaseException:
+                if token is not None:
+                    self.cancel(token)
+                raise
+            self.finished(token)
+
+    def __repr__(self):
+        return '{cls}(outstanding={n!r}, cancelled={x.cancelled!r})'.format(cls=self.__class__.__name__, n=len(self._tokens), x=self)
@@ -1,8 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import copy
+import datetime
+import errno
+import hashlib
 import json
 import logging
+import mmap
 import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.packages.urllib3.exceptions import HTTPError as TransportError
+
+from loginsightexport.cancellation import untracked
+from loginsightexport.jsonstream import ExportDocumentReader
+from loginsightexport.manifest import file_digest
+from loginsightexport.throttle import Throttle
 
 # Copyright © 2017 VMware, Inc. All Rights Reserved.
 #
@@ -16,6 +35,24 @@ import os
 # specific language governing permissions and limitations under the License.
 
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 64 * 1024  # Per read from the socket, and overridden by --buffer-size
+PARTIAL_SUFFIX = ".partial"  # Downloads are written here, and renamed into place only once complete
+HEDGE_SUFFIX = ".hedge"  # A second copy of a straggling download is written to <partial file, less .partial>.hedge.partial
+OUTPUT_PREFIX = "output."
+FLAT, HOURLY = LAYOUTS = ("flat", "hourly")  # Output files go straight into the output directory, or into YYYY/MM/DD/HH under it
+
+# A download that fails with one of these has been cut off, and is worth resuming
+INTERRUPTED = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout, TransportError)
+
+ResumePoint = namedtuple("ResumePoint", field_names=["offset", "events", "timestamp", "complete"])
+
+
+class Cancelled(RuntimeError):
+    """A download was abandoned part way, because another copy of it finished first or the export is being stopped."""
+
+
 class InconsistentFile(OSError):
     """A file whose size is not consistent with expectations, or which is not parsable."""
     def __bool__(self):
@@ -25,56 +62,521 @@ class InconsistentFile(OSError):
         return "{0} {s.filename!r}: {s.strerror}".format(self.__class__.__name__, s=self)
 
 
+class SyncPolicy(object):
+    """
+    Decide when downloaded files are flushed to stable storage.
+     - none: leave it to the operating system
+     - file: fsync each file as it's completed
+     - batch: sync the filesystem once every batch_size completed files, and at close()
+    """
+    MODES = ('none', 'file', 'batch')
+
+    def __init__(self, mode='none', batch_size=64):
+        if mode not in self.MODES:
+            raise ValueError("Unknown sync mode {0!r}, expected one of {1}".format(mode, self.MODES))
+        if mode == 'batch' and not hasattr(os, 'sync'):
+            logger.info("This platform can't sync the filesystem in batches, syncing each file instead.")
+            mode = 'file'
+        self.mode = mode
+        self.batch_size = batch_size
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def completed(self, f):
+        """Called with an open file once its last byte has been written."""
+        if self.mode == 'file':
+            f.flush()
+            os.fsync(f.fileno())
+        elif self.mode == 'batch':
+            with self._lock:
+                self._unsynced += 1
+                due = self._unsynced >= self.batch_size
+                if due:
+                    self._unsynced = 0
+            if due:
+                os.sync()
+
+    def close(self):
+        if self.mode == 'batch' and self._unsynced:
+            self._unsynced = 0
+            os.sync()
+
+    def __repr__(self):
+        return '{cls}(mode={x.mode!r}, batch_size={x.batch_size!r})'.format(cls=self.__class__.__name__, x=self)
+
+
+def preallocate(f, size):
+    """Reserve disk space for a file that's about to be written, where the platform and filesystem allow it."""
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise
+        return False
+    return True
+
+
+def copy_response(response, f, buffer_size=DEFAULT_BUFFER_SIZE, digest=None, throttle=None, cancelled=None):
+    """
+    Copy a streamed response body into a file through a single reused buffer. Returns the quantity of bytes written.
+    If a hashlib digest is given, it's updated with every byte on the way through. A throttle may cap the transfer rate.
+    Once the cancelled Event, if any, is set, raises Cancelled at the next buffer.
+    """
+    raw = response.raw
+    if not hasattr(raw, 'readinto'):
+        written = 0
+        for chunk in response.iter_content(chunk_size=buffer_size):
+            if cancelled is not None and cancelled.is_set():
+                raise Cancelled()
+            written += len(chunk)
+            f.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            if throttle is not None:
+                throttle.transferred(len(chunk))
+        return written
+
+    raw.decode_content = True  # Undo any Content-Encoding, as iter_content would
+    view = memoryview(bytearray(buffer_size))
+    written = 0
+    while True:
+        if cancelled is not None and cancelled.is_set():
+            raise Cancelled()
+        n = raw.readinto(view)
+        if not n:
+            break
+        f.write(view[:n])
+        if digest is not None:
+            digest.update(view[:n])
+        if throttle is not None:
+            throttle.transferred(n)
+        written += n
+    return written
+
+
+def bin_filename(bin):
+    """
+    The name of a bin's output file: output.<start>, or for one partition of a bin restricted to a field's value,
+    output.<start>.<digest of the field and value>, distinct from its siblings'.
+    """
+    if len(bin) > 3 and bin[3] is not None:
+        return "{0}{1}.{2}".format(OUTPUT_PREFIX, bin[0], hashlib.sha1(json.dumps(list(bin[3])).encode('utf-8')).hexdigest()[:12])
+    return "{0}{1}".format(OUTPUT_PREFIX, bin[0])
+
+
+def bin_path(bin, layout=FLAT):
+    """
+    Where a bin's output file goes, relative to the output directory: directly in it (flat), or in a YYYY/MM/DD/HH
+    subdirectory for the UTC hour the bin starts in (hourly), so that no single directory holds every file.
+    """
+    if layout == FLAT:
+        return bin_filename(bin)
+    hour = datetime.datetime.utcfromtimestamp(bin[0] / 1000.0)
+    return os.path.join(hour.strftime("%Y"), hour.strftime("%m"), hour.strftime("%d"), hour.strftime("%H"), bin_filename(bin))
+
+
+def output_files(directory):
+    """
+    Yield the path, relative to directory, of every complete output file in it, in either layout. Only subdirectories
+    named with digits, like the hourly layout's, are searched.
+    """
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        for name in os.listdir(os.path.join(directory, relative)):  # Not os.scandir(), which is new in Python 3.5
+            path = os.path.join(directory, relative, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                if name.isdigit():
+                    pending.append(os.path.join(relative, name))
+            elif name.startswith(OUTPUT_PREFIX) and not name.endswith(PARTIAL_SUFFIX):
+                yield os.path.join(relative, name)
+
+
+def copy_range(src, dst, length, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Copy length bytes from the current position of src to dst."""
+    while length > 0:
+        block = src.read(min(buffer_size, length))
+        if not block:
+            raise EOFError("Expected {0} more bytes".format(length))
+        dst.write(block)
+        length -= len(block)
+
+
+def publish(partial, filename):
+    """Atomically move a completed partial file into place. Like open(filename, 'x'), refuses to replace an existing file."""
+    try:
+        os.link(partial, filename)  # Raises FileExistsError rather than replacing
+    except FileExistsError:
+        raise
+    except (AttributeError, OSError) as e:
+        # No hard links on this platform or filesystem; a plain rename is still atomic, but only checks for an existing file first
+        logger.debug("Can't link {0!r}, renaming instead: {1}".format(partial, e))
+        if os.path.exists(filename):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), filename)
+        os.rename(partial, filename)
+    else:
+        os.unlink(partial)
+
+
+def find_resume_point(filename, bin, descending=True):
+    """
+    Scan a partially written JSON export of bin for the events that are safe to keep.
+    Events sharing the last timestamp written are not, as more events with that timestamp may not have been written yet.
+    Returns a ResumePoint: the byte offset just past the last kept event, the quantity of events kept, and the timestamp to
+    resume from; with complete=True if the whole document was written. Returns None if nothing can be kept.
+    """
+    header = {}
+    events = 0
+    timestamp = None
+    last_end = None
+    boundary = (None, 0)  # The offset and count of events just before the run of events sharing the current timestamp
+    try:
+        with open(filename, 'rb') as f:
+            for kind, key, value, start, end in ExportDocumentReader(f, offsets=True):
+                if kind == 'value':
+                    header[key] = value
+                    continue
+                if kind != 'message':
+                    continue
+                if events == 0 and (header.get('to') != bin[2] or header.get('hasMoreResults') is not False):
+                    logger.info("{0!r} was written for a different bin than {1}".format(filename, bin))
+                    return None
+                t = value.get('timestamp') if isinstance(value, dict) else None
+                if not isinstance(t, int):
+                    return None
+                if t != timestamp:
+                    if timestamp is not None and (t > timestamp) == descending:
+                        logger.info("{0!r} is not sorted by timestamp".format(filename))
+                        return None
+                    boundary = (last_end, events)
+                    timestamp = t
+                events += 1
+                last_end = end
+    except ValueError:
+        offset, kept = boundary
+        if not kept:
+            return None
+        return ResumePoint(offset=offset, events=kept, timestamp=timestamp, complete=False)
+
+    if header.get('to') != bin[2]:
+        return None
+    return ResumePoint(offset=os.path.getsize(filename), events=events, timestamp=None, complete=True)
+
+
+def count_lines(filename, block_size=1024 * 1024):
+    """Count lines as iterating over the file would, including a final line without a newline, by scanning a memory map."""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0  # mmap refuses empty files
+        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+            lines = sum(m[offset:offset + block_size].count(b'\n') for offset in range(0, size, block_size))
+            if m[size - 1:size] != b'\n':
+                lines += 1
+    return lines
+
+
+def validate(filename, bin, output_format):
+    """
+    Check an output file against the bin it was exported for, in constant memory.
+    Raises FileNotFoundError, or InconsistentFile describing the first problem found.
+    """
+    if output_format == 'JSON':
+        values = {}
+        found_messages = None
+        try:
+            with open(filename, 'rb') as f:
+                for kind, key, value, _, _ in ExportDocumentReader(f):
+                    if kind == 'value':
+                        values[key] = value
+                    elif kind == 'messages':
+                        found_messages = value
+        except ValueError:  # Also covers undecodable UTF-8
+            raise InconsistentFile(0, "Not valid JSON; size {0}".format(os.path.getsize(filename)), filename)
+        try:
+            if bin[2] != values['to']:
+                raise InconsistentFile(0, "Incorrect quantity of events, found {body[to]}".format(body=values), filename)
+            if values['hasMoreResults']:
+                raise InconsistentFile(0, "Contains hasMoreResults=True, should be False", filename)
+        except KeyError as e:
+            raise InconsistentFile(0, "Missing required key {0} (possible bug Ref: 1583205)".format(e), filename)
+        expected_messages = values['to'] - values.get('from', 1) + 1 if values['to'] else 0
+        if found_messages is not None and found_messages != expected_messages:
+            raise InconsistentFile(0, "Incorrect quantity of messages, found {0}".format(found_messages), filename)
+    elif output_format == 'RAW':
+        # TODO: Find a reasonable way to check file validity. Note that multi-line messages are present.
+        if bin[2] > count_lines(filename):
+            raise InconsistentFile(0, "Incorrect quantity of events, should be {b[2]}".format(b=bin), filename)
+    else:
+        raise ValueError("Unknown output format {0}".format(output_format))
+
+
+def check_file(task):
+    """
+    validate() for a process pool: takes a (filename, bin, output_format) tuple, and returns (filename, None) for
+    a valid file or (filename, exception) for a missing or inconsistent one.
+    """
+    filename, bin, output_format = task
+    try:
+        validate(filename, bin, output_format)
+    except (FileNotFoundError, InconsistentFile) as e:
+        return filename, e
+    return filename, None
+
+
 class ExportBinToFile(object):
-    def __init__(self, root_query, bin, output_directory, output_format, connection):
+    def __init__(self, root_query, bin, output_directory, output_format, connection, buffer_size=DEFAULT_BUFFER_SIZE, preallocate_per_event=0, sync=None,
+                 manifest=None, revalidate=False, attempts=3, throttle=None, page_size=None, queries=None, layout=FLAT, leases=None):
         self.root_query = root_query
         self.bin = bin
-        self.filename = os.path.join(output_directory, "output.%s" % bin[0])
+        self.filename = os.path.join(output_directory, bin_path(bin, layout))
+        self.constraints = [bin[3]] if len(bin) > 3 and bin[3] is not None else []  # (field, value) of a partitioned bin
+        self.leases = leases  # A lease.Leases shared with other processes, which the bin's lease must be held in to publish it
+        # With other processes sharing the directory, one which has lost a bin's lease may still be writing it; keep out of its way
+        self.partial_filename = self.filename + ("." + leases.tag if leases is not None else "") + PARTIAL_SUFFIX
         self.logger = logging.getLogger(self.__class__.__name__).getChild("time[{b[0]}-{b[1]}].events[{b[2]}].file[{filename!r}]".format(b=bin, filename=self.filename))
         self.connection = connection
         self.output_format = output_format
-        self.body = None
+        self.buffer_size = buffer_size
+        self.preallocate_per_event = preallocate_per_event  # Estimated bytes per event, or 0 to not preallocate
+        self.sync = sync or SyncPolicy()
+        self.manifest = manifest
+        self.revalidate = revalidate  # Re-parse existing files even if the manifest vouches for them
+        self.attempts = attempts  # Times to try a download, resuming after each interruption
+        self.throttle = throttle or Throttle()
+        self.page_size = page_size  # Export a JSON bin of more events than this in pages of this many, or None for all at once
+        self.sha256 = None
+        self.duration = None  # Seconds the download took
+        self.queries = queries  # A cancellation.OutstandingQueries, to tag each request with a cancel token
+        self.cancel_token = None  # The token of the request in flight
+        self.cancelled = threading.Event()
+        self.racing = False  # Another copy of this bin is being downloaded too, see hedge()
 
     @property
     def valid(self):
         try:
-            with open(self.filename, 'r') as f:
-                if self.output_format == 'JSON':
-                    try:
-                        self.body = json.load(f)
-                    except ValueError:
-                        raise InconsistentFile(0, "Not valid JSON; size {0}".format(os.path.getsize(self.filename)), self.filename)
-                    try:
-                        if self.bin[2] != self.body['to']:
-                            raise InconsistentFile(0, "Incorrect quantity of events, found {body[to]}".format(body=self.body), self.filename)
-                        if self.body['hasMoreResults']:
-                            raise InconsistentFile(0, "Contains hasMoreResults=True, should be False".format(self.bin), self.filename)
-                    except KeyError as e:
-                        raise InconsistentFile(0, "Missing required key {0} (possible bug Ref: 1583205)".format(e), self.filename)
-                elif self.output_format == 'RAW':
-                    pass
-                    # TODO: Find a reasonable way to check file validity. Note that multi-line messages are present.
-                    found_quantity = sum(1 for line in open(self.filename, 'rb'))
-                    if self.bin[2] > found_quantity:
-                        raise InconsistentFile(0, "Incorrect quantity of events, should be {b[2]}".format(b=self.bin), self.filename)
-                else:
-                    raise ValueError("Unknown output format {0}".format(self.output_format))
+            validate(self.filename, self.bin, self.output_format)
         except InconsistentFile as e:
             self.logger.info(e)
             raise
-        except FileNotFoundError:
-            raise
         return True
 
+    def retrieve(self):
+        """Download this bin unless a valid copy already exists. Returns the quantity of bytes written, or None if skipped."""
+        if self.manifest is not None and not self.revalidate and self.manifest.matches(self.filename, self.bin):
+            self.logger.info("Already been retrieved according to the manifest, skipping.")
+            return None
+
+        try:
+            if self.valid:  # raises exceptions FileNotFoundError, InconsistentFile
+                self.logger.info("Already been retrieved, skipping.")
+                if self.manifest is not None and not self.manifest.matches(self.filename, self.bin):
+                    self.manifest.record(self.filename, self.bin, os.path.getsize(self.filename), file_digest(self.filename))
+                return None
+        except FileNotFoundError:
+            pass  # download this
+
+        started_at = time.monotonic()
+        downloaded_bytes = self.download()
+        self.duration = time.monotonic() - started_at
+        self.logger.info("Wrote {bytes} bytes in {duration}".format(bytes=downloaded_bytes, duration=datetime.timedelta(seconds=self.duration)))
+
+        self.valid  # raises exceptions FileNotFoundError, InconsistentFile
+        if self.manifest is not None:
+            self.manifest.record(self.filename, self.bin, os.path.getsize(self.filename), self.sha256)
+        return downloaded_bytes
+
     def download(self):
-        export_chunk_url = self.root_query.messagesurl_export(altstart=self.bin[0], altend=self.bin[1], outputformat=self.output_format)
-
-        # TODO: py27: The e'x'clusive open isn't available in python2
-        # TODO: Coverage: This function isn't exercised by any tests
-        with open(self.filename, 'xb') as f:  # write-exclusive binary -- fails if the file already exists
-            bytes = 0
-            r = self.connection.get(export_chunk_url, stream=True)
-            for chunk in r.iter_content(chunk_size=512):  # 1024 * 1024 = 10MB chunk size
-                bytes += len(chunk)
-                f.write(chunk)
+        """
+        Write this bin to a partial file, and rename it into place once complete. Returns the quantity of bytes transferred.
+        A partial file left by an interruption, in this run or an earlier one, is resumed rather than downloaded again.
+        """
+        transferred = 0
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)  # An hourly layout's directory
+        try:
+            for attempt in range(1, self.attempts + 1):
+                try:
+                    # Each attempt's query has a token of its own; one cut off by an interruption is cancelled, as the resume supersedes it
+                    with (self.queries.track() if self.queries is not None else untracked()) as self.cancel_token:
+                        transferred += self.download_partial()
+                    break
+                except INTERRUPTED as e:
+                    if attempt == self.attempts:
+                        raise
+                    self.logger.warning("Download interrupted or stalled, resuming (attempt {0} of {1}): {2}".format(attempt + 1, self.attempts, e))
+            if self.leases is not None:
+                with self.leases.holding(bin_filename(self.bin)):  # Raises LeaseLost
+                    publish(self.partial_filename, self.filename)
+            else:
+                publish(self.partial_filename, self.filename)
+        except Cancelled:
+            if self.racing:
+                self.discard_partial()
+            raise
+        except FileExistsError:
+            if not self.racing:
+                raise
+            self.logger.info("Another copy of this bin finished first.")
+            self.discard_partial()
+            raise Cancelled()
+        return transferred
+
+    def discard_partial(self):
+        try:
+            os.unlink(self.partial_filename)
+        except FileNotFoundError:
+            pass
+
+    def hedge(self):
+        """Another ExportBinToFile for the same bin, writing to a partial file of its own, to race against this one."""
+        twin = copy.copy(self)
+        twin.partial_filename = self.partial_filename[:-len(PARTIAL_SUFFIX)] + HEDGE_SUFFIX + PARTIAL_SUFFIX
+        twin.logger = self.logger.getChild("hedge")
+        twin.cancel_token = None
+        twin.cancelled = threading.Event()
+        self.racing = twin.racing = True
+        return twin
+
+    def cancel(self):
+        """
+        Stop this download at its next buffer, and cancel its query on the server. Called from another thread.
+        A hedge's partial file is removed; otherwise it's left to be resumed.
+        """
+        self.cancelled.set()
+        if self.queries is not None and self.cancel_token is not None:
+            self.queries.cancel(self.cancel_token)
+
+    def download_partial(self):
+        point = None
+        if self.output_format == 'JSON' and os.path.exists(self.partial_filename):
+            point = find_resume_point(self.partial_filename, self.bin, descending=self.descending)
+        if point is not None and point.complete:
+            self.logger.info("Partial file is already complete.")
+            self.sha256 = file_digest(self.partial_filename)
+            return 0
+        if self.paged:
+            return self.download_pages()
+        if point is not None:
+            transferred = self.resume(point)
+            if transferred is not None:
+                return transferred
+
+        export_chunk_url = self.root_query.messagesurl_export(altstart=self.bin[0], altend=self.bin[1], outputformat=self.output_format,
+                                                              constraints=self.constraints, cancel_token=self.cancel_token)
+        with open(self.partial_filename, 'wb') as f:  # Starts over, replacing any partial file that can't be resumed
+            preallocated = preallocate(f, self.bin[2] * self.preallocate_per_event)
+            # The body is consumed incrementally from the socket; close the response so its connection returns to the pool.
+            digest = hashlib.sha256()
+            self.throttle.before_download()
+            with contextlib.closing(self.connection.get(export_chunk_url, stream=True)) as r:
+                bytes = copy_response(r, f, self.buffer_size, digest=digest, throttle=self.throttle, cancelled=self.cancelled)
+            self.sha256 = digest.hexdigest()
+            if preallocated:
+                f.truncate()  # The estimate may have overshot; drop the unused tail
+            self.sync.completed(f)
         return bytes
+
+    @property
+    def paged(self):
+        return self.output_format == 'JSON' and self.page_size is not None and self.bin[2] > self.page_size
+
+    def download_pages(self):
+        """
+        Download the bin's events page_size at a time, and stitch the pages into a single document for the whole bin,
+        as if it had been exported at once: the first page's keys, with one messages array holding every page's events.
+        Returns the quantity of bytes transferred.
+        """
+        total = self.bin[2]
+        pages = [(offset, min(total, offset + self.page_size)) for offset in range(0, total, self.page_size)]
+        self.logger.info("Exporting {0} events in {1} pages".format(total, len(pages)))
+        transferred = 0
+        with open(self.partial_filename, 'wb') as f:
+            trailer = b''
+            for page in pages:
+                export_chunk_url = self.root_query.messagesurl_export(altstart=self.bin[0], altend=self.bin[1], outputformat=self.output_format,
+                                                                      page=page, constraints=self.constraints,
+                                                                      cancel_token=self.cancel_token)
+                with tempfile.TemporaryFile(dir=os.path.dirname(self.filename)) as body:
+                    self.throttle.before_download()
+                    with contextlib.closing(self.connection.get(export_chunk_url, stream=True)) as r:
+                        transferred += copy_response(r, body, self.buffer_size, throttle=self.throttle, cancelled=self.cancelled)
+                    body.seek(0)
+                    keys = []  # (key, value) in document order, with the messages array's (count, start, end) in place of its value
+                    try:
+                        for kind, key, value, start, end in ExportDocumentReader(body, offsets=True):
+                            if kind == 'value':
+                                keys.append((key, value))
+                            elif kind == 'messages':
+                                keys.append((key, (value, start, end)))
+                    except ValueError as e:
+                        raise InconsistentFile(0, "Page {0} of the bin is not valid JSON: {1}".format(page, e), self.filename)
+                    values = dict(keys)
+                    count, array_start, array_end = values.get('messages', (None, None, None))
+                    if (values.get('from'), values.get('to'), values.get('hasMoreResults'), count) != (page[0] + 1, page[1], page[1] < total, page[1] - page[0]):
+                        raise InconsistentFile(0, "Page {0} of the bin has from={1} to={2} hasMoreResults={3} and {4} messages; the server may not support paging".format(
+                            page, values.get('from'), values.get('to'), values.get('hasMoreResults'), count), self.filename)
+
+                    if page[0] == 0:
+                        whole = {'from': 1, 'to': total, 'hasMoreResults': False}
+                        parts = [(json.dumps(key) + ':' + (json.dumps(whole.get(key, value)) if key != 'messages' else '[')).encode('utf-8') for key, value in keys]
+                        split_at = [key for key, _ in keys].index('messages') + 1
+                        f.write(b'{' + b','.join(parts[:split_at]))
+                        trailer = b']' + b''.join(b',' + part for part in parts[split_at:]) + b'}'
+                    else:
+                        f.write(b',')
+                    body.seek(array_start + 1)
+                    copy_range(body, f, array_end - array_start - 2, self.buffer_size)
+            f.write(trailer)
+            self.sync.completed(f)
+        self.sha256 = file_digest(self.partial_filename)
+        return transferred
+
+    @property
+    def descending(self):
+        return self.root_query.existingChartQuery.get('eventSortOrder', 'DESC') != 'ASC'
+
+    def resume(self, point):
+        """
+        Download the events after point, and stitch them onto the partial file in place of everything after point.offset.
+        Returns the quantity of bytes transferred, or None if the remainder doesn't fit and the bin must be downloaded again.
+        """
+        remaining = self.bin[2] - point.events
+        altstart, altend = (self.bin[0], point.timestamp) if self.descending else (point.timestamp, self.bin[1])
+        self.logger.info("Resuming after {0} events, requesting the remaining {1} from time[{2}-{3}]".format(point.events, remaining, altstart, altend))
+        export_chunk_url = self.root_query.messagesurl_export(altstart=altstart, altend=altend, outputformat=self.output_format, constraints=self.constraints, cancel_token=self.cancel_token)
+
+        with tempfile.TemporaryFile(dir=os.path.dirname(self.filename)) as rest:
+            self.throttle.before_download()
+            with contextlib.closing(self.connection.get(export_chunk_url, stream=True)) as r:
+                transferred = copy_response(r, rest, self.buffer_size, throttle=self.throttle, cancelled=self.cancelled)
+            rest.seek(0)
+            values = {}
+            array_start = None
+            try:
+                for kind, key, value, start, end in ExportDocumentReader(rest, offsets=True):
+                    if kind == 'value':
+                        values[key] = value
+                    elif kind == 'messages':
+                        array_start = start
+            except ValueError as e:
+                self.logger.warning("Remainder of the bin isn't valid JSON, starting over: {0}".format(e))
+                return None
+            if array_start is None or values.get('to') != remaining or values.get('hasMoreResults') is not False:
+                self.logger.warning("Remainder of the bin has to={0} hasMoreResults={1}, expected {2} events; starting over".format(
+                    values.get('to'), values.get('hasMoreResults'), remaining))
+                return None
+
+            # The partial file's header already describes the whole bin. Keep it and the events before point, then append
+            # the remainder's events and everything that follows them: "...}" + "," + "{...}]," + '"facetingFields":[...]}'
+            rest.seek(array_start + 1)
+            with open(self.partial_filename, 'r+b') as f:
+                f.seek(point.offset)
+                f.truncate()
+                if remaining:
+                    f.write(b',')
+                shutil.copyfileobj(rest, f, self.buffer_size)
+                self.sync.completed(f)
+        self.sha256 = file_digest(self.partial_filename)
+        return transferred
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incrementally read an exported JSON document, {"from":1,"to":2,"hasMoreResults":false,"messages":[{...},{...}],...},
+in constant memory: only one top-level value or one message is decoded and held at a time.
+"""
+
+import codecs
+import json
+import logging
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE = ' \t\n\r'
+MAXIMUM_VALUE_SIZE = 64 * 1024 * 1024  # Give up on a single value larger than this, rather than buffer the whole file
+
+
+class JsonStreamError(ValueError):
+    """The document isn't valid JSON, or isn't shaped like an export."""
+
+
+class ExportDocumentReader(object):
+    """
+    Walk the top level of an exported JSON document read from a binary file, yielding (kind, key, value, start, end):
+     - ('value', key, value, start, end) for each top-level key other than the messages array
+     - ('message', 'messages', message, start, end) for each element of the messages array
+     - ('messages', 'messages', count, start, end) once the messages array is closed
+    With offsets=True, start and end are byte offsets into the file, with end exclusive; otherwise they're None.
+    """
+
+    def __init__(self, f, buffer_size=64 * 1024, offsets=False):
+        self._f = f
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer_size = buffer_size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._offsets = offsets
+        self.offset = 0 if offsets else None  # Byte offset of the next unread character
+
+    def _fill(self):
+        """Read more of the file, discarding what's already been consumed. Reads grow with the buffer, so a large value costs O(n)."""
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        if len(self._buf) > MAXIMUM_VALUE_SIZE:
+            raise JsonStreamError("A single value exceeds {0} bytes".format(MAXIMUM_VALUE_SIZE))
+        chunk = self._f.read(max(self._buffer_size, len(self._buf)))
+        if chunk:
+            self._buf += self._decoder.decode(chunk)
+        else:
+            self._eof = True
+            self._buf += self._decoder.decode(b'', final=True)
+        return True
+
+    def _advance(self, n):
+        if self._offsets:
+            self.offset += len(self._buf[self._pos:self._pos + n].encode('utf-8'))
+        self._pos += n
+
+    def _peek(self):
+        """Skip whitespace, and return the next character without consuming it, or '' at the end of the file."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in WHITESPACE:
+                self._advance(1)
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos:self._pos + 1]
+
+    def _expect(self, characters):
+        c = self._peek()
+        if c == '' or c not in characters:
+            raise JsonStreamError("Expected one of {0!r} but found {1!r} at character {2}".format(characters, c, self._pos))
+        self._advance(1)
+        return c
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError as e:
+                if self._fill():
+                    continue  # Probably cut off by the end of the buffer; try again with more
+                raise JsonStreamError(str(e))
+            if end == len(self._buf) and self._fill():
+                continue  # A number or literal at the end of the buffer may continue beyond it
+            start = self.offset
+            self._advance(end - self._pos)
+            return value, start, self.offset
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self._advance(1)
+        else:
+            while True:
+                key, _, _ = self._value()
+                if not isinstance(key, str):
+                    raise JsonStreamError("Expected a key, found {0!r}".format(key))
+                self._expect(':')
+                if key == 'messages' and self._peek() == '[':
+                    for event in self._messages():
+                        yield event
+                else:
+                    value, start, end = self._value()
+                    yield ('value', key, value, start, end)
+                if self._expect(',}') == '}':
+                    break
+        if self._peek() != '':
+            raise JsonStreamError("Unexpected data after the end of the document at character {0}".format(self._pos))
+
+    def _messages(self):
+        array_start = self.offset
+        self._expect('[')
+        count = 0
+        if self._peek() == ']':
+            self._advance(1)
+        else:
+            while True:
+                message, start, end = self._value()
+                count += 1
+                yield ('message', 'messages', message, start, end)
+                if self._expect(',]') == ']':
+                    break
+        yield ('messages', 'messages', count, array_start, self.offset)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+Let several exporter processes share one output directory: each bin is leased by one process at a time, through a
+SQLite journal in the directory, and a process which runs out of bins of its own takes over those whose leases have
+expired, such as the bins of a process which crashed or hung.
+"""
+
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+LEASES_FILENAME = ".loginsight-export.leases"
+
+
+class LeaseLost(RuntimeError):
+    """Another process has taken over the lease."""
+
+
+class Leases(object):
+    """
+    Named leases shared by every process using the same directory. A lease lasts `expiry` seconds; a heartbeat thread
+    renews those held every expiry / 4 seconds, so they only lapse if this process dies or stops responding.
+    on_lost(name), if given, is called when a lease turns out to have lapsed and been taken over by another process.
+    tag is unique to this Leases, and safe in a filename, for naming files only its holder may write.
+    SQLite's locking needs a local filesystem; don't share a directory on NFS this way.
+    """
+
+    def __init__(self, directory, expiry=60.0, owner=None, on_lost=None, heartbeat=True, clock=time.time):
+        self.path = os.path.join(directory, LEASES_FILENAME)
+        self.expiry = expiry
+        self.tag = "{0}-{1}".format(os.getpid(), uuid.uuid4().hex[:8])
+        self.owner = owner or "{0}:{1}".format(socket.gethostname(), self.tag)
+        self.on_lost = on_lost
+        self.lost = set()
+        self._clock = clock
+        self._held = set()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+        self._stop = threading.Event()
+        self._heartbeat = None
+        if heartbeat:
+            self._heartbeat = threading.Thread(target=self._beat, name="lease-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+    def _transaction(self, statements):
+        """Run statements, a function of the connection, in a write transaction. Call with self._lock held."""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements(self._db)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return result
+
+    def acquire(self, name):
+        """Take the lease on name, unless another process holds it and it hasn't expired. Returns True if it's now held."""
+        now = self._clock()
+
+        def take(db):
+            row = db.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != self.owner and row[1] > now:
+                return False, row
+            db.execute("INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)", (name, self.owner, now + self.expiry))
+            return True, row
+
+        with self._lock:
+            acquired, previous = self._transaction(take)
+            if acquired:
+                self._held.add(name)
+                self.lost.discard(name)
+        if acquired and previous is not None and previous[0] != self.owner:
+            logger.info("Took over {0} from {1}, whose lease expired".format(name, previous[0]))
+        return acquired
+
+    def release(self, name):
+        with self._lock:
+            if name not in self._held:
+                return
+            self._held.discard(name)
+            self._db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+
+    @contextlib.contextmanager
+    def holding(self, name):
+        """
+        Context manager which raises LeaseLost unless the lease on name is still held, then keeps any other process from
+        taking it over until the block ends, even if it has expired, by holding the journal's write lock.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+                if row is None or row[0] != self.owner:
+                    self._held.discard(name)
+                    self.lost.add(name)
+                    raise LeaseLost("Lost the lease on {0} to {1}".format(name, row[0] if row is not None else "nobody"))
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def renew(self):
+        """Extend every lease held. Returns the names of those lost because they'd lapsed and another process took them."""
+        now = self._clock()
+
+        def extend(db):
+            return [name for name in list(self._held)
+                    if db.execute("UPDATE leases SET expires = ? WHERE name = ? AND owner = ?", (now + self.expiry, name, self.owner)).rowcount == 0]
+
+        with self._lock:
+            lost = self._transaction(extend)
+            self._held.difference_update(lost)
+            self.lost.update(lost)
+        for name in lost:
+            logger.warning("Lost the lease on {0} to another process".format(name))
+            if self.on_lost is not None:
+                self.on_lost(name)
+        return lost
+
+    def _beat(self):
+        while not self._stop.wait(self.expiry / 4.0):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.warning("Couldn't renew leases: {0}".format(e))
+
+    def close(self):
+        """Stop renewing, and release every lease still held."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self._lock:
+            self._db.execute("DELETE FROM leases WHERE owner = ?", (self.owner,))
+            self._held.clear()
+            self._db.close()
+
+    def __repr__(self):
+        return '{cls}(path={x.path!r}, owner={x.owner!r}, expiry={x.expiry!r}, held={n})'.format(
+            cls=self.__class__.__name__, x=self, n=len(self._held))
+
+
+def claim(items, leases, key, finished, poll=1.0, sleep=time.sleep):
+    """
+    Yield each item once this process holds its lease, named key(item), or once finished(item) shows that another
+    process has completed it. Items leased by another process are set aside until the rest have been yielded, then
+    checked every `poll` seconds until they're finished or their leases lapse. Items are pulled lazily, so a lease is
+    only taken when the consumer is ready to start on it.
+    """
+    waiting = []
+    for item in items:
+        if finished(item) or leases.acquire(key(item)):
+            yield item
+        else:
+            waiting.append(item)
+
+    if waiting:
+        logger.info("Waiting on {0} items leased by other processes".format(len(waiting)))
+    while waiting:
+        still_waiting = []
+        for item in waiting:
+            if finished(item) or leases.acquire(key(item)):
+                yield item
+            else:
+                still_waiting.append(item)
+        waiting = still_waiting
+        if waiting:
+            sleep(poll)
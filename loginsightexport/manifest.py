@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""
+An append-only journal of completed output files, kept alongside them in the output directory.
+Resuming an export trusts the journal instead of re-reading every file that's already been downloaded.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = ".loginsight-export.manifest"
+
+ManifestEntry = namedtuple("ManifestEntry", field_names=["filename", "start", "end", "events", "bytes", "sha256"])
+
+
+def file_digest(filename, buffer_size=1024 * 1024):
+    """Compute the sha256 of an existing file, as download() does inline for a new one."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(buffer_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """
+    One JSON object per line, each describing a completed file: its bin's time range and event count, size and sha256.
+    Later lines supersede earlier ones for the same file. A line torn by a crash mid-append is ignored.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_FILENAME)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                for number, line in enumerate(f, start=1):
+                    try:
+                        entry = ManifestEntry(**json.loads(line))
+                    except (ValueError, TypeError):
+                        logger.warning("Ignoring unreadable line {0} of {1}".format(number, self.path))
+                        continue
+                    self._entries[entry.filename] = entry
+        except FileNotFoundError:
+            pass
+        logger.debug("Loaded {0} entries from {1}".format(len(self._entries), self.path))
+
+    def record(self, filename, bin, size, sha256):
+        """Append an entry for a file that's been completely written and validated."""
+        entry = ManifestEntry(filename=os.path.basename(filename), start=bin[0], end=bin[1], events=bin[2], bytes=size, sha256=sha256)
+        line = json.dumps(entry._asdict(), sort_keys=True) + "\n"
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+            self._entries[entry.filename] = entry
+        return entry
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def lookup(self, filename):
+        return self._entries.get(os.path.basename(filename))
+
+    def matches(self, filename, bin):
+        """True if the file was recorded for exactly this bin, and still has the recorded size."""
+        entry = self.lookup(filename)
+        if entry is None:
+            return False
+        if (entry.start, entry.end, entry.events) != tuple(bin[:3]):
+            logger.info("Manifest entry {0} was recorded for a different bin than {1}".format(entry, bin))
+            return False
+        try:
+            size = os.path.getsize(filename)
+        except FileNotFoundError:
+            return False
+        if size != entry.bytes:
+            logger.info("Manifest entry {0} doesn't match the file's size {1}".format(entry, size))
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '{cls}(path={x.path!r}, entries={n})'.format(cls=self.__class__.__name__, x=self, n=len(self._entries))
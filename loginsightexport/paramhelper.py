@@ -2,6 +2,7 @@
 
 import json
 import logging
+import threading
 import time
 import warnings
 import functools
@@ -23,6 +24,20 @@ from urllib.parse import parse_qs, urlparse, urlencode
 
 logger = logging.getLogger(__name__)
 
+# How a partition of a bin constrains its field to one value. CONTAINS would also match other values with the same
+# words in, such as web1 in "web1 web2", so the partitions would overlap and their downloads hold more than counted.
+PARTITION_OPERATOR = 'MATCHES_REGEX'
+
+
+def exact_pattern(value):
+    """A regular expression matching value and nothing else. Every character but a letter or digit is escaped, which Java and Python read alike."""
+    return "^" + "".join(c if c.isalnum() else "\\" + c for c in str(value)) + "$"
+
+
+def field_constraint(field, value):
+    """A fieldConstraints entry restricting a query to events whose field has exactly the value."""
+    return {'internalName': field, 'operator': PARTITION_OPERATOR, 'value': exact_pattern(value)}
+
 
 class SeenWarning(UserWarning):
     """Raised when a @once function is called multiple times with the same arguments."""
@@ -62,6 +77,7 @@ class ExplorerUrlParse(object):
     def __init__(self, url):
         self.from_explorer_url(url)
         self.lasttoken = int(time.time()) * 1000
+        self._token_lock = threading.Lock()  # URLs may be generated concurrently by parallel downloads
 
     def from_explorer_url(self, url):
         p = urlparse(url)
@@ -84,6 +100,16 @@ class ExplorerUrlParse(object):
         self.existingChartQuery = _parse_json_or_empty_dict(queries, 'existingChartQuery')
         self.existingChartQuery_raw = queries['existingChartQuery'][0]
 
+    def _next_token(self):
+        """Produce a token that's distinct from the previous one, even when requested from several threads."""
+        with self._token_lock:
+            token = int(time.time()) * 1000
+
+            while token <= self.lasttoken:
+                token += 1
+            self.lasttoken = token
+        return token
+
     def currentTimeMillis(self):
         return int(round(time.time() * 1000))
 
@@ -154,13 +180,14 @@ class ExplorerUrlParse(object):
 
         return params
 
-    def getExportEventsHelper(self, extraparams={}, altstart=None, altend=None, outputformat='JSON'):
-        """Serialize back to a requests-friendly params dict"""
-        token = int(time.time()) * 1000
-
-        while token == self.lasttoken:
-            token += 1
-        self.lasttoken = token
+    def getExportEventsHelper(self, extraparams={}, altstart=None, altend=None, outputformat='JSON', page=None, constraints=(), cancel_token=None):
+        """
+        Serialize back to a requests-friendly params dict
+        page, if given, is (resultFrom, resultTo): skip the first resultFrom events and end after event resultTo.
+        constraints are (field, value) pairs, added to the query's fieldConstraints.
+        cancel_token, from /logcancel, lets the query be cancelled while it runs.
+        """
+        token = self._next_token()
 
         model = self.existingChartQuery.copy()
 
@@ -169,6 +196,8 @@ class ExplorerUrlParse(object):
             model['startTimeMillis'] = altstart
             model['endTimeMillis'] = altend
             model['dateFilterPreset'] = 'CUSTOM'
+        if constraints:
+            model['fieldConstraints'] = list(model.get('fieldConstraints') or []) + [field_constraint(f, v) for f, v in constraints]
         params = {
             'export': 'true',
             'exportHelper.exportFormat': outputformat,
@@ -177,17 +206,21 @@ class ExplorerUrlParse(object):
             'resultTo': 20000,
             'existingMessageQuery': json.dumps(model)
         }
+        if page is not None:
+            params['resultFrom'], params['resultTo'] = page
+        if cancel_token is not None:
+            params['paramsHelper.cancelToken'] = cancel_token
         if extraparams:
             params.update(extraparams)
         return params
 
-    def getExportChartHelper(self, extraparams={}, altstart=None, altend=None):
-        """Serialize back to a requests-friendly params dict"""
-        token = int(time.time()) * 1000
-
-        while token == self.lasttoken:
-            token += 1
-        self.lasttoken = token
+    def getExportChartHelper(self, extraparams={}, altstart=None, altend=None, group_by=None, cancel_token=None):
+        """
+        Serialize back to a requests-friendly params dict
+        With group_by, count events for each value of that field instead of over time.
+        cancel_token, from /logcancel, lets the query be cancelled while it runs.
+        """
+        token = self._next_token()
 
         params = {}
 
@@ -267,6 +300,14 @@ class ExplorerUrlParse(object):
             params['paramsHelper.endTimeMillis'] = altend
             params['paramsHelper.dateFilterPreset'] = 'CUSTOM'
 
+        if group_by is not None:
+            logger.debug("Grouping by {0} instead of time".format(group_by))
+            params['paramsHelper.shouldGroupByTime'] = 'false'
+            params['paramsHelper.groupByFields[0].internalName'] = group_by
+            params['paramsHelper.groupByFields[0].numericGroupByType'] = 'EACH_VALUE'
+        if cancel_token is not None:
+            params['paramsHelper.cancelToken'] = cancel_token
+
         return params
 
     @property
@@ -294,13 +335,14 @@ class ExplorerUrlParse(object):
         return '/logcharting?' + query
 
     @once
-    def messagesurl_export(self, altstart=None, altend=None, outputformat=None):
-        query = urlencode(self.getExportEventsHelper(altstart=altstart, altend=altend, outputformat=outputformat))
+    def messagesurl_export(self, altstart=None, altend=None, outputformat=None, page=None, constraints=(), cancel_token=None):
+        query = urlencode(self.getExportEventsHelper(altstart=altstart, altend=altend, outputformat=outputformat, page=page, constraints=constraints,
+                                                     cancel_token=cancel_token))
         return '/messages?' + query
 
     @once
-    def chartingurl_export(self, altstart=None, altend=None):
-        query = urlencode(self.getExportChartHelper(altstart=altstart, altend=altend))
+    def chartingurl_export(self, altstart=None, altend=None, group_by=None, cancel_token=None):
+        query = urlencode(self.getExportChartHelper(altstart=altstart, altend=altend, group_by=group_by, cancel_token=cancel_token))
         return '/logcharting?' + query
 
     @property
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+A plan file: the bins an export was divided into, with the query and the settings they were planned for, so the export
+can be downloaded later, from another machine, or by several machines at once, without planning it again.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+
+class InvalidPlan(ValueError):
+    """The file isn't a plan, or was written by an incompatible version."""
+
+
+class Plan(object):
+    """
+    The bins to download, in time order, for the query at url: the server, and the expanded /explorer?... query,
+    without credentials. output_format and maximum are the --raw and --max settings the bins were planned with.
+    """
+
+    def __init__(self, url, output_format, maximum, bins):
+        self.url = url
+        self.output_format = output_format
+        self.maximum = maximum
+        self.bins = bins
+
+    def save(self, path):
+        """Write the plan to path, as compact JSON, replacing any existing file only once it's complete."""
+        document = {
+            'version': PLAN_VERSION,
+            'url': self.url,
+            'format': self.output_format,
+            'max': self.maximum,
+            'bins': [list(b[:3]) + ([list(b[3])] if len(b) > 3 and b[3] is not None else []) for b in self.bins],
+        }
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(document, f, separators=(',', ':'))
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Read a plan written by save(). Raises InvalidPlan if it can't be used, or OSError if it can't be read."""
+        with open(path, 'r') as f:
+            try:
+                document = json.load(f)
+            except ValueError as e:
+                raise InvalidPlan("{0} isn't a plan file: {1}".format(path, e))
+        if not isinstance(document, dict) or document.get('version') != PLAN_VERSION:
+            raise InvalidPlan("{0} isn't a version {1} plan file".format(path, PLAN_VERSION))
+        try:
+            bins = [(b[0], b[1], b[2], tuple(b[3])) if len(b) > 3 else (b[0], b[1], b[2]) for b in document['bins']]
+            plan = cls(document['url'], document['format'], document['max'], bins)
+        except (KeyError, IndexError, TypeError) as e:
+            raise InvalidPlan("{0} is an incomplete plan file: {1!r}".format(path, e))
+        logger.debug("Loaded {0} from {1}".format(plan, path))
+        return plan
+
+    def __repr__(self):
+        return '{cls}(output_format={x.output_format!r}, maximum={x.maximum!r}, bins={n}, events={e})'.format(
+            cls=self.__class__.__name__, x=self, n=len(self.bins), e=sum(b[2] for b in self.bins))
+
+
+def shard(bins, index, count):
+    """
+    The index'th, from 1, of count contiguous slices of bins, balanced by event count, which stands in for the size of
+    the files they'll become. Each bin goes to the slice its midpoint falls in, so every bin is in exactly one slice, and
+    every machine given the same plan slices it the same way.
+    """
+    weights = [max(1, b[2]) for b in bins]  # Even an empty bin costs a request
+    total = float(sum(weights))
+    taken = 0
+    selected = []
+    for b, weight in zip(bins, weights):
+        if min(count - 1, int(count * (taken + weight / 2.0) / total)) == index - 1:
+            selected.append(b)
+        taken += weight
+    return selected
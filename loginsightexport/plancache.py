@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+An on-disk cache of the bins returned by aggregate (chart) queries, so a re-run or resume of the same export can plan
+without asking the server again. Each entry is keyed by the server, the normalized query and the time range.
+A range which ended well before it was cached won't gain new events, so its entry never expires; others expire after a TTL.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+PLAN_CACHE_DIRECTORY = ".loginsight-export.plancache"
+ENTRY_SUFFIX = ".json"
+
+# Parts of the query model that vary between otherwise-identical queries: the time range is part of each key instead
+VOLATILE_KEYS = ('startTimeMillis', 'endTimeMillis', 'dateFilterPreset')
+
+
+def normalized_query(model):
+    """The query model, without its time range or any tokens, as canonical JSON."""
+    return json.dumps({k: v for k, v in model.items() if k not in VOLATILE_KEYS and 'token' not in k.lower()}, sort_keys=True)
+
+
+class PlanCache(object):
+    """
+    Bins for (start, end) ranges of one query on one server, as one account sees them, one JSON file per range. What
+    a query counts depends on the data the account may access, so entries are kept apart by username and auth provider.
+     - ttl: seconds an entry for a recent range is trusted
+     - settle: seconds after which a range's events are assumed to have all arrived; an entry for a range that ended
+       this long before it was stored is kept until evicted
+     - max_entries: the least recently used entries beyond this are evicted
+    """
+
+    def __init__(self, directory, server, model, username=None, provider=None, ttl=600, settle=3600, max_entries=10000, clock=time.time):
+        self.directory = directory
+        self.ttl = ttl
+        self.settle = settle
+        self.max_entries = max_entries
+        self._clock = clock
+        self._namespace = hashlib.sha256(json.dumps([server, username, provider, normalized_query(model)]).encode('utf-8')).hexdigest()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.evict()
+
+    def _path(self, start, end):
+        key = hashlib.sha256("{0}:{1}:{2}".format(self._namespace, start, end).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def _expired(self, entry, now):
+        if entry['end'] < (entry['stored'] - self.settle) * 1000:
+            return False  # Immutable
+        return now - entry['stored'] > self.ttl
+
+    def get(self, start, end):
+        """The bins cached for this range, or None."""
+        path = self._path(start, end)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            expired = self._expired(entry, self._clock())
+        except FileNotFoundError:
+            entry, expired = None, True
+        except (ValueError, KeyError, TypeError) as e:
+            logger.debug("Ignoring unreadable plan cache entry {0}: {1}".format(path, e))
+            entry, expired = None, True
+
+        with self._lock:
+            if expired:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(path)  # Recently used
+        except OSError:
+            pass
+        return [tuple(b) for b in entry['bins']]
+
+    def put(self, start, end, bins):
+        entry = {'start': start, 'end': end, 'stored': self._clock(), 'bins': [list(b) for b in bins]}
+        # Write then rename, so a concurrent or interrupted run never reads half an entry
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(temporary, self._path(start, end))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def evict(self):
+        """Delete expired and unreadable entries, then the least recently used beyond max_entries."""
+        now = self._clock()
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                with open(path, 'r') as f:
+                    expired = self._expired(json.load(f), now)
+                used = os.path.getmtime(path)
+            except (OSError, ValueError, KeyError, TypeError):
+                expired, used = True, None
+            if expired:
+                self._remove(path)
+            else:
+                entries.append((used, path))
+
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            self._remove(path)
+        logger.debug("{0} holds {1} entries".format(self, min(len(entries), self.max_entries)))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return '{cls}(directory={x.directory!r}, ttl={x.ttl!r}, settle={x.settle!r}, max_entries={x.max_entries!r})'.format(
+            cls=self.__class__.__name__, x=self)
@@ -5,6 +5,7 @@ import sys
 import collections
 import datetime
 import humanize
+import threading
 import time
 
 
@@ -23,8 +24,9 @@ import time
 class ProgressRange(object):
     logger = logging.getLogger(__name__)
 
-    def __init__(self, bins=[(0, 0, 0)], prelude="Planning", suffix="requests", columns=100):
+    def __init__(self, bins=[(0, 0, 0)], prelude="Planning", suffix="requests", columns=100, quiet=False):
         self.columns = columns
+        self.quiet = quiet
         self.prelude = prelude
         self.suffix = suffix
         self.updates = 0
@@ -32,6 +34,7 @@ class ProgressRange(object):
         self.longest_line = 0
         self.started_at = time.monotonic()
         self.duration = 0
+        self._lock = threading.Lock()  # Parallel planning reports from several threads
 
     def start(self, bins):
         self._start = min([x[0] for x in bins])
@@ -42,6 +45,10 @@ class ProgressRange(object):
         return self
 
     def update(self, bins, increment=1):
+        with self._lock:
+            self._update(bins, increment)
+
+    def _update(self, bins, increment):
         self.duration = datetime.timedelta(seconds=time.monotonic() - self.started_at)
         self.updates += increment
         start = min([x[0] for x in bins])
@@ -53,7 +60,7 @@ class ProgressRange(object):
         filledEndin = int(round(self.columns * percent_endin))
         percent = sum([filledStart, filledEndin]) / 2
 
-        if not self.logger.isEnabledFor(logging.WARNING):
+        if self.quiet or not self.logger.isEnabledFor(logging.WARNING):
             return
         if self.logger.isEnabledFor(logging.INFO):
             self.logger.info("{s.prelude} consider time range {start}-{endin} = {percent:.1f}% {s.updates} {s.suffix} ({s.duration} elapsed)".format(s=self, start=start, endin=endin, bin=bin, percent=percent))
@@ -76,7 +83,7 @@ class ProgressRange(object):
         else:
             self.update([(self._end, self._end, 0)], increment=0)  # TODO: BUG: This results in a progress bar at 50% full of ====
 
-        if not self.logger.isEnabledFor(logging.WARNING) or self.logger.isEnabledFor(logging.INFO):
+        if self.quiet or not self.logger.isEnabledFor(logging.WARNING) or self.logger.isEnabledFor(logging.INFO):
             return
         sys.stdout.write("\n")  # write and flush a newline at the end of the progress bar
         sys.stdout.flush()
@@ -84,9 +91,9 @@ class ProgressRange(object):
 
 
 class ProgressBar(collections.Iterator):
-    def __init__(self, iterable, start=0, prelude="Download", suffix="", columns=100, quiet=False, log=False, extra=None):
+    def __init__(self, iterable, start=0, prelude="Download", suffix="", columns=100, quiet=False, log=False, extra=None, total=None):
         self.current = start
-        self.total = len(iterable)
+        self.total = len(iterable) if total is None else total  # Iterators have no len(), so the caller supplies it
         self.columns = columns
         self.prelude = prelude
         self.suffix = suffix
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""
+Execute a function over a stream of work items on a bounded pool of worker threads.
+"""
+
+import logging
+import queue
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Run fn(item) for each item, with at most `workers` items in flight at any time.
+    Items are pulled from the iterable only as workers become free, so a lazy iterable is never materialized.
+    With a single worker, items are processed inline on the calling thread, exactly like a plain loop.
+    If a limit is given, an object with a `current` attribute such as throttle.AdaptiveLimit, no more than limit.current
+    items are started while it's below the number of workers.
+    With hedge, up to that many stragglers at a time are run a second time on spare workers, see imap_unordered.
+    """
+
+    def __init__(self, workers=1, limit=None, hedge=0, hedge_after=2.0, clock=time.monotonic):
+        if workers < 1:
+            raise ValueError("At least one worker is required, got {0}".format(workers))
+        self.workers = workers
+        self.limit = limit
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self._clock = clock
+
+    @property
+    def capacity(self):
+        if self.limit is None:
+            return self.workers
+        return max(1, min(self.workers, self.limit.current))
+
+    def imap_unordered(self, fn, iterable, twin=None, cancel=None):
+        """
+        Yield (item, fn(item)) tuples in order of completion. The first exception raised by fn is re-raised here.
+        Once every item has started, an item which has been running for more than hedge_after times the median duration
+        of those finished is started again as fn(twin(item)), if a worker is free. The first of the two to succeed is
+        yielded, as (item or twin, result); the other is passed to cancel(), if given, and its outcome ignored.
+        An exception from one of the two is only raised if the other fails too.
+        If iteration ends early, items still running are passed to cancel().
+        """
+        if self.workers == 1:
+            for item in iterable:
+                yield item, fn(item)
+            return
+
+        hedging = self.hedge > 0 and twin is not None
+        items = iter(iterable)
+        pending = {}  # future: (item, what fn was called with, when it was submitted)
+        durations = []
+        hedged = set()  # ids of items which have been hedged, while they're pending
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                exhausted = False
+                while True:
+                    while not exhausted and len(pending) < self.capacity:
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        pending[executor.submit(fn, item)] = (item, item, self._clock())
+
+                    if not pending:
+                        return
+
+                    timeout = None
+                    if hedging and exhausted and durations:
+                        timeout = self._hedge_stragglers(executor, fn, twin, pending, hedged, statistics.median(durations))
+
+                    done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future not in pending:
+                            continue  # A hedge which lost, in the same batch as the winner
+                        item, work, started = pending.pop(future)
+                        siblings = [f for f, (other, _, _) in pending.items() if other is item]
+                        error = future.exception()
+                        if error is not None and siblings:
+                            logger.info("One copy of {0} failed, waiting on the other: {1}".format(item, error))
+                            continue
+                        durations.append(self._clock() - started)
+                        hedged.discard(id(item))
+                        for sibling in siblings:
+                            _, loser, _ = pending.pop(sibling)
+                            sibling.cancel()
+                            if cancel is not None:
+                                cancel(loser)
+                        yield work, future.result()
+            finally:
+                # Reached on exhaustion, on an exception from fn, or when the consumer stops iterating early.
+                # Work that hasn't started is abandoned; work already running is passed to cancel(), if given, or allowed to finish.
+                for future, (_, work, _) in pending.items():
+                    if not future.cancel() and cancel is not None:
+                        cancel(work)
+                if pending:
+                    logger.debug("Abandoned {0} scheduled items".format(len(pending)))
+
+    def _hedge_stragglers(self, executor, fn, twin, pending, hedged, median):
+        """Start twins of the items running longest past hedge_after * median. Returns seconds until the next one is due, or None."""
+        now = self._clock()
+        threshold = self.hedge_after * median
+        candidates = sorted(((started, item) for item, work, started in pending.values() if item is work and id(item) not in hedged), key=lambda c: c[0])
+        for started, item in candidates:
+            if len(hedged) >= self.hedge or len(pending) >= self.workers:
+                return None
+            if now - started < threshold:
+                return started + threshold - now
+            logger.info("Hedging {0}, running for {1:.1f}s against a median of {2:.1f}s".format(item, now - started, median))
+            hedged.add(id(item))
+            copy = twin(item)
+            pending[executor.submit(fn, copy)] = (item, copy, now)
+        return None
+
+    def __repr__(self):
+        return '{cls}(workers={x.workers!r}, limit={x.limit!r}, hedge={x.hedge!r})'.format(cls=self.__class__.__name__, x=self)
+
+
+def _put(q, value, stop):
+    """Block until value is enqueued, unless the consumer has gone away."""
+    while not stop.is_set():
+        try:
+            q.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def prefetch(iterable, maxsize=1):
+    """
+    Advance iterable on a background thread, running at most maxsize items ahead of the consumer.
+    The producer blocks while the buffer is full, so a slow consumer applies backpressure to a fast producer.
+    An exception raised by the iterable is re-raised to the consumer after the items that preceded it.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(q, (True, item), stop):
+                    return
+            _put(q, (False, None), stop)
+        except BaseException as e:
+            _put(q, (False, e), stop)
+
+    producer = threading.Thread(target=produce, name="prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            more, value = q.get()
+            if more:
+                yield value
+            elif value is None:
+                return
+            else:
+                raise value
+    finally:
+        stop.set()
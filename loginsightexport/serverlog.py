@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+Send messages to the server's ui_runtime.log from a background thread, so they cost the export neither time nor many
+requests: messages are logged locally straight away, queued, and posted together at most once per interval. If the
+queue fills up, because the server is slow or unreachable, further messages are dropped rather than waited for.
+"""
+
+import logging
+import queue
+import threading
+
+import requests
+
+from . import USERAGENT
+from loginsightexport.uidriver import ServerError
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+serverlogger = logging.getLogger("loginsightexport.uidriver").getChild("ServerLogger").getChild("ui_runtime.log")  # As Connection.log
+
+
+class ServerLog(object):
+    """
+    Connection.log(), off the critical path. Up to `capacity` messages wait to be sent; every `interval` seconds, those
+    waiting are posted as one multi-line message. close() sends whatever's left; after it, messages are sent at once.
+    """
+
+    def __init__(self, connection, capacity=100, interval=1.0):
+        self.connection = connection
+        self.interval = interval
+        self.sent = 0  # Messages the server accepted
+        self.dropped = 0
+        self.requests = 0
+        self._unreported = 0  # Dropped messages not yet owned up to in the server's log
+        self._queue = queue.Queue(maxsize=capacity)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="server-log", daemon=True)
+        self._thread.start()
+
+    def log(self, message, includeuseragent=True):
+        """Log message locally, and queue it for the server. Returns False if it was dropped, or once closed, if it failed."""
+        serverlogger.info(msg=message)
+        text = "%s %s" % (USERAGENT, message) if includeuseragent else message
+        if self._closed:
+            return self._send([text])
+        try:
+            self._queue.put_nowait(text)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            stopping = self._stop.wait(self.interval)
+            self._flush()
+            if stopping:
+                return
+
+    def _flush(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if messages or self._unreported:
+            self._send(messages)
+
+    def _send(self, messages):
+        with self._lock:
+            dropped, self._unreported = self._unreported, 0
+        if dropped:
+            messages.append("%s dropped %d messages the server was too slow to take" % (USERAGENT, dropped))
+        self.requests += 1
+        try:
+            succeeded = self.connection.log("\n".join(messages), includeuseragent=False, echo=False)
+        except (requests.exceptions.RequestException, ServerError) as e:
+            logger.debug("Couldn't send {0} messages to the server's log: {1}".format(len(messages), e))
+            return False
+        if succeeded:
+            self.sent += len(messages)
+        return succeeded
+
+    def close(self, timeout=10.0):
+        """Send the messages still waiting, giving up after timeout seconds. Idempotent."""
+        if self._closed:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("Gave up waiting for the server to take {0} log messages".format(self._queue.qsize()))
+        self._closed = True
+
+    def __repr__(self):
+        return '{cls}(sent={x.sent!r}, dropped={x.dropped!r}, requests={x.requests!r})'.format(cls=self.__class__.__name__, x=self)
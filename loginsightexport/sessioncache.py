@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+An on-disk cache of authenticated session cookies, one entry per server and user, so that a run can reuse the session
+of the run before it instead of fetching a CSRF token and logging in again. An entry isn't checked when it's loaded: if
+the server no longer accepts the session, the first request gets a 401 and the usual login replaces the entry.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import time
+
+import requests
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache"), "loginsight-export", "sessions")
+MAXIMUM_AGE = 12 * 3600  # Seconds; older sessions are assumed to have expired on the server anyway
+
+
+class SessionCache(object):
+    """
+    The session cookies for one user on one server. The directory is created readable by its owner only, and entries
+    are written the same way; an entry which anyone else could read or replace is ignored.
+    """
+
+    def __init__(self, directory, hostname, port, username, provider, maximum_age=MAXIMUM_AGE, clock=time.time):
+        self.directory = directory
+        self.maximum_age = maximum_age
+        self._clock = clock
+        self.age = None  # Seconds since the session returned by load() was stored
+        key = json.dumps([hostname, port, username, provider])
+        self.path = os.path.join(directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + ".json")
+
+    def _private(self, path):
+        if os.name != 'posix':
+            return True
+        st = os.stat(path)
+        if st.st_uid != os.getuid() or st.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+            logger.warning("Ignoring {0}, which other users can access".format(path))
+            return False
+        return True
+
+    def load(self):
+        """The cached session's cookies, as a cookie jar, or None."""
+        try:
+            if not (self._private(self.directory) and self._private(self.path)):
+                return None
+            with open(self.path, 'r') as f:
+                entry = json.load(f)
+            age = self._clock() - entry['stored']
+            if age > self.maximum_age:
+                logger.debug("Cached session {0} has expired".format(self.path))
+                return None
+            cookies = requests.cookies.RequestsCookieJar()
+            for c in entry['cookies']:
+                cookies.set_cookie(requests.cookies.create_cookie(c['name'], c['value'], domain=c['domain'], path=c['path']))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug("Ignoring unreadable session cache entry {0}: {1}".format(self.path, e))
+            return None
+        logger.info("Reusing the session cached in {0}".format(self.path))
+        self.age = age
+        return cookies
+
+    def save(self, cookies):
+        """Store a new session's cookie jar. Failure is logged, not raised: the cache is only an optimization."""
+        # With the domain and path each was set for, so they replace, rather than sit alongside, the cookies of the next login
+        entry = {'stored': self._clock(), 'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path} for c in cookies]}
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            if not self._private(self.directory):
+                return
+            fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")  # Created 0600
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entry, f)
+                os.replace(temporary, self.path)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+        except OSError as e:
+            logger.warning("Couldn't cache the session in {0}: {1}".format(self.path, e))
+            return
+        logger.debug("Cached the session in {0}".format(self.path))
+
+    def __repr__(self):
+        return '{cls}(path={x.path!r}, maximum_age={x.maximum_age!r})'.format(cls=self.__class__.__name__, x=self)
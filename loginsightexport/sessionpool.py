@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+Spread an export's queries over several independently authenticated sessions, on one Log Insight node or several nodes
+of a cluster, so that neither a server which works through a session's requests one at a time nor a single node's query
+capacity serializes the whole export. Each thread sticks to one session for a while, and a query, its cancel token and
+its paged follow-ups always use the same one; threads move towards the sessions answering fastest. A session that
+keeps failing is set aside for a while and logs in afresh when it's next used.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+import requests
+
+from loginsightexport.uidriver import ServerError
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_WEIGHT = 0.2  # Of each response, in a session's moving average response time
+
+
+class PooledConnection(object):
+    """One of the pool's sessions, with its health."""
+
+    def __init__(self, connection, index):
+        self.connection = connection
+        self.index = index
+        self.threads = 0  # Threads assigned to it so far
+        self.requests = 0
+        self.failures = 0  # In a row
+        self.healthy_at = 0  # While the clock is before this, it's set aside
+        self.latency = None  # Moving average of seconds until a response's headers arrive
+
+    def healthy(self, now):
+        return now >= self.healthy_at
+
+    def __repr__(self):
+        return '{cls}(index={x.index!r}, node={n!r}, requests={x.requests!r}, latency={x.latency!r}, failures={x.failures!r})'.format(
+            cls=self.__class__.__name__, n=self.connection._hostname, x=self)
+
+
+class SessionPool(object):
+    """
+    Connection-like: get(), post() and so on go to the session assigned to the calling thread: the healthy one where it
+    can expect the quickest responses, given each session's response time and the threads already sharing it. Every
+    rebalance_every requests, the thread is reassigned. A session whose requests fail max_failures times in a row, with
+    a connection error, an HTTP 5xx or a refused login, is set aside for `cooldown` seconds and its cookies dropped, so
+    it logs in again when it's back.
+    """
+
+    def __init__(self, connections, max_failures=3, cooldown=30.0, rebalance_every=16, clock=time.monotonic):
+        if not connections:
+            raise ValueError("A session pool needs at least one connection")
+        self.members = [PooledConnection(c, i) for i, c in enumerate(connections)]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.rebalance_every = rebalance_every
+        self._clock = clock
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def login(cls, connection, size, new_session=requests.Session, nodes=(), **kwargs):
+        """
+        A pool of connection and size - 1 copies of it, plus size connections to each other node, a (hostname, port) of
+        the same cluster. Each copy has a session from new_session() and logs in separately.
+        """
+        copies = [connection.copy_connection(connection, existing_session=new_session()) for _ in range(size - 1)]
+        for hostname, port in nodes:
+            copies += [connection.copy_connection(connection, existing_session=new_session(), hostname=hostname, port=port) for _ in range(size)]
+        return cls([connection] + copies, **kwargs)
+
+    def _member(self):
+        member = getattr(self._local, 'member', None)
+        self._local.requests = getattr(self._local, 'requests', 0) + 1
+        if member is not None and getattr(self._local, 'pinned', 0):
+            return member
+        now = self._clock()
+        if member is None or not member.healthy(now) or self._local.requests % self.rebalance_every == 0:
+            with self._lock:
+                if member is not None:
+                    member.threads -= 1
+                known = [m.latency for m in self.members if m.latency is not None]
+                untried = min(known) if known else 0  # Optimistic, so a session gets tried
+
+                def cost(m):
+                    latency = m.latency if m.latency is not None else untried
+                    return (not m.healthy(now), (m.threads + 1) * latency, m.threads, m.healthy_at, m.index)
+
+                member = min(self.members, key=cost)
+                member.threads += 1
+            self._local.member = member
+        return member
+
+    def current(self):
+        """The connection the calling thread's requests go to."""
+        return self._member().connection
+
+    @contextlib.contextmanager
+    def pinned(self):
+        """
+        Context manager which keeps the calling thread's requests on one session until the block ends, such as a query's
+        and those for its cancel token. Gives that session's connection.
+        """
+        member = self._member()
+        self._local.pinned = getattr(self._local, 'pinned', 0) + 1
+        try:
+            yield member.connection
+        finally:
+            self._local.pinned -= 1
+
+    def _failed(self, member, reason):
+        with self._lock:
+            member.failures += 1
+            if member.failures < self.max_failures or not member.healthy(self._clock()):
+                return
+            member.failures = 0
+            member.healthy_at = self._clock() + self.cooldown
+            member.latency = None  # Whatever it was, it'll be different when the session's back
+        logger.warning("Setting session {0} on {1} aside for {2}s after {3} failures in a row, the last {4}".format(
+            member.index, member.connection._hostname, self.cooldown, self.max_failures, reason))
+        # Log in afresh when it's next used, in case it's the session itself the server has stopped accepting
+        auth = member.connection._authprovider
+        if auth is not None:
+            auth.sessionId = None
+        member.connection._requestsession.cookies.clear()
+
+    def _request(self, method, *args, **kwargs):
+        member = self._member()
+        with self._lock:
+            member.requests += 1
+        started = self._clock()
+        try:
+            r = getattr(member.connection, method)(*args, **kwargs)
+        except (requests.exceptions.RequestException, ServerError) as e:
+            self._failed(member, e)
+            raise
+        if r.status_code >= 500:
+            self._failed(member, "HTTP {0}".format(r.status_code))
+            return r
+        elapsed = self._clock() - started
+        with self._lock:
+            member.failures = 0
+            member.latency = elapsed if member.latency is None else member.latency + LATENCY_WEIGHT * (elapsed - member.latency)
+        return r
+
+    def get(self, url, **kwargs):
+        return self._request('get', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._request('post', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self._request('put', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self._request('patch', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._request('delete', url, **kwargs)
+
+    def log(self, message, includeuseragent=True):
+        return self.current().log(message, includeuseragent=includeuseragent)
+
+    def ping(self):
+        return self.current().ping()
+
+    def __repr__(self):
+        return '{cls}({m!r})'.format(cls=self.__class__.__name__, m=self.members)
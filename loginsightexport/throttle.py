@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pace requests to a Log Insight server: adapt how many run at once to the server's responses, and optionally cap
+requests per second, bytes per second, and the rate at which bin downloads start. Suggest bin sizes that keep each
+download near a target duration or size.
+"""
+
+import logging
+import re
+import threading
+import time
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+logger = logging.getLogger(__name__)
+
+# A Warning header is only a sign of congestion if it says so; Log Insight also uses them for tech preview notices.
+CONGESTION_WARNING = re.compile(r'busy|overload|throttl|too many|capacity|slow down|try again', re.IGNORECASE)
+
+
+class TokenBucket(object):
+    """
+    Allow `rate` units per second on average, in bursts of up to `capacity` units. Units may be requests or bytes.
+    A consumer may take more than the bucket holds; it then waits until the debt has been repaid.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("Rate must be positive, got {0}".format(rate))
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, n=1):
+        """Take n units, blocking until they're available. Returns the seconds spent waiting."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    def __repr__(self):
+        return '{cls}(rate={x.rate!r}, capacity={x.capacity!r})'.format(cls=self.__class__.__name__, x=self)
+
+
+class AdaptiveLimit(object):
+    """
+    Additive-increase/multiplicative-decrease control of how many requests may be in flight, between minimum and maximum.
+    The limit grows by one per success until the first sign of congestion (slow start), then by one per round of `limit`
+    successes. Each congestion signal multiplies it by `decrease`, once per round: signals from requests that started
+    before the last decrease are taken as part of the congestion already reacted to.
+    A response slower than latency_factor times the fastest recently seen of its kind is a congestion signal too. Each
+    kind of request, such as each endpoint, has a latency baseline of its own, so that quick requests for cancel tokens
+    don't make every query look slow.
+    """
+    BASELINE_DRIFT = 0.05  # Let the latency baseline creep up towards slower responses, so it tracks a changing server
+    MINIMUM_LATENCY_EXCESS = 0.1  # Seconds; ignore jitter on responses that are fast anyway
+
+    def __init__(self, maximum, minimum=1, initial=1, decrease=0.5, latency_factor=3.0, clock=time.monotonic):
+        if not 1 <= minimum <= maximum:
+            raise ValueError("Expected 1 <= minimum <= maximum, got {0} and {1}".format(minimum, maximum))
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self._clock = clock
+        self._limit = float(min(max(initial, minimum), maximum))
+        self._slow_start = True
+        self._decreased_at = None
+        self._baselines = {}  # Kind of request to the fastest latency recently seen for it
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        return int(self._limit)
+
+    def observe(self, started_at, latency=None, congested=False, kind=None):
+        """
+        Feed back the outcome of a request of some kind, started at started_at, a reading of the clock. Returns True if
+        it was taken as congestion.
+        """
+        with self._lock:
+            if latency is not None:
+                baseline = self._baselines.get(kind)
+                if baseline is None or latency < baseline:
+                    self._baselines[kind] = latency
+                else:
+                    if latency > baseline * self.latency_factor and latency - baseline > self.MINIMUM_LATENCY_EXCESS:
+                        congested = True
+                    self._baselines[kind] = baseline + (latency - baseline) * self.BASELINE_DRIFT
+
+            if not congested:
+                self._limit = min(self.maximum, self._limit + (1 if self._slow_start else 1 / self._limit))
+                return False
+
+            if self._decreased_at is not None and started_at < self._decreased_at:
+                return True
+            self._slow_start = False
+            self._decreased_at = self._clock()
+            previous, self._limit = self._limit, max(self.minimum, self._limit * self.decrease)
+        logger.info("Congestion, reduced concurrency from {0} to {1}".format(int(previous), int(self._limit)))
+        return True
+
+    def __repr__(self):
+        return '{cls}(current={x.current!r}, minimum={x.minimum!r}, maximum={x.maximum!r})'.format(cls=self.__class__.__name__, x=self)
+
+
+def congested(response):
+    """True if a response, or a retry urllib3 made on the way to it, shows that the server is overloaded."""
+    if response.status_code >= 500 or response.status_code == 429:
+        return True
+    retries = getattr(getattr(response, 'raw', None), 'retries', None)
+    for attempt in getattr(retries, 'history', ()):
+        if attempt.error is not None or (attempt.status is not None and attempt.status >= 500):
+            return True
+    return bool(CONGESTION_WARNING.search(response.headers.get('Warning', '')))
+
+
+class Throttle(object):
+    """
+    Everything that paces a connection. Each part is optional; a Throttle() with no arguments never waits.
+     - concurrency: an AdaptiveLimit, fed by every response, for the caller to consult before starting work
+     - requests_per_second, bytes_per_second: caps on the request rate and on the transfer rate of downloads
+     - download_interval: seconds between the starts of successive bin downloads
+    """
+
+    def __init__(self, concurrency=None, requests_per_second=0, bytes_per_second=0, download_interval=0, clock=time.monotonic):
+        self.concurrency = concurrency
+        self.requests = TokenBucket(requests_per_second) if requests_per_second else None
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.downloads = TokenBucket(1.0 / download_interval, capacity=1) if download_interval else None
+        self._clock = clock
+
+    def before_request(self):
+        """Wait for the request rate cap, if any. Returns the time the request starts, for after_response()."""
+        if self.requests is not None:
+            self.requests.consume(1)
+        return self._clock()
+
+    def after_response(self, started_at, response=None, error=None, kind=None):
+        """
+        Report a response's headers having arrived, or the request having failed with a connection error or exhausted
+        retries. Responses are timed against others of the same kind, such as the endpoint requested.
+        """
+        if self.concurrency is None:
+            return
+        if error is not None:
+            self.concurrency.observe(started_at, congested=True, kind=kind)
+        else:
+            self.concurrency.observe(started_at, latency=self._clock() - started_at, congested=congested(response), kind=kind)
+
+    def before_download(self):
+        if self.downloads is not None:
+            self.downloads.consume(1)
+
+    def transferred(self, n):
+        if self.bytes is not None:
+            self.bytes.consume(n)
+
+    def __repr__(self):
+        return '{cls}(concurrency={x.concurrency!r}, requests={x.requests!r}, bytes={x.bytes!r}, downloads={x.downloads!r})'.format(
+            cls=self.__class__.__name__, x=self)
+
+
+class BinSizer(object):
+    """
+    Suggest how many events a bin should hold, so that its download takes about target_seconds, or its file is about
+    target_bytes, judging by the downloads so far. Never more than maximum, nor fewer than minimum; until a download has
+    been observed, or with no targets, maximum.
+    A download is modelled as a fixed overhead, the server's time to run the query, as measured by chart queries, plus a
+    time per event. Estimates are moving averages, so they follow a change in the size of events through the time range.
+    """
+
+    def __init__(self, maximum, target_seconds=0, target_bytes=0, minimum=1, smoothing=0.2):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.smoothing = smoothing
+        self.overhead = 0.0
+        self.bytes_per_event = None
+        self.seconds_per_event = None
+        self._lock = threading.Lock()
+
+    def _average(self, average, sample):
+        return sample if average is None else average + (sample - average) * self.smoothing
+
+    def observe_query(self, seconds):
+        """Feed back the time a query took the server to answer, regardless of its size."""
+        with self._lock:
+            self.overhead = self._average(self.overhead or None, seconds)
+
+    def observe(self, events, size, seconds):
+        """Feed back a bin of events downloaded to a file of size bytes in seconds."""
+        if events <= 0:
+            return
+        with self._lock:
+            self.bytes_per_event = self._average(self.bytes_per_event, size / float(events))
+            self.seconds_per_event = self._average(self.seconds_per_event, max(0.0, seconds - self.overhead) / events)
+
+    def __call__(self, bin=None):
+        """The suggested quantity of events per bin; the bin it's asked for makes no difference."""
+        limit = self.maximum
+        with self._lock:
+            if self.target_bytes and self.bytes_per_event:
+                limit = min(limit, self.target_bytes / self.bytes_per_event)
+            if self.target_seconds and self.seconds_per_event:
+                limit = min(limit, max(0.0, self.target_seconds - self.overhead) / self.seconds_per_event)
+        return max(self.minimum, int(limit))
+
+    def __repr__(self):
+        return '{cls}(current={c!r}, bytes_per_event={x.bytes_per_event!r}, seconds_per_event={x.seconds_per_event!r}, overhead={x.overhead!r})'.format(
+            cls=self.__class__.__name__, c=self(), x=self)
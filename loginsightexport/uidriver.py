@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+import time
 from urllib.parse import urlunparse, urlparse
 from . import USERAGENT
 import requests
 import warnings
 from requests.compat import cookielib
+from loginsightexport.throttle import Throttle
 
 
 # Copyright © 2017 VMware, Inc. All Rights Reserved.
@@ -46,6 +49,14 @@ def default_user_agent():
     return "loginsightexporter"
 
 
+def decode_payload(response):
+    """Read a response's entire body, and interpret it as JSON if possible or as text otherwise."""
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
+
+
 def csrf(session, url, **kwargs):
     """Populate the CSRF header for an upcoming POST/DELETE HTTP request to an Action Bean."""
     logger.debug("Retrieving CSRF token for {0}".format(url))
@@ -62,15 +73,27 @@ class Credentials(requests.auth.AuthBase):
     """A JSESSIONID cookie is included in each HTTP request.
     Based on http://docs.python-requests.org/en/master/_modules/requests/auth/"""
 
-    def __init__(self, username, password, provider, reuse_session=None):
+    def __init__(self, username, password, provider, reuse_session=None, session=None, on_login=None,
+                 session_ttl=None, session_age=0, clock=time.monotonic):
+        """
+        session, if given, is the cookie jar of an earlier session to try first, session_age seconds old; on_login(cookies)
+        is called after each login. If session_ttl is given, a session is replaced by a new login once it's been in use
+        for most of that many seconds, instead of waiting for a request to be refused.
+        """
         self.username = username
         self.password = password
         self.provider = provider
         self._requests_session = reuse_session or requests.Session()
-        self.sessionId = None
-
-    def get_session(self, previousresponse, **kwargs):
-        """Perform a session login and return a new cookiejar containing a JSESSIONID."""
+        self.sessionId = session
+        self.on_login = on_login
+        self.session_ttl = session_ttl
+        self._clock = clock
+        self._logged_in_at = clock() - session_age
+        self._csrf_token = None  # Reused for every request with side-effects until the server refuses it
+        self._login_lock = threading.Lock()  # Logins share the session's headers, so parallel requests take turns
+        self._csrf_lock = threading.Lock()
+
+    def _login_form(self):
         if self.username is None or self.password is None:
             raise Unauthorized("Cannot authenticate without username/password")
         logger.info("Attempting to authenticate as {0}".format(self.username))
@@ -78,6 +101,33 @@ class Credentials(requests.auth.AuthBase):
         authdict = {"username": self.username, "password": self.password, "authMethod": self.provider, '_eventName': 'loginAjax'}
         if authdict['authMethod'] == "Local":
             authdict['authMethod'] = "DEFAULT"  # UI refers to "Local" accounts as from the "DEFAULT" provider.
+        return authdict
+
+    def _login_succeeded(self, authresponse):
+        """Return the new session's cookiejar from a /login response, or raise Unauthorized."""
+        try:
+            if authresponse.json()['succ']:
+                self._requests_session.cookies.update(authresponse.cookies)
+                return authresponse.cookies
+        except Exception as e:
+            logger.exception("Can't parse authresponse JSON: {0}".format(authresponse.text))
+
+        if authresponse.headers.get("pi_requires_login", 'false') == 'true':
+            raise Unauthorized("Authentication failed, got header pi_requires_login:true")
+        raise Unauthorized("Authentication failed")
+
+    def _logged_in(self, cookies):
+        """Switch to a new session. Call with self._login_lock held."""
+        self.sessionId = cookies
+        self._requests_session.cookies.update(cookies)
+        self._logged_in_at = self._clock()
+        self._csrf_token = None  # Tokens belong to a session
+        if self.on_login is not None:
+            self.on_login(cookies)
+
+    def get_session(self, previousresponse, **kwargs):
+        """Perform a session login and return a new cookiejar containing a JSESSIONID."""
+        authdict = self._login_form()
 
         prep = previousresponse.request.copy()
 
@@ -97,17 +147,70 @@ class Credentials(requests.auth.AuthBase):
         # logger.debug("Authentication request: {prep.url}\n  cookies: {session.cookies}\n  headers: {prep.headers}\n  body: {prep.body}".format(session=self._requests_session, prep=prep))
         authresponse = previousresponse.connection.send(prep, **kwargs)  # kwargs contains ssl _verify
         # logger.debug("Got authresponse:\n  cookies: {a.cookies}\n  headers: {a.headers}\n  body: {a.text}".format(a=authresponse))
+        return self._login_succeeded(authresponse)
+
+    def _expiring(self):
+        # Whether the server expires sessions some time after login or some time after their last use, one this old is
+        # about to be refused; log in again with a little to spare.
+        return self.sessionId and self.session_ttl and self._clock() - self._logged_in_at > self.session_ttl * 0.9
+
+    def refresh(self, url):
+        """Log in again, ahead of the current session's expiry, to the server which url is on."""
+        p = urlparse(url)
+        login_url = urlunparse([p.scheme, p.netloc, "/login", None, None, None])
+        with self._login_lock:
+            if not self._expiring():
+                return  # Another request got here first
+            logger.debug("Session is {0:.0f}s old, logging in again before it expires".format(self._clock() - self._logged_in_at))
+            headers = {
+                CSRFHEADER: csrf(self._requests_session, login_url),
+                "X-Requested-With": "XMLHttpRequest",
+                'User-Agent': default_user_agent(),
+                "Referer": login_url
+            }
+            try:
+                authresponse = self._requests_session.post(login_url, data=self._login_form(), headers=headers, allow_redirects=False)
+                self._logged_in(self._login_succeeded(authresponse))
+            except (requests.exceptions.RequestException, Unauthorized):
+                # The session is still good, and a refused request would log in anyway; don't hold every request up
+                # trying again, until a tenth of session_ttl from now.
+                self._logged_in_at = self._clock() - self.session_ttl * 0.8
+                raise
+
+    def csrf_token(self, url):
+        """The CSRF token for a request with side-effects, fetched once per session."""
+        with self._csrf_lock:
+            if self._csrf_token is None:
+                self._csrf_token = csrf(self._requests_session, url)
+            return self._csrf_token
+
+    def _replay(self, r, **kwargs):
+        """Send a copy of r's request again, with the session's current cookies and CSRF token."""
+        prep = r.request.copy()
+
+        prep.headers.update({
+            "X-Requested-With": "XMLHttpRequest",
+            'User-Agent': default_user_agent(),
+            "Referer": prep.url
+        })
+
+        # Add CSRF header to methods with side-effects
+        if prep.method not in ["GET", "HEAD", "OPTIONS"]:
+            prep.headers[CSRFHEADER] = self.csrf_token(prep.url)
 
         try:
-            if authresponse.json()['succ']:
-                self._requests_session.cookies.update(authresponse.cookies)
-                return authresponse.cookies
-        except Exception as e:
-            logger.exception("Can't parse authresponse JSON: {0}".format(authresponse.text))
+            del prep.headers['Cookie']
+        except KeyError:
+            pass
+        prep.prepare_cookies(self._requests_session.cookies)
 
-        if authresponse.headers.get("pi_requires_login", 'false') == 'true':
-            raise Unauthorized("Authentication failed, got header pi_requires_login:true")
-        raise Unauthorized("Authentication failed")
+        logger.debug("Replay request: {prep.url}".format(prep=prep))
+        # logger.debug("  cookies: {prep._cookies}\n  headers: {prep.headers}\n  body: {prep.body}".format(prep=prep))
+        replay_response = r.connection.send(prep, **kwargs)
+        replay_response.history.append(r)
+        replay_response.request = prep
+        # logger.debug("Replay response:\n  cookies: {a.cookies}\n  headers: {a.headers}\n  body: {a.text}".format(a=replay_response))
+        return replay_response
 
     def handle_401(self, r, **kwargs):
         # method signature matches requests.Request.register_hook
@@ -117,6 +220,16 @@ class Credentials(requests.auth.AuthBase):
             logger.debug("Not authenticated (got header pi_requires_login: {0})".format(r.headers.get("pi_requires_login")))
             internal_status = 401  # If we got back a pi_requires_login=true header, pretend that it was an HTTP/401
 
+        if internal_status == 403 and CSRFHEADER in r.request.headers and not r.history:
+            # A reused CSRF token may have been refused. Fetch a fresh one and try once more, without logging in again.
+            with self._csrf_lock:
+                if self._csrf_token == r.request.headers[CSRFHEADER]:
+                    self._csrf_token = None
+            logger.debug("Got status 403 @ {r.request.url}, replaying with a new CSRF token".format(r=r))
+            r.content
+            r.raw.release_conn()
+            return self._replay(r, **kwargs)
+
         if internal_status not in [401, 440, 404]:
             return r
 
@@ -125,36 +238,13 @@ class Credentials(requests.auth.AuthBase):
         # r.close()
         r.raw.release_conn()
 
-        self.sessionId = self.get_session(r, **kwargs)
-        self._requests_session.cookies.update(self.sessionId)
+        with self._login_lock:
+            self._logged_in(self.get_session(r, **kwargs))
 
         logger.debug("Got new sessionId, replaying request with it: {0}".format(self.sessionId))
 
         # Now that we have a good session, copy and retry the original request. If it fails again, raise Unauthorized.
-        prep = r.request.copy()
-
-        prep.headers.update({
-            "X-Requested-With": "XMLHttpRequest",
-            'User-Agent': default_user_agent(),
-            "Referer": prep.url
-        })
-
-        # Add CSRF header to methods with side-effects
-        if prep.method not in ["GET", "HEAD", "OPTIONS"]:
-            prep.headers[CSRFHEADER] = csrf(self._requests_session, prep.url)  # kwargs contains ssl _verify
-
-        try:
-            del prep.headers['Cookie']
-        except KeyError:
-            pass
-        prep.prepare_cookies(self._requests_session.cookies)
-
-        logger.debug("Replay request: {prep.url}".format(prep=prep))
-        # logger.debug("  cookies: {prep._cookies}\n  headers: {prep.headers}\n  body: {prep.body}".format(prep=prep))
-        replay_response = r.connection.send(prep, **kwargs)
-        replay_response.history.append(r)
-        replay_response.request = prep
-        # logger.debug("Replay response:\n  cookies: {a.cookies}\n  headers: {a.headers}\n  body: {a.text}".format(a=replay_response))
+        replay_response = self._replay(r, **kwargs)
 
         if replay_response.status_code in [401, 440]:
             raise Unauthorized("Authentication failed", replay_response)
@@ -164,9 +254,13 @@ class Credentials(requests.auth.AuthBase):
         return replay_response
 
     def __call__(self, r):
-        # TODO: If the TTL has expired, or we have no Bearer token at all, we can reasonably expect this
-        # TODO.cont: request to fail with 401. In both cases, we could avoid a round-trip to the server.
-        # TODO.cont: This is an optimization and does not materially affect success.
+        if self._expiring():
+            # Rather than have this request refused, and replayed after logging in, log in first.
+            try:
+                self.refresh(r.url)
+            except (requests.exceptions.RequestException, Unauthorized) as e:
+                logger.warning("Couldn't log in again ahead of the session's expiry: {0}".format(e))
+
         if hasattr(self, 'sessionId') and self.sessionId:
             # If we already have a Session ID cookie, try to use it.
             # If the cookie isn't valid, it'll force a re-login just like a missing one would.
@@ -175,7 +269,7 @@ class Credentials(requests.auth.AuthBase):
 
         # Add CSRF header to methods with side-effects
         if r.method not in ["GET", "HEAD", "OPTIONS"]:
-            r.headers[CSRFHEADER] = csrf(self._requests_session, r.url)  # kwargs contains ssl _verify
+            r.headers[CSRFHEADER] = self.csrf_token(r.url)
 
         # The two above processes have updated the session's cookies. Recreate the Cookie header from them.
         try:
@@ -188,6 +282,10 @@ class Credentials(requests.auth.AuthBase):
         r.register_hook('response', self.handle_401)
         return r
 
+    def copy(self):
+        """Credentials for the same account which haven't logged in yet, for a connection with a session of its own."""
+        return self.__class__(self.username, self.password, self.provider, session_ttl=self.session_ttl, clock=self._clock)
+
     def __repr__(self):
         return '{cls}(username={x.username!r}, password=..., provider={x.provider!r})'.format(cls=self.__class__.__name__, x=self)
 
@@ -207,7 +305,7 @@ class Connection(object):
     obtains a session bearer token and retries the request.
     You should probably use the :py:class:: Server class instead"""
 
-    def __init__(self, hostname, port=443, ssl=True, verify=True, auth=None, existing_session=None):
+    def __init__(self, hostname, port=443, ssl=True, verify=True, auth=None, existing_session=None, throttle=None, timeout=None):
         self._requestsession = existing_session or requests.Session()
         self._requestsession.cookies.set_policy(BlockPIDLTokenCookies())
         self._hostname = hostname
@@ -217,6 +315,10 @@ class Connection(object):
         self._requestsession.verify = verify
         self._verify = verify
         self._authprovider = auth
+        self._throttle = throttle or Throttle()  # Paces requests, and learns from each response whether the server is congested
+        # Seconds to wait for a streamed response to start, or for each read of its body, before giving up; None waits
+        # forever. Other requests only give up connecting after this long: a query sends nothing until it's done.
+        self._timeout = timeout
 
         self._apiroot = '{method}://{hostname}:{port}'.format(method='https' if ssl else 'http',
                                                                      hostname=hostname, port=port)
@@ -229,38 +331,52 @@ class Connection(object):
         logger.debug("Created {0}".format(self))
 
     @classmethod
-    def copy_connection(cls, connection):
-        return cls(hostname=connection._hostname,
-                   port=connection._port,
+    def copy_connection(cls, connection, existing_session=None, hostname=None, port=None):
+        """
+        A connection to the same server, or to another node of its cluster at hostname:port. Given existing_session, it
+        uses that session instead and logs in separately.
+        """
+        auth = connection._authprovider
+        if existing_session is not None and auth is not None:
+            auth = auth.copy()
+        return cls(hostname=hostname or connection._hostname,
+                   port=port or connection._port,
                    ssl=connection._ssl,
                    verify=connection._verify,
-                   auth=connection._authprovider,
-                   existing_session=connection._requestsession)
+                   auth=auth,
+                   existing_session=existing_session or connection._requestsession,
+                   throttle=connection._throttle,
+                   timeout=connection._timeout)
 
     def _call(self, method, url, data=None, json=None, params=None, sendauthorization=True, stream=False):
-        r = self._requestsession.request(
-            method=method,
-            url=self._apiroot + url,
-            data=data,
-            json=json,
-            verify=self._verify,
-            auth=self._authprovider if sendauthorization else None,
-            params=params,
-            stream=stream,
-            allow_redirects=False,
-            headers={
-                'X-Requested-With': 'XMLHttpRequest',
-                'User-Agent': default_user_agent()
-            }
-        )
+        started_at = self._throttle.before_request()
         try:
-            payload = r.json()
-        except:
-            payload = r.text
+            r = self._requestsession.request(
+                method=method,
+                url=self._apiroot + url,
+                data=data,
+                json=json,
+                verify=self._verify,
+                auth=self._authprovider if sendauthorization else None,
+                params=params,
+                stream=stream,
+                timeout=self._timeout if stream or self._timeout is None else (self._timeout, None),
+                allow_redirects=False,
+                headers={
+                    'X-Requested-With': 'XMLHttpRequest',
+                    'User-Agent': default_user_agent()
+                }
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.RetryError) as e:
+            self._throttle.after_response(started_at, error=e, kind=urlparse(url).path)
+            raise
+        self._throttle.after_response(started_at, response=r, kind=urlparse(url).path)  # Each endpoint is timed against itself
+        # Only headers have been read so far. The body is left for the caller, which lets a stream=True download
+        # flow straight from the socket to disk instead of being buffered here first.
         if 'Warning' in r.headers:
             warnings.warn(TechPreviewWarning(url, r.headers.get('Warning')), stacklevel=3)
         if r.status_code in [401, 440]:
-            raise Unauthorized(r.status_code, payload)
+            raise Unauthorized(r.status_code, decode_payload(r))
         return r
 
     def post(self, url, data=None, json=None, params=None, sendauthorization=True):
@@ -306,8 +422,8 @@ class Connection(object):
                           sendauthorization=sendauthorization,
                           params=params)
 
-    def log(self, message, includeuseragent=True):
-        """Emit a log message into ui_runtime.log on the remote server."""
+    def log(self, message, includeuseragent=True, echo=True):
+        """Emit a log message into ui_runtime.log on the remote server, and unless echo is False, into the local log."""
         srvmessage = message if not includeuseragent else "%s %s" % (USERAGENT, message)
         response = self.post("/internal/logger", data={
             b"logMessage": srvmessage,
@@ -317,7 +433,8 @@ class Connection(object):
         serverlogger = logger.getChild("ServerLogger").getChild("ui_runtime.log")
         if response.status_code != 200:
             serverlogger.warning("Attempt to log to server failed with HTTP status %d" % response.status_code)
-        serverlogger.info(msg=message)
+        if echo:
+            serverlogger.info(msg=message)
         return response.status_code == 200
 
     def ping(self):
@@ -398,16 +515,22 @@ class AggregateQuery(object):
             raise RuntimeError("This query produced zero groupings. Set the query to group by time only.")
         if len(body['groupByHeaders']) != 1:
             raise RuntimeError("This query produced multiple groupings (%s). Set the query to group by time only." % body['groupByHeaders'])
-        if not body['groupByHeaders'][0]['isTime']:
-            raise RuntimeError("This query is grouped by something other than time. Set the query to group by time only.")
+        self.check_grouping(body['groupByHeaders'][0])
 
         for k, v in body.items():
             setattr(self, k, v)
 
-        self.bins = [(x['groupByValues'][0]['val'], x['groupByValues'][0]['endVal'], x['aggregationValues'][0]) for x in body['rows']]
+        self.parse_rows(body['rows'])
 
         logger.debug("Retrieved results: {0}".format(self))
 
+    def check_grouping(self, header):
+        if not header['isTime']:
+            raise RuntimeError("This query is grouped by something other than time. Set the query to group by time only.")
+
+    def parse_rows(self, rows):
+        self.bins = [(x['groupByValues'][0]['val'], x['groupByValues'][0]['endVal'], x['aggregationValues'][0]) for x in rows]
+
     def __repr__(self):
         """Human-readable representation of query result summary."""
         return '<{cls}: elapsed={x.elapsed}, {lenbins} bins containing {n} events>'.format(
@@ -416,3 +539,22 @@ class AggregateQuery(object):
             lenbins=len(self.bins),
             n=sum([b[2] for b in self.bins])
         )
+
+
+class FieldAggregateQuery(AggregateQuery):
+    """Given a url like /logcharting?paramsHelper... grouped by a single field instead of time, produce (value, count) groups"""
+
+    def check_grouping(self, header):
+        if header['isTime']:
+            raise RuntimeError("This query is grouped by time, expected a field.")
+
+    def parse_rows(self, rows):
+        self.groups = [(x['groupByValues'][0]['val'], x['aggregationValues'][0]) for x in rows]
+
+    def __repr__(self):
+        return '<{cls}: elapsed={x.elapsed}, {n} groups containing {e} events>'.format(
+            cls=self.__class__.__name__,
+            x=self,
+            n=len(self.groups),
+            e=sum([g[1] for g in self.groups])
+        )
@@ -89,6 +89,23 @@ def identifiers_for_test_parameters(val):
     return str(val).replace(".", "_")
 
 
+class FakeClock(object):
+    """Stands in for time.time or time.monotonic, and time.sleep: time only passes when the test says so."""
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
 def checkfile(fspath):
     errors = []
     body = fspath.read()
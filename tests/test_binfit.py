@@ -2,10 +2,14 @@
 
 from __future__ import division
 
+import bisect
+import collections
 import pytest
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from loginsightexport.binfit import map_dict_to_list, sorted_by_startTimeMillis, overlapping, split, merge, patch_bins_at_boundaries
+from loginsightexport.binfit import anchored_target, map_dict_to_list, sorted_by_startTimeMillis, overlapping, split, split_by_level, split_by_density, estimate_split_requests, \
+    windows, contiguous, merge, pack, partition, patch_bins_at_boundaries, IndivisibleBin
 from itertools import tee
 
 
@@ -180,6 +184,57 @@ def test_bins_should_not_merge(bins, maximum, name):
     assert untouched == bins
 
 
+def test_merge_nothing():
+    assert list(merge([], maximum=20)) == []
+
+
+def test_merge_is_incremental():
+    def source():
+        yield (100, 199, 9)
+        yield (200, 299, 8)
+        yield (300, 399, 7)
+        raise AssertionError("merge read further than it needed to")
+
+    assert next(merge(source(), maximum=20)) == (100, 299, 17)
+
+
+@pytest.mark.parametrize("bins, maximum, expected, name", [
+    ([(100, 199, 10), (200, 299, 1), (300, 399, 10), (400, 499, 1)], 20, [(100, 299, 11), (300, 499, 11)], "balanced pair"),
+    ([(100 * i, 100 * i + 99, 1) for i in range(1, 7)], 5, [(100, 399, 3), (400, 699, 3)], "short tail"),
+    ([(100, 199, 5), (200, 299, 5), (400, 499, 5), (500, 599, 5)], 20, [(100, 299, 10), (400, 599, 10)], "gap"),
+    ([(100, 199, 5), (200, 299, 99), (300, 399, 5)], 20, [(100, 199, 5), (200, 299, 99), (300, 399, 5)], "oversized"),
+    ([], 20, [], "nothing"),
+], ids=str)
+def test_pack(bins, maximum, expected, name):
+    del name  # unused variable, only for naming the test
+
+    assert list(pack(bins, maximum=maximum)) == expected
+
+
+def test_pack_uses_as_few_bins_as_merge_but_evener():
+    bins = [(i * 10, i * 10 + 9, n) for i, n in enumerate([7, 3, 9, 1, 1, 8, 2, 6, 4, 9, 9, 1, 5, 5, 3, 7, 2, 8, 6, 4])]
+    merged = list(merge(bins, maximum=20))
+    packed = list(pack(bins, maximum=20))
+
+    assert len(packed) == len(merged)
+    assert max(b[2] for b in packed) <= max(b[2] for b in merged)
+    assert max(b[2] for b in packed) - min(b[2] for b in packed) < max(b[2] for b in merged) - min(b[2] for b in merged)
+    assert_binsize_remained_the_same(bins, packed)
+    assert contiguous(packed)
+
+    def assert_only(*unused):
+        raise RuntimeError("Unsplit buckets still exceed maximum")
+    assert list(split(packed, assert_only, maximum=20)) == packed
+
+
+def test_pack_balances_for_concurrency():
+    bins = [(i * 10, i * 10 + 9, 2) for i in range(12)]
+    assert len(list(pack(bins, maximum=20))) == 2
+    packed = list(pack(bins, maximum=20, concurrency=4))
+    assert [b[2] for b in packed] == [6, 6, 6, 6]
+    assert len(list(pack(bins[:2], maximum=20, concurrency=4))) == 2  # Can't divide further than the bins
+
+
 @pytest.mark.parametrize("bins, overview, expected, name", [
     ([(1, 5, 2), (6, 10, 3)], (-100, 100, None), [(1, 5, 2), (6, 10, 3)], "superset of all bins (sparse response)"),
     ([(1, 5, 2), (6, 10, 3)], (1, 10, None), [(1, 5, 2), (6, 10, 3)], "perfectly aligned already"),
@@ -193,3 +248,186 @@ def test_patch_bins_at_boundaries(bins, overview, expected, name):
 
     r = list(patch_bins_at_boundaries(bins=bins, boundary_bin=overview))
     assert r == expected
+
+
+def halving_fetch_subset_fn(bin, report_callback=False):
+    del report_callback  # unused variable, only present for mocking
+    halfway_time = (bin[0] + bin[1]) / 2
+    halfway_value = bin[2] / 2
+    return [(bin[0], halfway_time, halfway_value), (halfway_time, bin[1], halfway_value)]
+
+
+@pytest.mark.parametrize("bins, maximum", [
+    ([(80, 180, 60), (180, 280, 3), (280, 380, 5)], 20),
+    ([(0, 1, 1000)], 10),
+    ([(0, 1, 10), (1, 2, 10), (2, 3, 10)], 20),
+    ([(0, 1, 20), (1, 2, 10), (2, 3, 10)], 15),
+    ([(0, 1, 10), (1, 2, 10), (2, 3, 20)], 15),
+    ([(0, 1, 40), (1, 2, 1), (2, 3, 90)], 15),
+], ids=str)
+def test_split_by_level_matches_split(bins, maximum):
+    depth_first = list(split(bins, halving_fetch_subset_fn, maximum))
+
+    assert list(split_by_level(bins, halving_fetch_subset_fn, maximum)) == depth_first
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert list(split_by_level(bins, halving_fetch_subset_fn, maximum, map_fn=pool.map)) == depth_first
+
+
+def test_split_by_level_batches_each_level():
+    batches = []
+
+    def recording_map(fn, iterable):
+        items = list(iterable)
+        batches.append(len(items))
+        return map(fn, items)
+
+    list(split_by_level([(0, 1, 16), (1, 2, 16)], halving_fetch_subset_fn, 2, map_fn=recording_map))
+    assert batches == [2, 4, 8]
+
+
+@pytest.mark.parametrize("fetch_subset_fn, message", [
+    (lambda b: [b], "won't subdivide"),
+    (lambda b: [(b[0], b[1], b[2] - 1)], "expanded bin"),
+], ids=str)
+def test_split_by_level_indivisible(fetch_subset_fn, message):
+    with pytest.raises(IndivisibleBin) as e:
+        list(split_by_level([(0, 10, 50)], fetch_subset_fn, 20))
+    assert message in str(e.value)
+
+
+class HistogramServer(object):
+    """Answers chart requests over a fixed set of event timestamps with four equal-width buckets, counting requests."""
+    def __init__(self, timestamps, buckets=4):
+        self.timestamps = sorted(timestamps)
+        self.buckets = buckets
+        self.requests = 0
+
+    def fetch(self, bin, report_callback=False):
+        self.requests += 1
+        return [(w[0], w[1], bisect.bisect_right(self.timestamps, w[1]) - bisect.bisect_left(self.timestamps, w[0])) for w in windows(bin, self.buckets)]
+
+
+# Mostly sparse, with a dense burst in the middle
+BURSTY = list(range(0, 100000, 50)) + [50000 + i // 20 for i in range(20000)]
+
+
+def test_windows_are_contiguous():
+    for quantity in (1, 3, 7, 1000, 5000):
+        w = windows((10, 1009, 0), quantity)
+        assert w[0][0] == 10 and w[-1][1] == 1009
+        assert contiguous(w)
+        assert len(w) == min(quantity, 1000)
+
+
+@pytest.mark.parametrize("maximum", [100, 500, 5000])
+def test_split_by_density_fits_maximum(maximum):
+    server = HistogramServer(BURSTY)
+    overview = server.fetch((0, 99999, 0))
+    stats = collections.Counter()
+    bins = list(split_by_density(overview, server.fetch, maximum, stats=stats))
+
+    assert contiguous(bins)
+    assert bins[0][0] == 0 and bins[-1][1] == 99999
+    assert sum(b[2] for b in bins) == len(BURSTY)
+    assert all(b[2] <= maximum for b in bins)
+    assert stats['requests'] == server.requests - 1
+
+    split_server = HistogramServer(BURSTY)
+    split_bins = list(split(split_server.fetch((0, 99999, 0)), split_server.fetch, maximum))
+    requests, rounds = estimate_split_requests(overview, bins, maximum)
+    split_rounds = depth(HistogramServer(BURSTY), maximum)
+    assert requests == pytest.approx(split_server.requests - 1, rel=0.25)
+    assert abs(rounds - split_rounds) <= 1  # Interpolated counts sit right at the maximum for some ranges
+    assert stats['levels'] < split_rounds
+    assert sum(b[2] for b in split_bins) == len(BURSTY)
+
+
+def depth(server, maximum):
+    """Rounds of requests split() needs: one per level of the tree below the overview."""
+    levels = 0
+    level = server.fetch((0, 99999, 0))
+    while any(b[2] > maximum for b in level):
+        levels += 1
+        level = [n for b in level for n in (server.fetch(b) if b[2] > maximum else [b])]
+    return levels
+
+
+def test_split_by_density_indivisible():
+    server = HistogramServer([5] * 100)
+    with pytest.raises(IndivisibleBin) as e:
+        list(split_by_density([(0, 10, 100)], server.fetch, 20))
+    assert "0ms long" in str(e.value)
+
+
+def test_paginate_leaves_dense_milliseconds_whole():
+    server = HistogramServer([5] * 100 + list(range(10, 20)))
+    for splitter in (split, split_by_level, split_by_density):
+        bins = list(splitter([(0, 19, 110)], server.fetch, 20, paginate=True))
+        assert (5, 5, 100) in bins
+        assert all(b[2] <= 20 for b in bins if b[0] != b[1])
+        assert_binsize_remained_the_same([(0, 19, 110)], bins)
+
+
+HOSTS = {"web1": 15, "web2": 12, "db": 3}
+
+
+def test_partition_by_field():
+    bins = [(1, 4, 10), (5, 5, 30), (6, 9, 10)]
+    calls = []
+
+    def fetch_groups(b, field):
+        calls.append((b, field))
+        return list(HOSTS.items()) + [("idle", 0)]
+
+    partitioned = list(partition(bins, fetch_groups, "hostname", maximum=20))
+    assert calls == [((5, 5, 30), "hostname")]
+    assert partitioned == [(1, 4, 10), (5, 5, 3, ("hostname", "db")), (5, 5, 15, ("hostname", "web1")), (5, 5, 12, ("hostname", "web2")), (6, 9, 10)]
+    assert_binsize_remained_the_same(bins, partitioned)
+
+    # Partitions are never merged with their neighbours, or each other
+    assert list(merge(partitioned, maximum=100)) == [(1, 4, 10)] + partitioned[1:4] + [(6, 9, 10)]
+    assert list(pack(partitioned, maximum=100)) == [(1, 4, 10)] + partitioned[1:4] + [(6, 9, 10)]
+
+
+def test_partition_must_account_for_every_event():
+    def fetch_groups(b, field):
+        return [("web1", 15)]  # The other events have no hostname
+
+    assert list(partition([(5, 5, 30)], fetch_groups, "hostname", maximum=20, paginate=True)) == [(5, 5, 30)]
+    with pytest.raises(IndivisibleBin) as e:
+        list(partition([(5, 5, 30)], fetch_groups, "hostname", maximum=20))
+    assert "accounts for 15 of its 30" in str(e.value)
+
+
+def test_merge_follows_target():
+    bins = [(i * 10, i * 10 + 9, 5) for i in range(8)]
+    targets = iter([20, 20, 20, 10, 10, 10, 10])
+    assert list(merge(bins, maximum=20, target=lambda b: next(targets))) == [(0, 39, 20), (40, 59, 10), (60, 79, 10)]
+    assert list(merge(bins, maximum=10, target=lambda b: 100)) == [(0, 19, 10), (20, 39, 10), (40, 59, 10), (60, 79, 10)]
+
+
+def test_merge_reproduces_anchored_ranges():
+    bins = [(i * 10, i * 10 + 9, 5) for i in range(8)]
+    assert list(merge(bins, maximum=20, target=lambda b: 5, anchors={10: 39, 50: 69})) == [
+        (0, 9, 5), (10, 39, 15), (40, 49, 5), (50, 69, 10), (70, 79, 5)]
+
+
+def test_split_follows_target():
+    server = HistogramServer(range(0, 1000, 10))
+    bins = list(split([(0, 999, 100)], server.fetch, maximum=100, target=lambda b: 10))
+    assert all(b[2] <= 10 for b in bins)
+    assert_binsize_remained_the_same([(0, 999, 100)], bins)
+
+    # A bin the server won't subdivide is left over the target, as long as it's within the maximum
+    assert list(split([(5, 5, 30)], lambda b: [b], maximum=100, target=lambda b: 10)) == [(5, 5, 30)]
+
+
+def test_anchored_target_retraces_earlier_divisions():
+    server = HistogramServer(range(0, 1000, 10))
+    first = list(merge(split([(0, 999, 100)], server.fetch, maximum=100, target=lambda b: 10), maximum=100, target=lambda b: 10))
+    anchors = {b[0]: b[1] for b in first}
+
+    # Knowing nothing yet, the target would leave the bin whole; the anchors divide and merge it as before
+    target = anchored_target(lambda b: 100, anchors)
+    assert list(merge(split([(0, 999, 100)], server.fetch, maximum=100, target=target), maximum=100, target=target, anchors=anchors)) == first
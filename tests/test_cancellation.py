@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from loginsightexport.cancellation import OutstandingQueries, untracked
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+class FakeResponse(object):
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+
+class FakeConnection(object):
+    """Issues cancel tokens t1, t2, ... from /logcancel, and records the ones cancelled."""
+    def __init__(self, supported=True):
+        self.supported = supported
+        self.issued = 0
+        self.asked = 0
+        self.cancelled = []
+
+    def get(self, url, params=None):
+        assert url == '/logcancel'
+        self.asked += 1
+        if not self.supported:
+            return FakeResponse({"errorMessage": "Not found"}, status_code=404)
+        self.issued += 1
+        return FakeResponse({"cancelToken": "t{0}".format(self.issued)})
+
+    def post(self, url, data=None):
+        self.cancelled.append(data["cancelToken"])
+        return FakeResponse({"succ": True})
+
+
+def test_finished_query_is_not_cancelled():
+    connection = FakeConnection()
+    queries = OutstandingQueries(connection)
+    with queries.track() as token:
+        assert token == "t1"
+    queries.cancel_all()
+    assert connection.cancelled == []
+
+
+def test_query_is_cancelled_when_its_request_fails():
+    connection = FakeConnection()
+    queries = OutstandingQueries(connection)
+    with pytest.raises(KeyboardInterrupt):
+        with queries.track():
+            raise KeyboardInterrupt()
+    assert connection.cancelled == ["t1"]
+    assert queries.cancelled == 1
+
+
+def test_cancel_all_cancels_outstanding_queries_once():
+    connection = FakeConnection()
+    queries = OutstandingQueries(connection)
+    first, second, third = queries.token(), queries.token(), queries.token()
+    queries.finished(second)
+    queries.cancel(third)
+    queries.cancel_all()
+    queries.cancel_all()
+    assert sorted(connection.cancelled) == [first, third]
+
+
+def test_server_without_cancel_tokens_is_asked_less_and_less_often(clock):
+    connection = FakeConnection(supported=False)
+    queries = OutstandingQueries(connection, retry_after=5, maximum_retry_after=20, clock=clock)
+    for _ in range(3):
+        with queries.track() as token:
+            assert token is None
+    assert connection.asked == 1
+
+    asked = []
+    for _ in range(60):
+        clock.now += 1
+        assert queries.token() is None
+        asked.append(connection.asked)
+    assert [n for i, n in enumerate(asked) if i == 0 or n != asked[i - 1]] == [1, 2, 3, 4, 5]  # After 5, 10, 20, then 20s
+    queries.cancel_all()
+    assert connection.cancelled == []
+
+
+def test_cancel_tokens_are_asked_for_again_once_the_server_recovers(clock):
+    connection = FakeConnection(supported=False)
+    queries = OutstandingQueries(connection, retry_after=5, clock=clock)
+    assert queries.token() is None
+    connection.supported = True
+    assert queries.token() is None  # Not yet
+    clock.now += 5
+    assert queries.token() == "t1"
+    assert queries.token() == "t2"
+
+
+def test_untracked_query_has_no_token():
+    with untracked() as token:
+        assert token is None
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+
+from loginsightexport.uidriver import Connection
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Answers every GET after DELAY seconds, as a server does a query over a wide time range."""
+    DELAY = 0.5
+
+    def do_GET(self):
+        time.sleep(self.DELAY)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def slow_server():
+    server = HTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_stall_timeout_only_applies_to_streamed_downloads(slow_server):
+    connection = Connection("127.0.0.1", port=slow_server.server_address[1], ssl=False, timeout=0.1)
+    assert connection.get("/logcharting").status_code == 200  # Quiet until the whole result is ready, and waited for
+
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        with contextlib.closing(connection.get("/messages", stream=True)):
+            pass
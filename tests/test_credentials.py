@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from mock_loginsight_server import MockedConnection
+from loginsightexport.uidriver import Credentials, CSRFHEADER
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+def connection(**kwargs):
+    ui = MockedConnection("mockserverlocal", auth=Credentials("admin", "password", "mock", **kwargs))
+    return ui, ui._requestsession.get_adapter("https://mockserverlocal")
+
+
+def paths(adapter):
+    return [request.path for request in adapter.request_history]
+
+
+def test_csrf_token_is_fetched_once_per_session():
+    ui, adapter = connection()
+    ui.post("/api/v1/licenses", json={"key": "A"})
+    before = paths(adapter).count("/csrf")
+    ui.post("/api/v1/licenses", json={"key": "B"})
+    ui.post("/api/v1/licenses", json={"key": "C"})
+    assert paths(adapter).count("/csrf") == before
+    assert all(request.headers[CSRFHEADER] == "secret" for request in adapter.request_history if request.path == "/api/v1/licenses")
+
+
+def test_refused_csrf_token_is_replaced_without_logging_in_again():
+    ui, adapter = connection()
+    tokens = iter(["first", "second"])
+
+    def new_token(request, context):
+        context.headers[CSRFHEADER] = next(tokens)
+        return "{}"
+
+    def check(request, context):
+        context.status_code = 200 if request.headers[CSRFHEADER] == "second" else 403
+        return "{}"
+
+    adapter.register_uri('GET', '/csrf', text=new_token)
+    adapter.register_uri('POST', '/api/v1/checked', text=check)
+    assert ui.post("/api/v1/checked").status_code == 200
+    assert paths(adapter).count("/login") == 0
+
+
+def test_session_is_renewed_before_it_expires(clock):
+    ui, adapter = connection(session_ttl=100, clock=clock)
+    assert ui.get("/api/v1/licenses").history  # Refused, then replayed after logging in
+    first = ui._authprovider.sessionId["JSESSIONID"]
+
+    clock.now += 50
+    assert not ui.get("/api/v1/licenses").history
+    assert paths(adapter).count("/login") == 1
+
+    clock.now += 45
+    assert not ui.get("/api/v1/licenses").history  # Logged in beforehand, so never refused
+    assert paths(adapter).count("/login") == 2
+    assert ui._authprovider.sessionId["JSESSIONID"] != first
+
+
+def test_failed_renewal_is_not_retried_by_every_request(clock):
+    ui, adapter = connection(session_ttl=100, clock=clock)
+    ui.get("/api/v1/licenses")
+    adapter.register_uri('POST', '/login', json={"succ": False})
+
+    clock.now += 95
+    for _ in range(5):
+        assert ui.get("/api/v1/licenses").status_code == 200  # The session it has still works
+    assert paths(adapter).count("/login") == 2
+
+    clock.now += 11
+    ui.get("/api/v1/licenses")
+    assert paths(adapter).count("/login") == 3  # Tried again, a while later
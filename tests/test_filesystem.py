@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import io
 import os.path
 import json
 import pytest
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
-from loginsightexport.files import ExportBinToFile, InconsistentFile
+import requests
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+
+from loginsightexport.lease import Leases, LeaseLost
+from loginsightexport.files import Cancelled, ExportBinToFile, InconsistentFile, SyncPolicy, bin_filename, bin_path, check_file, copy_response, count_lines, find_resume_point, output_files, preallocate, publish
 
 
 # VMware vRealize Log Insight Exporter
@@ -85,3 +93,376 @@ class TestExistingFileValidity(object):
         with pytest.raises(InconsistentFile):
             export.valid
         assert "Incorrect quantity of events, found" in caplog.text
+
+    def test_mismatched_messages(self, caplog, tmpdir, root_bin):
+        export = ExportBinToFile(root_query=None, bin=root_bin, output_directory=str(tmpdir), output_format='JSON', connection=None)
+
+        with open(export.filename, "w") as f:
+            json.dump({"from": 1, "to": root_bin[2], "hasMoreResults": False, "messages": [{"text": "x"}] * (root_bin[2] - 1)}, fp=f)
+
+        with pytest.raises(InconsistentFile):
+            export.valid
+        assert "Incorrect quantity of messages, found 54" in caplog.text
+
+    def test_truncated_json(self, caplog, tmpdir, root_bin):
+        export = ExportBinToFile(root_query=None, bin=root_bin, output_directory=str(tmpdir), output_format='JSON', connection=None)
+
+        body = json.dumps({"from": 1, "to": root_bin[2], "hasMoreResults": False, "messages": [{"text": "x"}] * root_bin[2]})
+        with open(export.filename, "w") as f:
+            f.write(body[:-10])
+
+        with pytest.raises(InconsistentFile):
+            export.valid
+        assert "Not valid JSON" in caplog.text
+
+    def test_complete_json(self, tmpdir, root_bin):
+        export = ExportBinToFile(root_query=None, bin=root_bin, output_directory=str(tmpdir), output_format='JSON', connection=None)
+
+        with open(export.filename, "w") as f:
+            json.dump({"from": 1, "to": root_bin[2], "hasMoreResults": False, "messages": [{"text": "x"}] * root_bin[2], "facetingFields": []}, fp=f)
+
+        assert export.valid
+
+    @pytest.mark.parametrize("body,expected", [(b"", 0), (b"a", 1), (b"a\n", 1), (b"a\nb", 2), (b"\n\n\n", 3)])
+    def test_count_lines(self, tmpdir, body, expected):
+        filename = str(tmpdir.join("raw"))
+        with open(filename, "wb") as f:
+            f.write(body)
+        assert count_lines(filename, block_size=2) == expected
+        with open(filename, 'rb') as f:
+            assert count_lines(filename) == sum(1 for line in f)
+
+    def test_raw_too_few_lines(self, caplog, tmpdir, root_bin):
+        export = ExportBinToFile(root_query=None, bin=root_bin, output_directory=str(tmpdir), output_format='RAW', connection=None)
+
+        with open(export.filename, "w") as f:
+            f.write("line\n" * (root_bin[2] - 1))
+
+        with pytest.raises(InconsistentFile):
+            export.valid
+        assert "Incorrect quantity of events, should be 55" in caplog.text
+
+    def test_check_file_in_process_pool(self, tmpdir, root_bin):
+        good, bad, missing = (str(tmpdir.join(name)) for name in ("good", "bad", "missing"))
+        with open(good, "w") as f:
+            json.dump({"hasMoreResults": False, "to": root_bin[2]}, fp=f)
+        with open(bad, "w") as f:
+            f.write("notjson")
+
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            results = dict(pool.map(check_file, [(name, root_bin, 'JSON') for name in (good, bad, missing)]))
+
+        assert results[good] is None
+        assert isinstance(results[bad], InconsistentFile)
+        assert isinstance(results[missing], FileNotFoundError)
+
+
+class TestRetrieve(object):
+
+    def test_valid_file_is_skipped(self, tmpdir, root_bin):
+        export = ExportBinToFile(root_query=None, bin=root_bin, output_directory=str(tmpdir), output_format='JSON', connection=None)
+
+        with open(export.filename, "w") as f:
+            json.dump({"hasMoreResults": False, "to": root_bin[2]}, fp=f)
+
+        assert export.retrieve() is None
+
+    def test_inconsistent_file_is_not_overwritten(self, tmpdir, root_bin):
+        export = ExportBinToFile(root_query=None, bin=root_bin, output_directory=str(tmpdir), output_format='JSON', connection=None)
+
+        with open(export.filename, "w") as f:
+            f.write("notjson")
+
+        with pytest.raises(InconsistentFile):
+            export.retrieve()
+
+
+class FakeStreamedResponse(object):
+    def __init__(self, body):
+        self.raw = io.BytesIO(body)
+
+    def iter_content(self, chunk_size):
+        return iter(lambda: self.raw.read(chunk_size), b'')
+
+    def close(self):
+        pass
+
+
+class DroppedConnection(io.BytesIO):
+    """A response body that's cut off after `limit` bytes, by a broken connection or the given exception."""
+    def __init__(self, body, limit, error=None):
+        super(DroppedConnection, self).__init__(body[:limit])
+        self.error = error or requests.exceptions.ChunkedEncodingError("Connection broken")
+
+    def readinto(self, b):
+        n = super(DroppedConnection, self).readinto(b)
+        if not n:
+            raise self.error
+        return n
+
+
+class TestLayout(object):
+
+    def test_flat_layout(self):
+        assert bin_path((1483154191149, 1483154191200, 5)) == "output.1483154191149"
+
+    def test_hourly_layout_by_utc_start(self):
+        assert bin_path((1483154191149, 1483160000000, 5), layout="hourly") == os.path.join("2016", "12", "31", "03", "output.1483154191149")
+
+    def test_output_files_in_either_layout(self, tmpdir):
+        tmpdir.join("output.1").write("")
+        tmpdir.join("output.2.partial").write("")
+        tmpdir.join("2017", "01", "02", "03", "output.3").write("", ensure=True)
+        tmpdir.join(".loginsight-export.plancache", "output.4").write("", ensure=True)
+        assert sorted(output_files(str(tmpdir))) == sorted(["output.1", os.path.join("2017", "01", "02", "03", "output.3")])
+
+    def test_download_creates_the_hour_directory(self, tmpdir):
+        messages = [{"text": "event", "timestamp": 1483154191149, "fields": []}]
+        export = ExportBinToFile(root_query=FakeQuery(), bin=(1483154191149, 1483154191149, 1), output_directory=str(tmpdir), output_format='JSON',
+                                 connection=FakeConnection(messages), layout="hourly")
+        assert export.retrieve() is not None
+        assert tmpdir.join("2016", "12", "31", "03", "output.1483154191149").check(file=1)
+
+
+class TestWritePath(object):
+
+    @pytest.mark.parametrize("buffer_size", [1, 7, 4096, 1024 * 1024])
+    def test_copy_response(self, tmpdir, buffer_size):
+        body = os.urandom(10000)
+        with open(str(tmpdir.join("out")), "wb") as f:
+            assert copy_response(FakeStreamedResponse(body), f, buffer_size) == len(body)
+        assert tmpdir.join("out").read_binary() == body
+
+    def test_copy_response_stops_once_cancelled(self, tmpdir):
+        cancelled = threading.Event()
+        cancelled.set()
+        with open(str(tmpdir.join("out")), "wb") as f:
+            with pytest.raises(Cancelled):
+                copy_response(FakeStreamedResponse(os.urandom(10000)), f, 1024, cancelled=cancelled)
+
+    def test_preallocation_is_truncated(self, tmpdir):
+        with open(str(tmpdir.join("out")), "wb") as f:
+            preallocated = preallocate(f, 1024 * 1024)
+            f.write(b"abc")
+            if preallocated:
+                f.truncate()
+        assert tmpdir.join("out").read_binary() == b"abc"
+
+    @pytest.mark.parametrize("mode", SyncPolicy.MODES)
+    def test_sync_modes(self, tmpdir, mode):
+        sync = SyncPolicy(mode, batch_size=2)
+        for i in range(3):
+            with open(str(tmpdir.join("out%d" % i)), "wb") as f:
+                f.write(b"abc")
+                sync.completed(f)
+        sync.close()
+
+    def test_unknown_sync_mode(self):
+        with pytest.raises(ValueError):
+            SyncPolicy('sometimes')
+
+
+def export_document(messages, page=None, total=None):
+    first, last = page if page is not None else (0, len(messages))
+    total = total if total is not None else len(messages)
+    return json.dumps({"from": first + 1, "to": last, "hasMoreResults": last < total, "messages": messages, "facetingFields": []}).encode('utf-8')
+
+
+class FakeQuery(object):
+    existingChartQuery = {"eventSortOrder": "DESC"}
+
+    def messagesurl_export(self, altstart=None, altend=None, outputformat=None, page=None, constraints=(), cancel_token=None):
+        return (altstart, altend, page)
+
+
+class FakeConnection(object):
+    """Serves the events of a time range, newest first, optionally cutting off the first response. Pages unless ignore_pages."""
+    def __init__(self, messages, cut_first_at=None, ignore_pages=False, cut_error=None):
+        self.messages = messages
+        self.cut_first_at = cut_first_at
+        self.cut_error = cut_error
+        self.ignore_pages = ignore_pages
+        self.requests = []
+
+    def get(self, url, stream=False):
+        start, end, page = url
+        self.requests.append(url)
+        matching = [m for m in self.messages if start <= m["timestamp"] <= end]
+        if page is None or self.ignore_pages:
+            body = export_document(matching)
+        else:
+            body = export_document(matching[page[0]:page[1]], page=page, total=len(matching))
+        response = FakeStreamedResponse(body)
+        if self.cut_first_at is not None:
+            response.raw = DroppedConnection(body, self.cut_first_at, self.cut_error)
+            self.cut_first_at = None
+        return response
+
+
+class FakeOutstandingQueries(object):
+    """Issues cancel tokens t1, t2, ..., one per query, and records which were cancelled or finished."""
+    def __init__(self):
+        self.issued = 0
+        self.cancelled = []
+        self.finished = []
+
+    @contextlib.contextmanager
+    def track(self):
+        self.issued += 1
+        token = "t{0}".format(self.issued)
+        try:
+            yield token
+        except BaseException:
+            self.cancelled.append(token)
+            raise
+        self.finished.append(token)
+
+
+class TestResume(object):
+    BIN = (1, 100, 10)
+    # Timestamps 100, 100, 90, 90, 80, ...: events share timestamps in pairs
+    MESSAGES = [{"text": "event %d" % i, "timestamp": 100 - 10 * (i // 2), "fields": []} for i in range(10)]
+
+    def test_resume_point_drops_shared_timestamp(self, tmpdir):
+        body = export_document(self.MESSAGES)
+        filename = str(tmpdir.join("partial"))
+        cut = body.index(b'"event 4"')  # Midway through the fifth event, after both events with timestamp 90
+        with open(filename, "wb") as f:
+            f.write(body[:cut])
+
+        point = find_resume_point(filename, self.BIN)
+        assert point.events == 2  # Only the events at 100; more events at 90 might follow those written
+        assert point.timestamp == 90
+        assert not point.complete
+        assert json.loads(body[body.index(b'[') + 1:point.offset].decode('utf-8').join("[]")) == self.MESSAGES[:2]
+
+    def test_resume_point_unusable(self, tmpdir):
+        filename = str(tmpdir.join("partial"))
+        with open(filename, "wb") as f:
+            f.write(export_document(self.MESSAGES)[:40])  # Nothing past the header
+        assert find_resume_point(filename, self.BIN) is None
+        assert find_resume_point(filename, (1, 100, 11)) is None
+
+    def test_resume_point_complete(self, tmpdir):
+        filename = str(tmpdir.join("partial"))
+        with open(filename, "wb") as f:
+            f.write(export_document(self.MESSAGES))
+        assert find_resume_point(filename, self.BIN).complete
+
+    @pytest.mark.parametrize("cut", [60, 150, 300, 450])
+    def test_interrupted_download_is_resumed(self, tmpdir, cut):
+        connection = FakeConnection(self.MESSAGES, cut_first_at=cut)
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON', connection=connection)
+
+        assert export.retrieve() is not None
+        assert json.loads(tmpdir.join("output.1").read()) == json.loads(export_document(self.MESSAGES).decode('utf-8'))
+        assert not os.path.exists(export.partial_filename)
+        assert len(connection.requests) == 2
+        assert connection.requests[1][0] == self.BIN[0]
+
+    def test_stalled_download_is_resumed(self, tmpdir):
+        connection = FakeConnection(self.MESSAGES, cut_first_at=150, cut_error=ReadTimeoutError(None, None, "Read timed out."))
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON', connection=connection)
+
+        assert export.retrieve() is not None
+        assert json.loads(tmpdir.join("output.1").read()) == json.loads(export_document(self.MESSAGES).decode('utf-8'))
+        assert len(connection.requests) == 2
+
+    def test_query_superseded_by_a_resume_is_cancelled(self, tmpdir):
+        queries = FakeOutstandingQueries()
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON',
+                                 connection=FakeConnection(self.MESSAGES, cut_first_at=150), queries=queries)
+
+        assert export.retrieve() is not None
+        assert queries.cancelled == ["t1"]
+        assert queries.finished == ["t2"]
+
+    def test_cancelled_hedge_leaves_no_partial_file(self, tmpdir):
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON',
+                                 connection=FakeConnection(self.MESSAGES))
+        twin = export.hedge()
+        assert twin.partial_filename != export.partial_filename
+        twin.cancel()
+        with pytest.raises(Cancelled):
+            twin.retrieve()
+        assert not os.path.exists(twin.partial_filename)
+        assert export.retrieve() is not None
+
+    def test_hedge_which_loses_the_race_steps_aside(self, tmpdir):
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON',
+                                 connection=FakeConnection(self.MESSAGES))
+        twin = export.hedge()
+        export.download()
+        with pytest.raises(Cancelled):
+            twin.download()
+        assert not os.path.exists(twin.partial_filename)
+        assert json.loads(tmpdir.join("output.1").read()) == json.loads(export_document(self.MESSAGES).decode('utf-8'))
+
+    def test_download_whose_lease_was_lost_is_not_published(self, tmpdir, clock):
+        mine = Leases(str(tmpdir), expiry=60, owner="mine", heartbeat=False, clock=clock)
+        other = Leases(str(tmpdir), expiry=60, owner="other", heartbeat=False, clock=clock)
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON',
+                                 connection=FakeConnection(self.MESSAGES), leases=mine)
+        assert export.partial_filename == str(tmpdir.join("output.1." + mine.tag + ".partial"))
+        assert export.hedge().partial_filename == str(tmpdir.join("output.1." + mine.tag + ".hedge.partial"))
+
+        assert mine.acquire("output.1")
+        clock.now += 61
+        assert other.acquire("output.1")
+        with pytest.raises(LeaseLost):
+            export.retrieve()
+        assert not tmpdir.join("output.1").exists()
+
+    def test_partial_from_earlier_run_is_resumed(self, tmpdir):
+        connection = FakeConnection(self.MESSAGES)
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON', connection=connection)
+        with open(export.partial_filename, "wb") as f:
+            f.write(export_document(self.MESSAGES)[:300])
+
+        export.retrieve()
+        assert connection.requests[0][1] < self.BIN[1]  # Only the older part of the bin was requested
+        assert json.loads(tmpdir.join("output.1").read())["messages"] == self.MESSAGES
+
+    def test_publish_refuses_to_replace(self, tmpdir):
+        partial, filename = str(tmpdir.join("a.partial")), str(tmpdir.join("a"))
+        tmpdir.join("a.partial").write("new")
+        tmpdir.join("a").write("old")
+        with pytest.raises(FileExistsError):
+            publish(partial, filename)
+        assert tmpdir.join("a").read() == "old"
+
+        os.unlink(filename)
+        publish(partial, filename)
+        assert tmpdir.join("a").read() == "new"
+        assert not os.path.exists(partial)
+
+
+class TestPages(object):
+    BIN = (50, 50, 7)
+    MESSAGES = [{"text": "event %d" % i, "timestamp": 50, "fields": []} for i in range(7)]
+
+    @pytest.mark.parametrize("page_size, pages", [(3, 3), (6, 2), (7, 1), (20, 1)])
+    def test_bin_is_exported_in_pages(self, tmpdir, page_size, pages):
+        connection = FakeConnection(self.MESSAGES)
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON', connection=connection,
+                                 page_size=page_size)
+
+        assert export.retrieve() is not None
+        assert json.loads(tmpdir.join("output.50").read()) == json.loads(export_document(self.MESSAGES).decode('utf-8'))
+        assert len(connection.requests) == pages
+
+    def test_partition_filenames_are_distinct(self, tmpdir):
+        names = {bin_filename(self.BIN), bin_filename((50, 50, 3, ("hostname", "web1"))), bin_filename((50, 50, 4, ("hostname", "web2")))}
+        assert len(names) == 3
+        assert all(n.startswith("output.50") for n in names)
+
+        export = ExportBinToFile(root_query=FakeQuery(), bin=(50, 50, 3, ("hostname", "web1")), output_directory=str(tmpdir), output_format='JSON',
+                                 connection=FakeConnection(self.MESSAGES))
+        assert export.constraints == [("hostname", "web1")]
+
+    def test_server_ignoring_pages_is_detected(self, tmpdir):
+        export = ExportBinToFile(root_query=FakeQuery(), bin=self.BIN, output_directory=str(tmpdir), output_format='JSON',
+                                 connection=FakeConnection(self.MESSAGES, ignore_pages=True), page_size=3)
+        with pytest.raises(InconsistentFile):
+            export.retrieve()
+        assert not tmpdir.join("output.50").check()
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import warnings
+import pytest
+
+from loginsightexport.uidriver import Unauthorized
 
 
 # VMware vRealize Log Insight Exporter
@@ -30,3 +33,18 @@ def test_get_version_without_credentials(ui):
     with warnings.catch_warnings(record=True) as w:
         assert 'version' in ui.get("/api/v1/version").json()
     ui._requestsession.close()
+
+
+def test_streamed_body_is_not_buffered(uimock):
+    r = uimock.get("/api/v1/version", stream=True)
+    assert not r._content_consumed
+    assert 'version' in r.json()
+    uimock._requestsession.close()
+
+
+def test_unauthorized_carries_decoded_payload(uimock):
+    uimock._authprovider = None
+    with pytest.raises(Unauthorized) as e:
+        uimock.get("/api/v1/licenses", stream=True)
+    assert e.value.args[0] == 401
+    uimock._requestsession.close()
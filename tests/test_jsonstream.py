@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import pytest
+
+from loginsightexport.jsonstream import ExportDocumentReader, JsonStreamError
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+DOCUMENT = {
+    "from": 1,
+    "to": 3,
+    "hasMoreResults": False,
+    "messages": [
+        {"text": "first", "timestamp": 1234567890123, "fields": []},
+        {"text": "zweite Nachricht, naïve ☃", "timestamp": 1234567890122, "fields": [{"name": "a", "content": "b"}]},
+        {"text": "third", "timestamp": 1234567890121, "fields": []},
+    ],
+    "facetingFields": [],
+}
+
+
+def read(body, **kwargs):
+    return list(ExportDocumentReader(io.BytesIO(body), **kwargs))
+
+
+@pytest.mark.parametrize("buffer_size", [1, 3, 64 * 1024])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_matches_json_load(buffer_size, indent):
+    body = json.dumps(DOCUMENT, indent=indent, ensure_ascii=False).encode('utf-8')
+    events = read(body, buffer_size=buffer_size, offsets=True)
+
+    values = {key: value for kind, key, value, _, _ in events if kind == 'value'}
+    messages = [value for kind, _, value, _, _ in events if kind == 'message']
+    assert values == {k: v for k, v in DOCUMENT.items() if k != 'messages'}
+    assert messages == DOCUMENT['messages']
+    assert [value for kind, _, value, _, _ in events if kind == 'messages'] == [3]
+
+    # Offsets are in bytes, and slice out exactly the encoded value
+    for kind, key, value, start, end in events:
+        if kind in ('value', 'message'):
+            assert json.loads(body[start:end].decode('utf-8')) == value
+
+
+def test_number_split_across_buffers():
+    events = read(b'{"to": 12345678}', buffer_size=8)
+    assert events == [('value', 'to', 12345678, None, None)]
+
+
+def test_empty_messages():
+    events = read(b'{"messages": [], "to": 0}')
+    assert [(kind, value) for kind, _, value, _, _ in events] == [('messages', 0), ('value', 0)]
+
+
+@pytest.mark.parametrize("body", [b'', b'notjson', b'[1, 2]', b'{"to": 1', b'{"messages": [{"a": 1}', b'{"to": 1} trailing', b'{1: 2}'])
+def test_invalid(body):
+    with pytest.raises(JsonStreamError):
+        read(body, buffer_size=4)
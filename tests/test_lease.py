@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+import pytest
+
+from loginsightexport.lease import Leases, LeaseLost, claim
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+def leases(tmpdir, owner, clock):
+    return Leases(str(tmpdir), expiry=60, owner=owner, heartbeat=False, clock=clock)
+
+
+def test_lease_is_exclusive_until_released(tmpdir, clock):
+    a, b = leases(tmpdir, "a", clock), leases(tmpdir, "b", clock)
+    assert a.acquire("output.1")
+    assert a.acquire("output.1")  # Already ours
+    assert not b.acquire("output.1")
+    a.release("output.1")
+    assert b.acquire("output.1")
+
+
+def test_expired_lease_is_taken_over_and_its_holder_told(tmpdir, clock):
+    lost = []
+    a = Leases(str(tmpdir), expiry=60, owner="a", heartbeat=False, clock=clock, on_lost=lost.append)
+    b = leases(tmpdir, "b", clock)
+    assert a.acquire("output.1")
+
+    clock.now += 30
+    a.renew()
+    clock.now += 59
+    assert not b.acquire("output.1")  # Renewed, so still live
+
+    clock.now += 2
+    assert b.acquire("output.1")
+    assert a.renew() == ["output.1"]
+    assert lost == ["output.1"] and "output.1" in a.lost
+
+
+def test_holding_checks_the_lease_and_keeps_it_until_the_block_ends(tmpdir, clock):
+    a, b = leases(tmpdir, "a", clock), leases(tmpdir, "b", clock)
+    b._db.execute("PRAGMA busy_timeout = 0")  # Don't wait for a's write lock
+    assert a.acquire("output.1")
+    clock.now += 61  # Expired, but not yet taken over
+
+    with a.holding("output.1"):
+        with pytest.raises(sqlite3.OperationalError):
+            b.acquire("output.1")  # Locked out until a has finished
+
+    assert b.acquire("output.1")
+    with pytest.raises(LeaseLost):
+        with a.holding("output.1"):
+            pass
+    assert "output.1" in a.lost
+    assert a.tag != b.tag
+
+
+def test_close_releases_every_lease(tmpdir, clock):
+    a, b = leases(tmpdir, "a", clock), leases(tmpdir, "b", clock)
+    assert a.acquire("output.1") and a.acquire("output.2")
+    a.close()
+    assert b.acquire("output.1") and b.acquire("output.2")
+
+
+def test_claim_waits_for_items_leased_elsewhere(tmpdir, clock):
+    other, mine = leases(tmpdir, "other", clock), leases(tmpdir, "mine", clock)
+    finished = set()
+    assert other.acquire("2") and other.acquire("3")
+
+    def sleep(seconds):
+        clock.sleep(seconds)
+        finished.add("2")  # The other process finishes 2 and then dies, leaving 3's lease to lapse
+
+    claimed = list(claim(["1", "2", "3", "4"], mine, key=str, finished=lambda item: item in finished, poll=40, sleep=sleep))
+    assert claimed == ["1", "4", "2", "3"]
+    assert clock.now > 1060
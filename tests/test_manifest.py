@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os.path
+
+from loginsightexport.files import ExportBinToFile
+from loginsightexport.manifest import Manifest, file_digest
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+BIN = (1, 4, 55)
+
+
+def write(tmpdir, name, body):
+    filename = str(tmpdir.join(name))
+    with open(filename, "w") as f:
+        f.write(body)
+    return filename
+
+
+def test_record_survives_reload(tmpdir):
+    filename = write(tmpdir, "output.1", "abc")
+    Manifest(str(tmpdir)).record(filename, BIN, 3, file_digest(filename))
+
+    reloaded = Manifest(str(tmpdir))
+    assert len(reloaded) == 1
+    assert reloaded.matches(filename, BIN)
+    assert reloaded.lookup(filename).sha256 == file_digest(filename)
+
+
+def test_mismatches(tmpdir):
+    filename = write(tmpdir, "output.1", "abc")
+    manifest = Manifest(str(tmpdir))
+    manifest.record(filename, BIN, 3, None)
+
+    assert not manifest.matches(filename, (1, 4, 56))  # different bin
+    assert not manifest.matches(str(tmpdir.join("output.2")), BIN)  # never recorded
+
+    write(tmpdir, "output.1", "abcd")
+    assert not manifest.matches(filename, BIN)  # size changed
+
+    os.unlink(filename)
+    assert not manifest.matches(filename, BIN)  # deleted
+
+
+def test_torn_line_is_ignored(tmpdir):
+    filename = write(tmpdir, "output.1", "abc")
+    manifest = Manifest(str(tmpdir))
+    manifest.record(filename, BIN, 3, None)
+    with open(manifest.path, "a") as f:
+        f.write('{"filename": "output.2", "st')
+
+    assert len(Manifest(str(tmpdir))) == 1
+
+
+def test_retrieve_trusts_manifest(tmpdir):
+    filename = write(tmpdir, "output.1", "not json, but the manifest vouches for it")
+    manifest = Manifest(str(tmpdir))
+    manifest.record(filename, BIN, os.path.getsize(filename), None)
+
+    export = ExportBinToFile(root_query=None, bin=BIN, output_directory=str(tmpdir), output_format='JSON', connection=None, manifest=manifest)
+    assert export.retrieve() is None  # never parsed, or it would have raised InconsistentFile
+
+
+def test_retrieve_records_validated_file(tmpdir):
+    filename = write(tmpdir, "output.1", json.dumps({"hasMoreResults": False, "to": BIN[2]}))
+    manifest = Manifest(str(tmpdir))
+
+    export = ExportBinToFile(root_query=None, bin=BIN, output_directory=str(tmpdir), output_format='JSON', connection=None, manifest=manifest)
+    assert export.retrieve() is None
+    assert manifest.matches(filename, BIN)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from loginsightexport.plan import InvalidPlan, Plan, shard
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+URL = "https://li.example.com:443/explorer?existingChartQuery=%7B%7D"
+
+
+def test_plan_round_trip(tmpdir):
+    bins = [(1, 10, 5), (11, 11, 3, ("hostname", "a")), (11, 11, 4, ("hostname", 7)), (12, 20, 0)]
+    path = str(tmpdir.join("plan.json"))
+    Plan(URL, "JSON", 20, bins).save(path)
+
+    plan = Plan.load(path)
+    assert (plan.url, plan.output_format, plan.maximum) == (URL, "JSON", 20)
+    assert plan.bins == bins
+
+
+@pytest.mark.parametrize("content", ["", "[]", '{"version": 99, "bins": []}', '{"version": 1, "bins": [[1, 2, 3]]}'])
+def test_invalid_plan(tmpdir, content):
+    tmpdir.join("plan.json").write(content)
+    with pytest.raises(InvalidPlan):
+        Plan.load(str(tmpdir.join("plan.json")))
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7, 20])
+def test_shards_cover_the_plan_once(count):
+    bins = [(i * 10, i * 10 + 9, (i * 37) % 20) for i in range(50)]
+    shards = [shard(bins, index, count) for index in range(1, count + 1)]
+    assert [b for s in shards for b in s] == bins  # Contiguous, in order, and disjoint
+
+
+def test_shards_are_balanced_by_events():
+    bins = [(0, 0, 1000)] + [(i, i, 10) for i in range(1, 101)]
+    first, second = shard(bins, 1, 2), shard(bins, 2, 2)
+    assert sum(b[2] for b in first) == 1000
+    assert len(second) == 100
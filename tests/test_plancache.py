@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from loginsightexport.plancache import PlanCache, normalized_query
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+MODEL = {"query": "error", "startTimeMillis": 1, "endTimeMillis": 2, "dateFilterPreset": "CUSTOM", "eventSortOrder": "DESC", "fieldConstraints": []}
+NOW = 1500000000.0  # seconds
+OLD = (int(NOW * 1000) - 86400000, int(NOW * 1000) - 86400000 + 999)  # A day before NOW, in milliseconds
+RECENT = (int(NOW * 1000) - 1000, int(NOW * 1000))
+BINS = [(OLD[0], OLD[0] + 499, 10), (OLD[0] + 500, OLD[1], 20)]
+
+
+@pytest.fixture
+def clock(clock):
+    clock.now = NOW
+    return clock
+
+
+def cache(tmpdir, clock, model=MODEL, server="li.example.com:443", **kwargs):
+    return PlanCache(str(tmpdir), server=server, model=model, clock=clock, **kwargs)
+
+
+def test_normalized_query_ignores_range_and_tokens():
+    other = dict(MODEL, startTimeMillis=5, endTimeMillis=6, dateFilterPreset="LAST_HOUR", cancelToken="abc")
+    assert normalized_query(other) == normalized_query(MODEL)
+    assert normalized_query(dict(MODEL, query="warning")) != normalized_query(MODEL)
+
+
+def test_round_trip(tmpdir, clock):
+    cache(tmpdir, clock).put(OLD[0], OLD[1], BINS)
+
+    reopened = cache(tmpdir, clock)
+    assert reopened.get(OLD[0], OLD[1]) == BINS
+    assert reopened.get(OLD[0], OLD[1] + 1) is None
+    assert (reopened.hits, reopened.misses) == (1, 1)
+
+
+def test_keyed_by_server_and_query(tmpdir, clock):
+    cache(tmpdir, clock).put(OLD[0], OLD[1], BINS)
+
+    assert cache(tmpdir, clock, server="other.example.com:443").get(OLD[0], OLD[1]) is None
+    assert cache(tmpdir, clock, model=dict(MODEL, query="warning")).get(OLD[0], OLD[1]) is None
+    assert cache(tmpdir, clock, model=dict(MODEL, startTimeMillis=7)).get(OLD[0], OLD[1]) == BINS
+
+
+def test_keyed_by_account(tmpdir, clock):
+    cache(tmpdir, clock, username="admin", provider="Local").put(OLD[0], OLD[1], BINS)
+    assert cache(tmpdir, clock, username="admin", provider="Local").get(OLD[0], OLD[1]) == BINS
+    assert cache(tmpdir, clock, username="auditor", provider="Local").get(OLD[0], OLD[1]) is None  # May see other events
+    assert cache(tmpdir, clock, username="admin", provider="ActiveDirectory").get(OLD[0], OLD[1]) is None
+
+
+def test_recent_ranges_expire(tmpdir, clock):
+    c = cache(tmpdir, clock, ttl=60)
+    c.put(RECENT[0], RECENT[1], BINS)
+    c.put(OLD[0], OLD[1], BINS)
+
+    clock.now += 30
+    assert c.get(RECENT[0], RECENT[1]) == BINS
+
+    clock.now += 60
+    assert c.get(RECENT[0], RECENT[1]) is None
+    assert c.get(OLD[0], OLD[1]) == BINS  # Historical ranges are immutable
+
+    clock.now += 86400 * 365
+    assert cache(tmpdir, clock, ttl=60).get(OLD[0], OLD[1]) == BINS
+    assert len(os.listdir(str(tmpdir))) == 1  # The expired entry was evicted on opening
+
+
+def test_least_recently_used_are_evicted(tmpdir, clock):
+    c = cache(tmpdir, clock)
+    for i in range(5):
+        c.put(OLD[0] + i, OLD[1], BINS)
+        path = c._path(OLD[0] + i, OLD[1])
+        os.utime(path, (NOW + i, NOW + i))
+    os.utime(c._path(OLD[0], OLD[1]), (NOW + 10, NOW + 10))  # Used most recently
+
+    c = cache(tmpdir, clock, max_entries=2)
+    assert c.get(OLD[0], OLD[1]) == BINS
+    assert c.get(OLD[0] + 4, OLD[1]) == BINS
+    assert c.get(OLD[0] + 1, OLD[1]) is None
+
+
+def test_unreadable_entry_is_a_miss(tmpdir, clock):
+    c = cache(tmpdir, clock)
+    c.put(OLD[0], OLD[1], BINS)
+    with open(c._path(OLD[0], OLD[1]), 'w') as f:
+        f.write('{"start": ')
+    assert c.get(OLD[0], OLD[1]) is None
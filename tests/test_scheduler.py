@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import pytest
+
+from loginsightexport.scheduler import Scheduler, prefetch
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+@pytest.mark.parametrize("workers", [1, 2, 8])
+def test_every_item_processed_once(workers):
+    results = list(Scheduler(workers=workers).imap_unordered(lambda x: x * 2, range(50)))
+    assert sorted(results) == [(x, x * 2) for x in range(50)]
+
+
+def test_single_worker_preserves_order():
+    results = list(Scheduler(workers=1).imap_unordered(lambda x: x, [3, 1, 2]))
+    assert results == [(3, 3), (1, 1), (2, 2)]
+
+
+def test_concurrency_is_bounded():
+    lock = threading.Lock()
+    active = [0]
+    highest = [0]
+
+    def fn(x):
+        with lock:
+            active[0] += 1
+            highest[0] = max(highest[0], active[0])
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+        return x
+
+    list(Scheduler(workers=3).imap_unordered(fn, range(20)))
+    assert highest[0] == 3
+
+
+class FixedLimit(object):
+    current = 2
+
+
+def test_concurrency_follows_limit():
+    lock = threading.Lock()
+    active = [0]
+    highest = [0]
+
+    def fn(x):
+        with lock:
+            active[0] += 1
+            highest[0] = max(highest[0], active[0])
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+        return x
+
+    list(Scheduler(workers=8, limit=FixedLimit()).imap_unordered(fn, range(20)))
+    assert highest[0] == 2
+
+
+def test_items_are_pulled_lazily():
+    pulled = []
+
+    def source():
+        for x in range(100):
+            pulled.append(x)
+            yield x
+
+    results = Scheduler(workers=4).imap_unordered(lambda x: x, source())
+    next(results)
+    assert len(pulled) <= 5
+    results.close()
+
+
+def test_exception_propagates():
+    def fn(x):
+        if x == 5:
+            raise ZeroDivisionError()
+        return x
+
+    with pytest.raises(ZeroDivisionError):
+        list(Scheduler(workers=4).imap_unordered(fn, range(10)))
+
+
+def test_straggler_is_hedged_and_the_loser_cancelled():
+    released = threading.Event()
+    cancelled = []
+
+    def fn(x):
+        if x == 1:
+            released.wait(5)  # The straggler, until it's cancelled
+        return x
+
+    def cancel(x):
+        cancelled.append(x)
+        released.set()
+
+    results = dict(Scheduler(workers=3, hedge=1).imap_unordered(fn, range(1, 7), twin=lambda x: x + 100, cancel=cancel))
+    assert sorted(results) == [2, 3, 4, 5, 6, 101]
+    assert cancelled == [1]
+
+
+def test_hedge_covers_a_failure():
+    def fn(x):
+        if x == 1:
+            time.sleep(0.2)
+            raise ZeroDivisionError()
+        return x
+
+    results = dict(Scheduler(workers=3, hedge=1).imap_unordered(fn, range(1, 7), twin=lambda x: x + 100))
+    assert sorted(results) == [2, 3, 4, 5, 6, 101]
+
+
+def test_exception_propagates_when_both_copies_fail():
+    def fn(x):
+        if x in (1, 101):
+            time.sleep(0.2)
+            raise ZeroDivisionError()
+        return x
+
+    with pytest.raises(ZeroDivisionError):
+        list(Scheduler(workers=3, hedge=1).imap_unordered(fn, range(1, 7), twin=lambda x: x + 100))
+
+
+def test_running_items_are_cancelled_when_iteration_stops_early():
+    started = threading.Event()
+    released = threading.Event()
+    cancelled = []
+
+    def fn(x):
+        if x == 0:
+            return x
+        started.set()
+        released.wait(5)
+        return x
+
+    def cancel(x):
+        cancelled.append(x)
+        released.set()
+
+    results = Scheduler(workers=2).imap_unordered(fn, range(2), cancel=cancel)
+    assert next(results) == (0, 0)
+    started.wait(5)
+    results.close()
+    assert cancelled == [1]
+
+
+def test_invalid_worker_count():
+    with pytest.raises(ValueError):
+        Scheduler(workers=0)
+
+
+def test_prefetch_preserves_order():
+    assert list(prefetch(iter(range(100)), maxsize=3)) == list(range(100))
+
+
+def test_prefetch_applies_backpressure():
+    produced = []
+
+    def source():
+        for x in range(100):
+            produced.append(x)
+            yield x
+
+    items = prefetch(source(), maxsize=2)
+    assert next(items) == 0
+    time.sleep(0.1)
+    assert len(produced) <= 4  # one consumed, two buffered, one waiting to be enqueued
+    items.close()
+
+
+def test_prefetch_reraises_after_preceding_items():
+    def source():
+        yield 1
+        yield 2
+        raise ZeroDivisionError()
+
+    items = prefetch(source())
+    assert next(items) == 1
+    assert next(items) == 2
+    with pytest.raises(ZeroDivisionError):
+        next(items)
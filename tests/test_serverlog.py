@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import requests
+
+from loginsightexport.serverlog import ServerLog
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+class FakeConnection(object):
+    """Records what's posted to the server's log; blocks while `held` is clear, as a hung server would."""
+    def __init__(self, failing=False):
+        self.failing = failing
+        self.posted = []
+        self.held = threading.Event()
+        self.held.set()
+
+    def log(self, message, includeuseragent=True, echo=True):
+        assert not includeuseragent and not echo
+        self.held.wait()
+        if self.failing:
+            raise requests.exceptions.ConnectionError("refused")
+        self.posted.append(message.split("\n"))
+        return True
+
+
+def test_messages_are_sent_together_and_flushed_on_close():
+    connection = FakeConnection()
+    server_log = ServerLog(connection, interval=60)
+    for i in range(3):
+        assert server_log.log("message {0}".format(i), includeuseragent=False)
+    assert connection.posted == []  # Not on the caller's time
+
+    server_log.close()
+    assert connection.posted == [["message 0", "message 1", "message 2"]]
+    assert (server_log.sent, server_log.requests) == (3, 1)
+
+    assert server_log.log("after", includeuseragent=False)  # Once closed, sent straight away
+    assert connection.posted[-1] == ["after"]
+
+
+def test_messages_are_dropped_rather_than_waited_for():
+    connection = FakeConnection()
+    server_log = ServerLog(connection, capacity=2, interval=60)
+    results = [server_log.log("message {0}".format(i), includeuseragent=False) for i in range(5)]
+    assert results == [True, True, False, False, False]
+
+    server_log.close()
+    assert connection.posted[0][:2] == ["message 0", "message 1"]
+    assert "dropped 3 messages" in connection.posted[0][2]
+    assert server_log.dropped == 3
+
+
+def test_failure_to_send_is_not_raised():
+    connection = FakeConnection(failing=True)
+    server_log = ServerLog(connection, interval=60)
+    server_log.log("message", includeuseragent=False)
+    server_log.close()
+    assert server_log.sent == 0
+    assert not server_log.log("after", includeuseragent=False)
+
+
+def test_close_gives_up_on_a_hung_server():
+    connection = FakeConnection()
+    connection.held.clear()
+    server_log = ServerLog(connection, interval=60)
+    server_log.log("message", includeuseragent=False)
+    server_log.close(timeout=0.05)
+    connection.held.set()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+import requests
+
+from loginsightexport.sessioncache import SessionCache
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+def cache(tmpdir, clock, username="admin"):
+    return SessionCache(str(tmpdir.join("sessions")), "li.example.com", 443, username, "Local", maximum_age=3600, clock=clock)
+
+
+def jar():
+    cookies = requests.cookies.RequestsCookieJar()
+    cookies.set_cookie(requests.cookies.create_cookie("JSESSIONID", "abc123", domain="li.example.com", path="/"))
+    return cookies
+
+
+def test_round_trip(tmpdir, clock):
+    cache(tmpdir, clock).save(jar())
+    loaded = cache(tmpdir, clock).load()
+    assert [(c.name, c.value, c.domain, c.path) for c in loaded] == [("JSESSIONID", "abc123", "li.example.com", "/")]
+    assert cache(tmpdir, clock, username="other").load() is None
+
+
+def test_expired_entry_is_ignored(tmpdir, clock):
+    cache(tmpdir, clock).save(jar())
+    clock.now += 3601
+    assert cache(tmpdir, clock).load() is None
+
+
+@pytest.mark.skipif(os.name != 'posix', reason="POSIX permissions")
+def test_entry_others_can_read_is_ignored(tmpdir, clock):
+    c = cache(tmpdir, clock)
+    c.save(jar())
+    assert oct(os.stat(c.path).st_mode & 0o777) == oct(0o600)
+    os.chmod(c.path, 0o644)
+    assert c.load() is None
+
+
+def test_missing_or_corrupt_entry_is_ignored(tmpdir, clock):
+    c = cache(tmpdir, clock)
+    assert c.load() is None
+    c.save(jar())
+    with open(c.path, 'w') as f:
+        f.write("{")
+    assert c.load() is None
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+import requests
+
+from mock_loginsight_server import MockedConnection
+from loginsightexport.cancellation import OutstandingQueries
+from loginsightexport.sessionpool import SessionPool
+from loginsightexport.uidriver import Credentials
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+class FakeResponse(object):
+    def __init__(self, body=None, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+
+class FakeConnection(object):
+    """A session on a node which takes `latency` seconds of clock time to answer."""
+    def __init__(self, name, failing=False, clock=None, latency=0):
+        self.name = name
+        self.failing = failing
+        self.clock = clock
+        self.latency = latency
+        self.urls = []
+        self._hostname = name
+        self._authprovider = None
+        self._requestsession = requests.Session()
+
+    def get(self, url, params=None):
+        if self.failing:
+            raise requests.exceptions.ConnectionError("refused")
+        if self.clock is not None:
+            self.clock.now += self.latency
+        self.urls.append(url)
+        if url == '/logcancel':
+            return FakeResponse({"cancelToken": self.name})
+        return FakeResponse()
+
+    def post(self, url, data=None):
+        self.urls.append((url, data["cancelToken"]))
+        return FakeResponse({"succ": True})
+
+
+def run_in_threads(count, fn):
+    threads = [threading.Thread(target=fn) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_threads_are_spread_over_sessions_and_stick_to_one(clock):
+    connections = [FakeConnection("a"), FakeConnection("b"), FakeConnection("c")]
+    pool = SessionPool(connections, clock=clock)
+
+    def work():
+        for i in range(5):
+            pool.get("/" + pool.current().name)
+
+    run_in_threads(6, work)
+    assert [len(c.urls) for c in connections] == [10, 10, 10]
+    assert all(url == "/" + c.name for c in connections for url in c.urls)
+
+
+def test_failing_session_is_set_aside_and_logs_in_again(clock):
+    good, bad = FakeConnection("good"), FakeConnection("bad", failing=True)
+    bad._requestsession.cookies.set("JSESSIONID", "stale")
+    pool = SessionPool([bad, good], max_failures=2, cooldown=30, clock=clock)
+
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            pool.get("/")
+    assert len(bad._requestsession.cookies) == 0  # Dropped, so it logs in afresh
+
+    pool.get("/")
+    assert good.urls == ["/"]
+
+    clock.now += 31
+    bad.failing = False
+    run_in_threads(1, lambda: pool.get("/"))  # A new thread goes to the session with fewer threads, now healthy again
+    assert bad.urls == ["/"]
+
+
+def test_threads_favour_the_node_answering_fastest(clock):
+    fast, slow = FakeConnection("fast", clock=clock, latency=0.1), FakeConnection("slow", clock=clock, latency=0.4)
+    pool = SessionPool([fast, slow], rebalance_every=4, clock=clock)
+    ready = threading.Barrier(6)
+
+    def work():
+        ready.wait()
+        pool.get("/")  # Every thread's first request goes out before any is reassigned
+        ready.wait()
+        for i in range(40):
+            pool.get("/")
+
+    run_in_threads(6, work)
+    # Four times as fast, so worth sharing between up to four times as many threads
+    assert len(fast.urls) > 3 * len(slow.urls)
+    assert [m.threads for m in pool.members] in ([5, 1], [4, 2])
+
+
+def test_query_is_cancelled_through_the_session_that_issued_its_token():
+    connections = [FakeConnection("a"), FakeConnection("b")]
+    pool = SessionPool(connections)
+    queries = OutstandingQueries(pool)
+    tokens = []
+    run_in_threads(1, lambda: tokens.append(queries.token()))
+    run_in_threads(1, lambda: tokens.append(queries.token()))
+    assert sorted(tokens) == ["a", "b"]
+
+    queries.cancel_all()
+    assert connections[0].urls[-1] == ('/logcancel', "a")
+    assert connections[1].urls[-1] == ('/logcancel', "b")
+
+
+def test_query_goes_to_the_session_that_issued_its_token(clock):
+    slow, fast = FakeConnection("slow", clock=clock, latency=0.4), FakeConnection("fast", clock=clock, latency=0.1)
+    pool = SessionPool([slow, fast], rebalance_every=3, clock=clock)
+    queries = OutstandingQueries(pool)
+    pool.get("/")
+    run_in_threads(1, lambda: pool.get("/"))  # Finds the other session faster, so this thread would move to it mid-query
+
+    with queries.track() as token:
+        for page in range(4):
+            pool.get("/events/" + token)
+    assert token == "slow"
+    assert slow.urls == ["/", "/logcancel"] + ["/events/slow"] * 4
+    assert fast.urls == ["/"]
+
+
+def test_pooled_connections_log_in_separately():
+    ui = MockedConnection("mockserverlocal", auth=Credentials("admin", "password", "mock"))
+    pool = SessionPool.login(ui, 2)
+    first, second = [m.connection for m in pool.members]
+    assert first._authprovider is not second._authprovider
+    assert first._requestsession is not second._requestsession
+
+    for c in (first, second):
+        assert c.get("/api/v1/licenses").status_code == 200
+    assert first._authprovider.sessionId["JSESSIONID"] != second._authprovider.sessionId["JSESSIONID"]
+
+
+def test_pool_spans_the_nodes_of_a_cluster():
+    ui = MockedConnection("mockserverlocal", auth=Credentials("admin", "password", "mock"))
+    pool = SessionPool.login(ui, 2, nodes=[("mocknode2", 9543)])
+    assert [(m.connection._hostname, m.connection._port) for m in pool.members] == [("mockserverlocal", 443)] * 2 + [("mocknode2", 9543)] * 2
+
+    for m in pool.members:
+        r = m.connection.get("/api/v1/licenses")
+        assert r.status_code == 200
+        assert r.url.startswith("https://{0}:{1}/".format(m.connection._hostname, m.connection._port))
+    assert len(set(m.connection._authprovider.sessionId["JSESSIONID"] for m in pool.members)) == 4
+
+
+def test_copy_connection_to_another_node():
+    ui = MockedConnection("mockserverlocal", auth=Credentials("admin", "password", "mock"))
+    node = MockedConnection.copy_connection(ui, existing_session=requests.Session(), hostname="mocknode2", port=9543)
+    assert (node._hostname, node._port, node._apiroot) == ("mocknode2", 9543, "https://mocknode2:9543")
+    assert node._authprovider is not ui._authprovider and node._throttle is ui._throttle
+    assert node.get("/api/v1/licenses").status_code == 200
+
+    same = MockedConnection.copy_connection(ui)
+    assert (same._hostname, same._port) == ("mockserverlocal", 443)
+    assert same._requestsession is ui._requestsession and same._authprovider is ui._authprovider
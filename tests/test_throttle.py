@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from loginsightexport.throttle import AdaptiveLimit, BinSizer, Throttle, TokenBucket, congested
+
+
+# VMware vRealize Log Insight Exporter
+# Copyright © 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an “AS IS” BASIS, without warranties or
+# conditions of any kind, EITHER EXPRESS OR IMPLIED. See the License for the
+# specific language governing permissions and limitations under the License.
+
+
+class FakeAttempt(object):
+    def __init__(self, status=None, error=None):
+        self.status = status
+        self.error = error
+
+
+class FakeRetries(object):
+    def __init__(self, history):
+        self.history = history
+
+
+class FakeRaw(object):
+    def __init__(self, history=()):
+        self.retries = FakeRetries(list(history))
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, headers=None, history=()):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.raw = FakeRaw(history)
+
+
+def test_token_bucket_paces_requests(clock):
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+    waits = [bucket.consume() for _ in range(6)]
+    assert waits[:2] == [0, 0]  # The initial burst
+    assert waits[2:] == [0.5] * 4
+    assert clock.now == 1002.0
+
+
+def test_token_bucket_allows_debt(clock):
+    bucket = TokenBucket(rate=1000, clock=clock, sleep=clock.sleep)
+    assert bucket.consume(5000) == 4.0  # 1000 in hand, 4000 owed
+    assert bucket.consume(1) == pytest.approx(0.001)
+
+
+def test_slow_start_then_additive_increase(clock):
+    limit = AdaptiveLimit(maximum=20, clock=clock)
+    for _ in range(7):
+        limit.observe(clock(), latency=0.1)
+    assert limit.current == 8  # One more per success while nothing has gone wrong
+
+    assert limit.observe(clock(), congested=True)
+    assert limit.current == 4
+
+    for _ in range(5):
+        clock.now += 1
+        limit.observe(clock(), latency=0.1)
+    assert limit.current == 5  # About one more per round of `limit` successes
+
+
+def test_one_decrease_per_round(clock):
+    limit = AdaptiveLimit(maximum=20, initial=16, clock=clock)
+    started = clock()
+    clock.now += 1
+    for _ in range(5):
+        limit.observe(started, congested=True)  # All in flight together, they're one congestion event
+    assert limit.current == 8
+
+    limit.observe(clock() + 1, congested=True)
+    assert limit.current == 4
+
+
+def test_never_below_minimum_or_above_maximum(clock):
+    limit = AdaptiveLimit(maximum=3, clock=clock)
+    for _ in range(10):
+        clock.now += 1
+        limit.observe(clock(), congested=True)
+    assert limit.current == 1
+    for _ in range(100):
+        limit.observe(clock(), latency=0.1)
+    assert limit.current == 3
+
+
+def test_slow_responses_are_congestion(clock):
+    limit = AdaptiveLimit(maximum=20, initial=10, clock=clock)
+    assert not limit.observe(clock(), latency=0.5)
+    assert not limit.observe(clock(), latency=0.6)
+    assert limit.current == 12
+    assert limit.observe(clock(), latency=5.0)
+    assert limit.current == 6
+
+
+def test_slow_requests_are_only_compared_with_their_own_kind(clock):
+    limit = AdaptiveLimit(maximum=20, initial=10, clock=clock)
+    for i in range(5):
+        assert not limit.observe(clock(), latency=0.01, kind='/logcancel')
+        assert not limit.observe(clock(), latency=2.0, kind='/events')  # A query, always slower than a cancel token
+    assert limit.current == 20
+    assert limit.observe(clock(), latency=7.0, kind='/events')
+    assert limit.current == 10
+
+
+def test_throttle_times_each_kind_of_request_separately(clock):
+    limit = AdaptiveLimit(maximum=4, initial=2, clock=clock)
+    throttle = Throttle(concurrency=limit, clock=clock)
+    for kind, latency in [('/csrf', 0.01), ('/events', 2.0), ('/csrf', 0.01), ('/events', 2.5)]:
+        started = throttle.before_request()
+        clock.now += latency
+        throttle.after_response(started, response=FakeResponse(200), kind=kind)
+    assert limit.current == 4
+
+
+@pytest.mark.parametrize("response,expected", [
+    (FakeResponse(200), False),
+    (FakeResponse(503), True),
+    (FakeResponse(429), True),
+    (FakeResponse(200, history=[FakeAttempt(status=503)]), True),
+    (FakeResponse(200, headers={'Warning': '299 - "This API is a tech preview"'}), False),
+    (FakeResponse(200, headers={'Warning': '199 - "Server busy, slow down"'}), True),
+])
+def test_congestion_signals(response, expected):
+    assert congested(response) == expected
+
+
+def test_throttle_feeds_limit(clock):
+    limit = AdaptiveLimit(maximum=4, initial=2, clock=clock)
+    throttle = Throttle(concurrency=limit, clock=clock)
+
+    started = throttle.before_request()
+    throttle.after_response(started, response=FakeResponse(200))
+    assert limit.current == 3
+
+    clock.now += 1
+    started = throttle.before_request()
+    throttle.after_response(started, error=IOError("Connection reset"))
+    assert limit.current == 1
+
+
+def test_default_throttle_never_waits():
+    throttle = Throttle()
+    started = throttle.before_request()
+    throttle.after_response(started, response=FakeResponse(503))
+    throttle.before_download()
+    throttle.transferred(10 ** 9)
+
+
+def test_bin_sizer_targets_bytes():
+    sizer = BinSizer(2000, target_bytes=100000)
+    assert sizer() == 2000  # Nothing learned yet
+    sizer.observe(1000, 500000, 2.0)  # 500 bytes per event
+    assert sizer() == 200
+    sizer.observe(0, 100, 1.0)  # Ignored
+    assert sizer() == 200
+
+
+def test_bin_sizer_targets_seconds_after_overhead():
+    sizer = BinSizer(2000, target_seconds=10, minimum=50)
+    sizer.observe_query(2.0)
+    sizer.observe(100, 1000, 12.0)  # 0.1s per event after the 2s overhead
+    assert sizer() == 80
+    for _ in range(50):
+        sizer.observe(100, 1000, 102.0)  # Events got ten times slower
+    assert sizer() == 50
+    for _ in range(50):
+        sizer.observe(1000, 1000, 2.1)  # Nearly free
+    assert sizer() == 2000
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from urllib.parse import parse_qs, urlparse
-from loginsightexport.paramhelper import ExplorerUrlParse
+from loginsightexport.paramhelper import ExplorerUrlParse, exact_pattern
 import json
+import re
+
+import pytest
 
 # VMware vRealize Log Insight Exporter
 # Copyright © 2017 VMware, Inc. All Rights Reserved.
@@ -70,3 +73,27 @@ def test_extracted_fields_export_chart():
 
     proposed_charting = str(o.chartingurl_export())
     diff_url_components(c, proposed_charting)
+
+
+@pytest.mark.parametrize("value", ["web1", "web1.example.com", "a b", "(x|y)*", "c:\\temp\\", "^$", "100%", "naïve"])
+def test_partition_constraint_matches_exactly_its_value(value):
+    pattern = re.compile(exact_pattern(value))
+    assert pattern.match(value)
+    for other in (value + "0", "x" + value, value[:-1]):
+        assert not pattern.match(other)
+
+
+def test_partition_constraint_and_grouping():
+    u = '/explorer/?existingChartQuery=%7B%22query%22%3A%22%22%2C%22startTimeMillis%22%3A1479275107728%2C%22endTimeMillis%22%3A1479280737437%2C%22shouldGroupByTime%22%3Atrue%2C%22fieldConstraints%22%3A%5B%7B%22internalName%22%3A%22text%22%2C%22operator%22%3A%22CONTAINS%22%2C%22value%22%3A%22error%22%7D%5D%7D'
+    o = ExplorerUrlParse(u)
+
+    d = explode_url_components(o.messagesurl_export(outputformat="JSON", constraints=[("hostname", "web1")]))
+    assert d['existingMessageQuery']['fieldConstraints'] == [
+        {"internalName": "text", "operator": "CONTAINS", "value": "error"},
+        {"internalName": "hostname", "operator": "MATCHES_REGEX", "value": "^web1$"},
+    ]
+    assert o.existingChartQuery['fieldConstraints'] == [{"internalName": "text", "operator": "CONTAINS", "value": "error"}]  # Unchanged
+
+    d = explode_url_components(o.chartingurl_export(group_by="hostname"))
+    assert d['paramsHelper.shouldGroupByTime'] == ['false']
+    assert d['paramsHelper.groupByFields[0].internalName'] == ['hostname']